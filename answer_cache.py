@@ -0,0 +1,273 @@
+"""
+Semantic cache for RFx answers
+
+Before doing retrieval + generation we look for an answer
+already generated for a similar question (cosine similarity
+of the question embeddings above a threshold).
+
+Answers are scoped to (collection, collection version, model, lang, preamble):
+when the content of a collection changes the version changes
+and old answers are not used anymore.
+Answers are stored in SQLite, with citations and cited documents,
+and are returned in the same format produced by the llm.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.messages import AIMessage
+from oci.response import Response
+from oci.generative_ai_inference.models import (
+    ChatResult,
+    Citation,
+    CohereChatResponse,
+)
+
+from utils import get_console_logger
+
+from config import ANSWER_CACHE_PATH, ANSWER_CACHE_THRESHOLD
+
+logger = get_console_logger()
+
+
+def make_scope(collection, collection_version, llm_model, lang, preamble):
+    """
+    answers can be reused only inside the same scope
+    """
+    preamble_hash = hashlib.sha256(preamble.encode("utf-8")).hexdigest()
+
+    return f"{collection}:{collection_version}:{llm_model}:{lang}:{preamble_hash}"
+
+
+def serialize_response(response, llm_model) -> dict:
+    """
+    extract from the llm response what we need to rebuild it
+    """
+    if not llm_model.startswith("cohere"):
+        # Llama3, AIMessage
+        return {"text": response.content}
+
+    chat_response = response.data.chat_response
+
+    citations = [
+        {
+            "start": citation.start,
+            "end": citation.end,
+            "text": citation.text,
+            "document_ids": citation.document_ids,
+        }
+        for citation in (chat_response.citations or [])
+    ]
+
+    return {
+        "text": chat_response.text,
+        "citations": citations,
+        "documents": chat_response.documents,
+    }
+
+
+def deserialize_response(payload: dict, llm_model):
+    """
+    rebuild a response with the same structure produced by the llm
+    so that it can be used with get_text_from_response and citations functions
+    """
+    if not llm_model.startswith("cohere"):
+        return AIMessage(content=payload["text"])
+
+    chat_response = CohereChatResponse(
+        api_format="COHERE",
+        text=payload["text"],
+        citations=[Citation(**citation) for citation in payload["citations"]],
+        documents=payload["documents"],
+    )
+
+    return Response(
+        200, {}, ChatResult(model_id=llm_model, chat_response=chat_response), None
+    )
+
+
+class AnswerCache:
+    """
+    Semantic cache, thread safe
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, threshold=ANSWER_CACHE_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+
+        # for each scope: (ids, matrix of normalized embeddings)
+        self.index = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                collection TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers(scope)")
+        self.conn.commit()
+
+    def _load_scope(self, scope):
+        """
+        load (once) in memory the embeddings of the scope
+        """
+        if scope not in self.index:
+            rows = self.conn.execute(
+                "SELECT id, embedding FROM answers WHERE scope = ?", (scope,)
+            ).fetchall()
+
+            ids = [row[0] for row in rows]
+            if rows:
+                matrix = np.vstack(
+                    [np.frombuffer(row[1], dtype=np.float32) for row in rows]
+                )
+            else:
+                matrix = None
+
+            self.index[scope] = (ids, matrix)
+
+        return self.index[scope]
+
+    def _drop_from_index(self, scope, position):
+        """
+        remove from the in memory index an answer no more in the db
+        """
+        ids, matrix = self.index[scope]
+
+        ids = ids[:position] + ids[position + 1 :]
+        matrix = np.delete(matrix, position, axis=0) if ids else None
+
+        self.index[scope] = (ids, matrix)
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+
+        return vector / (np.linalg.norm(vector) + 1e-12)
+
+    def lookup(self, scope, question_embedding):
+        """
+        returns (payload, similarity) of the most similar question
+        or (None, similarity) if below threshold
+        """
+        with self.lock:
+            ids, matrix = self._load_scope(scope)
+
+            if matrix is None:
+                self.misses += 1
+                return None, 0.0
+
+            similarities = matrix @ self._normalize(question_embedding)
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+
+            if similarity < self.threshold:
+                self.misses += 1
+                return None, similarity
+
+            row = self.conn.execute(
+                "SELECT payload FROM answers WHERE id = ?", (ids[best],)
+            ).fetchone()
+
+            if row is None:
+                # deleted by another process (see invalidate_collection)
+                self._drop_from_index(scope, best)
+                self.misses += 1
+                return None, similarity
+
+            self.hits += 1
+
+        return json.loads(row[0]), similarity
+
+    def save(self, collection, scope, question, question_embedding, payload):
+        """
+        store a new answer
+        """
+        vector = self._normalize(question_embedding)
+
+        with self.lock:
+            cursor = self.conn.execute(
+                """
+                INSERT INTO answers
+                (collection, scope, question, embedding, payload, created)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    collection,
+                    scope,
+                    question,
+                    vector.tobytes(),
+                    json.dumps(payload),
+                    time.time(),
+                ),
+            )
+            self.conn.commit()
+
+            # keep the in memory index aligned
+            if scope in self.index:
+                ids, matrix = self.index[scope]
+                ids = ids + [cursor.lastrowid]
+                matrix = (
+                    vector[None, :] if matrix is None else np.vstack([matrix, vector])
+                )
+                self.index[scope] = (ids, matrix)
+
+    def invalidate_collection(self, collection):
+        """
+        drop all the answers for a collection (ex: docs added or removed)
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM answers WHERE collection = ?", (collection,))
+            self.conn.commit()
+
+            self.index = {
+                scope: value
+                for scope, value in self.index.items()
+                if not scope.startswith(f"{collection}:")
+            }
+
+        logger.info("Answer cache: invalidated collection %s", collection)
+
+    def get_stats(self) -> dict:
+        """
+        hit/miss counters
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_ANSWER_CACHE = None
+_ANSWER_CACHE_LOCK = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """
+    the answer cache shared in the process
+    """
+    global _ANSWER_CACHE
+
+    with _ANSWER_CACHE_LOCK:
+        if _ANSWER_CACHE is None:
+            _ANSWER_CACHE = AnswerCache()
+
+        return _ANSWER_CACHE
@@ -3,8 +3,12 @@ Batch loading
 
 Create a new collection and load a set of pdf
 Can be used ONLY for a new collection.
+
+embeddings are saved in checkpoints as they are computed:
+if the load fails, run again with --resume to embed only what's missing
 """
 
+import os
 import sys
 import argparse
 from glob import glob
@@ -14,14 +18,23 @@ from chunk_index_utils import (
     load_book_and_split,
     create_collection_and_add_docs_to_23ai,
 )
+from ingest_checkpoint import (
+    CheckpointStore,
+    PrecomputedEmbeddings,
+    embed_with_checkpoints,
+)
 from rfx_doc_loader_backend import get_list_collections
 from factory_rfx import get_embed_model
 
 from utils import get_console_logger
 
-from batch_loading_config import BOOKS_DIR
+from batch_loading_config import (
+    BOOKS_DIR,
+    INGEST_CHECKPOINT_DIR,
+    CHECKPOINT_SHARD_SIZE,
+)
 
-from config import CHUNK_SIZE, CHUNK_OVERLAP
+from config import CHUNK_SIZE, CHUNK_OVERLAP, OCI_EMBED_MODEL
 
 
 def compute_stats(list_docs):
@@ -50,6 +63,11 @@ parser = argparse.ArgumentParser(description="Document batch loading.")
 
 parser.add_argument("new_collection_name", type=str, help="New collection name.")
 parser.add_argument("books_dir", type=str, help="Dir with the books to load.")
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Resume a load interrupted, using the embeddings saved.",
+)
 
 args = parser.parse_args()
 
@@ -65,12 +83,31 @@ logger.info("")
 # init models
 embed_model = get_embed_model()
 
+checkpoint_store = CheckpointStore(
+    os.path.join(INGEST_CHECKPOINT_DIR, new_collection_name),
+    {
+        "embed_model": OCI_EMBED_MODEL,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+    },
+)
+is_resumed = args.resume and checkpoint_store.exists()
+
+if is_resumed:
+    checkpoint_store.resume()
+
 # check that the collection doesn't exist yet
+# when resumed, it can be the collection partially loaded by the same load:
+# only in this case it is dropped and created again
 collection_list = get_list_collections()
 
-if new_collection_name in collection_list:
+if new_collection_name in collection_list and not (
+    is_resumed and checkpoint_store.is_collection_created()
+):
     logger.info("")
     logger.error("Collection %s already exist!", new_collection_name)
+    if is_resumed:
+        logger.error("It has not been created by the load to resume.")
     logger.error("Exiting !")
     logger.info("")
 
@@ -100,9 +137,28 @@ for book in books_list:
 
 if len(docs) > 0:
     logger.info("")
-    logger.info("Embedding and loading documents in collection %s", new_collection_name)
+    logger.info("Embedding documents...")
+
+    if not is_resumed:
+        checkpoint_store.start()
+
+    embed_with_checkpoints(docs, embed_model, checkpoint_store, CHECKPOINT_SHARD_SIZE)
+
+    logger.info("")
+    logger.info("Loading documents in collection %s", new_collection_name)
+
+    checkpoint_store.set_collection_created()
+
+    dedup_stats = create_collection_and_add_docs_to_23ai(
+        docs, PrecomputedEmbeddings(checkpoint_store, embed_model), new_collection_name
+    )
+
+    if dedup_stats is None:
+        logger.error("Loading failed, run again with --resume")
+        sys.exit(-1)
 
-    create_collection_and_add_docs_to_23ai(docs, embed_model, new_collection_name)
+    # completed: the checkpoint is not needed anymore
+    checkpoint_store.remove()
 
     logger.info("Loading completed.")
     logger.info("")
@@ -112,6 +168,11 @@ if len(docs) > 0:
     logger.info("")
     logger.info("Statistics on the distribution of chunk lengths:")
     logger.info("Total num. of chunks loaded: %s", len(docs))
+    logger.info(
+        "Duplicated chunks (embedded once): %s (dedup ratio %.2f)",
+        dedup_stats["saved"],
+        dedup_stats["texts"] / max(dedup_stats["embedded"], 1),
+    )
     logger.info("Avg. length : %s (chars)", mean)
     logger.info("Std dev: %s (chars)", stdev)
     logger.info("75-perc. : %s (chars)", perc_75)
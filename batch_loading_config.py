@@ -4,3 +4,9 @@ config for batch_loading
 
 # directory where pdf must be
 BOOKS_DIR = "./books"
+
+# embeddings computed are saved here (a dir for each collection)
+# to resume a load interrupted (--resume)
+INGEST_CHECKPOINT_DIR = "./cache/ingest"
+# num. of chunks in a checkpoint shard
+CHECKPOINT_SHARD_SIZE = 960
@@ -7,20 +7,26 @@ Python Version: 3.11
 Usage: contains the functions to split in chunks and create the index
 """
 
+import hashlib
 from glob import glob
+from typing import List
 from tqdm.auto import tqdm
 import oracledb
 
+from langchain_core.embeddings import Embeddings
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_community.vectorstores import OpenSearchVectorSearch
-from langchain_community.vectorstores.oraclevs import OracleVS
+from langchain_community.vectorstores.oraclevs import drop_table_purge
 from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from oraclevs_4_rfx import OracleVS4RFX
+from opensearch_4_rfx import OpenSearchRFX
 from utils import get_console_logger, remove_path_from_ref
 from config import (
     CHUNK_SIZE,
     CHUNK_OVERLAP,
+    EMBEDDINGS_BITS,
     OPENSEARCH_URL,
     OPENSEARCH_INDEX_NAME,
 )
@@ -35,6 +41,91 @@ from config_private import (
 )
 
 
+def get_embedding_dim(embed_model):
+    """
+    the num. of dimensions of the vectors
+    """
+    return len(embed_model.embed_query("What is a Oracle database"))
+
+
+def get_text_hash(text):
+    """
+    to find chunks with the same text
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class DedupEmbeddings(Embeddings):
+    """
+    Embeddings for ingestion: each distinct text is embedded once
+    and the vector is used for every chunk with that text
+    (repeated boilerplate: legal notices, headers, tables)
+
+    Usage:
+        OracleVS.from_documents(docs, DedupEmbeddings(embed_model), ...)
+    """
+
+    def __init__(self, embed_model: Embeddings):
+        self.embed_model = embed_model
+
+        # stats
+        self.n_texts = 0
+        self.n_embedded = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        logger = get_console_logger()
+
+        hashes = [get_text_hash(text) for text in texts]
+
+        # dict to remove duplicates, keeping the order
+        distinct = {}
+        for text_hash, text in zip(hashes, texts):
+            distinct.setdefault(text_hash, text)
+
+        vectors = self.embed_model.embed_documents(list(distinct.values()))
+        vectors_by_hash = dict(zip(distinct.keys(), vectors))
+
+        self.n_texts += len(texts)
+        self.n_embedded += len(distinct)
+
+        if len(distinct) < len(texts):
+            logger.info(
+                "Embedded %d distinct texts for %d chunks, %d embeddings saved",
+                len(distinct),
+                len(texts),
+                len(texts) - len(distinct),
+            )
+
+        return [vectors_by_hash[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_model.embed_query(text)
+
+    def get_stats(self):
+        """
+        num. of texts, of embeddings computed and saved
+        """
+        return {
+            "texts": self.n_texts,
+            "embedded": self.n_embedded,
+            "saved": self.n_texts - self.n_embedded,
+        }
+
+    def log_stats(self):
+        """
+        log the stats, at the end of a load
+        """
+        stats = self.get_stats()
+
+        get_console_logger().info(
+            "Embedded %d distinct texts for %d chunks (%d saved, dedup ratio %.2f)",
+            stats["embedded"],
+            stats["texts"],
+            stats["saved"],
+            stats["texts"] / max(stats["embedded"], 1),
+        )
+
+
 def get_recursive_text_splitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
     """
     return a recursive text splitter
@@ -73,28 +164,45 @@ def create_collection_and_add_docs_to_23ai(docs, embed_model, collection_name):
     """
     create the collection and load docs in that collection
     To be used only for a NEW collection
+
+    vectors are stored with EMBEDDINGS_BITS (32: FLOAT32, 8: INT8)
+    returns the stats of DedupEmbeddings (None if the load failed)
     """
     logger = get_console_logger()
 
+    dedup_embeddings = DedupEmbeddings(embed_model)
+
     try:
         dsn = f"{DB_HOST_IP}:1521/{DB_SERVICE}"
 
         connection = oracledb.connect(user=DB_USER, password=DB_PWD, dsn=dsn)
 
-        OracleVS.from_documents(
-            docs,
-            embed_model,
+        drop_table_purge(connection, collection_name)
+
+        # the table is created with the format in config (EMBEDDINGS_BITS)
+        v_store = OracleVS4RFX(
             client=connection,
             table_name=collection_name,
             distance_strategy=DistanceStrategy.COSINE,
+            embedding_function=dedup_embeddings,
         )
 
+        v_store.add_documents(docs)
+
         logger.info("Created collection and documents saved...")
+        dedup_embeddings.log_stats()
+
+        # for keyword search (hybrid search)
+        OracleVS4RFX.create_text_index(connection, collection_name)
 
     except oracledb.Error as e:
         err_msg = "An error occurred in create_collection_and_add_docs: " + str(e)
         logger.error(err_msg)
 
+        return None
+
+    return dedup_embeddings.get_stats()
+
 
 def add_docs_to_23ai(docs, embed_model, collection_name):
     """
@@ -103,16 +211,19 @@ def add_docs_to_23ai(docs, embed_model, collection_name):
     """
     logger = get_console_logger()
 
+    dedup_embeddings = DedupEmbeddings(embed_model)
+
     try:
         dsn = f"{DB_HOST_IP}:1521/{DB_SERVICE}"
 
         connection = oracledb.connect(user=DB_USER, password=DB_PWD, dsn=dsn)
 
-        v_store = OracleVS(
+        # vectors are quantized as the ones already in the collection
+        v_store = OracleVS4RFX(
             client=connection,
             table_name=collection_name,
             distance_strategy=DistanceStrategy.COSINE,
-            embedding_function=embed_model,
+            embedding_function=dedup_embeddings,
         )
 
         logger.info("Saving new documents to Vector Store...")
@@ -120,6 +231,7 @@ def add_docs_to_23ai(docs, embed_model, collection_name):
         v_store.add_documents(docs)
 
         logger.info("Saved new documents to Vector Store !")
+        dedup_embeddings.log_stats()
 
     except oracledb.Error as e:
         err_msg = "An error occurred in add_docs_to_23ai: " + str(e)
@@ -132,8 +244,10 @@ def add_docs_to_opensearch(docs, embed_model):
     """
     logger = get_console_logger()
 
+    dedup_embeddings = DedupEmbeddings(embed_model)
+
     v_store = OpenSearchVectorSearch(
-        embedding_function=embed_model,
+        embedding_function=dedup_embeddings,
         opensearch_url=OPENSEARCH_URL,
         http_auth=(OPENSEARCH_USER, OPENSEARCH_PWD),
         use_ssl=True,
@@ -145,11 +259,21 @@ def add_docs_to_opensearch(docs, embed_model):
         engine="faiss",
     )
 
+    if EMBEDDINGS_BITS != 32:
+        # the index is created with fp16 vectors
+        OpenSearchRFX.create_index(
+            v_store.client,
+            OPENSEARCH_INDEX_NAME,
+            get_embedding_dim(embed_model),
+            EMBEDDINGS_BITS,
+        )
+
     logger.info("Saving new documents to Vector Store...")
 
     v_store.add_documents(docs)
 
     logger.info("Saved new documents to Vector Store !")
+    dedup_embeddings.log_stats()
 
 
 def load_books_and_split(books_dir) -> list:
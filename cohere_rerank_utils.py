@@ -0,0 +1,274 @@
+"""
+Extensions to CohereRerank
+
+* acompress_documents uses the Cohere async client, instead of
+  running the sync call in an executor
+* scores are cached, keyed by (rerank model, query hash, chunk id):
+  only (query, chunk) pairs never scored are sent to Cohere
+* rerank_many reranks the candidates of many questions concurrently
+"""
+
+import asyncio
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Any, List, Optional, Sequence
+
+import cohere
+from langchain_cohere import CohereRerank
+from langchain_core.callbacks.manager import Callbacks
+from langchain_core.documents import Document
+
+from rank_fusion import get_doc_key
+from deadlines import DeadlineExceeded, mark_service_call, time_left
+from utils import get_console_logger
+
+from config import RERANK_CACHE_SIZE, RERANK_MAX_CONCURRENCY
+
+logger = get_console_logger()
+
+
+def get_hash(text: str) -> str:
+    """
+    sha256 of a text
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_chunk_id(doc: Document) -> str:
+    """
+    identify a chunk (same chunk -> same id)
+    """
+    return get_hash(repr(get_doc_key(doc)))
+
+
+class RerankScoreCache:
+    """
+    LRU cache for rerank scores, thread safe
+    """
+
+    def __init__(self, max_items=RERANK_CACHE_SIZE):
+        self.max_items = max_items
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        return the score or None
+        """
+        with self.lock:
+            score = self.scores.get(key)
+
+            if score is None:
+                self.misses += 1
+            else:
+                self.scores.move_to_end(key)
+                self.hits += 1
+
+        return score
+
+    def put(self, key, score):
+        """
+        add a score
+        """
+        with self.lock:
+            self.scores[key] = score
+            self.scores.move_to_end(key)
+
+            if len(self.scores) > self.max_items:
+                self.scores.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        """
+        hit/miss counters
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+# shared by all the rerankers in the process
+_SCORE_CACHE = RerankScoreCache()
+
+# for rerank_many
+_EXECUTOR = ThreadPoolExecutor(max_workers=RERANK_MAX_CONCURRENCY)
+
+
+def get_request_options():
+    """
+    with a time limit (see deadlines.time_left) the timeout is the time left
+    and there are no retries
+    """
+    left = time_left()
+
+    if left is None:
+        return None
+
+    if left <= 0:
+        raise DeadlineExceeded("No time left for rerank")
+
+    return {"timeout_in_seconds": left, "max_retries": 0}
+
+
+class CohereRerankAsync(CohereRerank):
+    """
+    CohereRerank with a native async path and cached scores
+    """
+
+    async_clients: Any = None
+    """Cohere async clients, one for each event loop, created on first use"""
+
+    def _get_async_client(self):
+        """
+        the client for the running event loop (its httpx client
+        can't be used in another loop)
+        """
+        loop = asyncio.get_running_loop()
+
+        if self.async_clients is None:
+            self.async_clients = weakref.WeakKeyDictionary()
+
+        async_client = self.async_clients.get(loop)
+
+        if async_client is None:
+            async_client = cohere.AsyncClient(
+                self.cohere_api_key, client_name=self.user_agent
+            )
+            self.async_clients[loop] = async_client
+
+        return async_client
+
+    def _lookup_scores(self, documents, query):
+        """
+        returns the cache keys, the scores found (by position)
+        and the positions of the docs to be sent to Cohere
+        """
+        query_hash = get_hash(query)
+
+        keys = [(self.model, query_hash, get_chunk_id(doc)) for doc in documents]
+
+        scores = {}
+        to_score = []
+        for i, key in enumerate(keys):
+            score = _SCORE_CACHE.get(key)
+
+            if score is None:
+                to_score.append(i)
+            else:
+                scores[i] = score
+
+        return keys, scores, to_score
+
+    def _save_scores(self, results, keys, scores, to_score):
+        """
+        results: the results from Cohere (index relative to to_score)
+        """
+        for res in results:
+            i = to_score[res.index]
+
+            scores[i] = res.relevance_score
+            _SCORE_CACHE.put(keys[i], res.relevance_score)
+
+    def _select_top_n(self, documents, scores):
+        """
+        the top_n docs, with relevance_score in metadata
+        """
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+        compressed = []
+        for i, score in ranked[: self.top_n]:
+            doc = documents[i]
+            doc_copy = Document(doc.page_content, metadata=deepcopy(doc.metadata))
+            doc_copy.metadata["relevance_score"] = score
+            compressed.append(doc_copy)
+
+        return compressed
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        """
+        rerank, sending to Cohere only the docs not in cache
+        """
+        if len(documents) == 0:
+            return []
+
+        keys, scores, to_score = self._lookup_scores(documents, query)
+
+        if to_score:
+            mark_service_call()
+
+            # we need the scores of all the docs sent, to cache them
+            results = self.client.rerank(
+                query=query,
+                documents=[documents[i].page_content for i in to_score],
+                model=self.model,
+                top_n=len(to_score),
+                request_options=get_request_options(),
+            )
+            self._save_scores(results.results, keys, scores, to_score)
+
+        return self._select_top_n(documents, scores)
+
+    async def acompress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        """
+        async version of compress_documents
+        """
+        if len(documents) == 0:
+            return []
+
+        keys, scores, to_score = self._lookup_scores(documents, query)
+
+        if to_score:
+            results = await self._get_async_client().rerank(
+                query=query,
+                documents=[documents[i].page_content for i in to_score],
+                model=self.model,
+                top_n=len(to_score),
+            )
+            self._save_scores(results.results, keys, scores, to_score)
+
+        return self._select_top_n(documents, scores)
+
+    def rerank_many(
+        self, queries: List[str], list_docs: List[List[Document]]
+    ) -> List[List[Document]]:
+        """
+        rerank the candidates of many questions
+
+        identical questions are reranked only once, the others
+        are sent concurrently (at most RERANK_MAX_CONCURRENCY requests)
+        """
+        futures = {}
+        for query, docs in zip(queries, list_docs):
+            request_key = (query, tuple(get_chunk_id(doc) for doc in docs))
+
+            if request_key not in futures:
+                futures[request_key] = _EXECUTOR.submit(
+                    self.compress_documents, docs, query
+                )
+
+        return [
+            futures[(query, tuple(get_chunk_id(doc) for doc in docs))].result()
+            for query, docs in zip(queries, list_docs)
+        ]
+
+
+def get_rerank_cache_stats() -> dict:
+    """
+    hit/miss counters of the scores cache
+    """
+    return _SCORE_CACHE.get_stats()
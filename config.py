@@ -27,17 +27,68 @@ CHUNK_OVERLAP = 100
 # with Cohere embeddings max is 96
 # value: COHERE, OCI
 EMBED_MODEL_TYPE = "OCI"
-EMBED_BATCH_SIZE = 90
+# max num. of texts in a batch
+EMBED_BATCH_SIZE = 96
+# batches are also limited by estimated tokens and payload size
+EMBED_MAX_BATCH_TOKENS = 40000
+EMBED_MAX_BATCH_BYTES = 1000000
+# (sec.) the tokens per batch are adapted to get this latency
+EMBED_TARGET_LATENCY = 2.0
+# max num. of embedding batches in flight
+EMBED_MAX_CONCURRENCY = 4
 OCI_EMBED_MODEL = "cohere.embed-multilingual-v3.0"
 COHERE_EMBED_MODEL = "embed-multilingual-v3.0"
 
+# cache for embeddings (memory LRU + SQLite on disk)
+EMBED_CACHE_ENABLED = True
+EMBED_CACHE_PATH = "./cache/embeddings.sqlite"
+# max num. of vectors kept
+EMBED_CACHE_MEMORY_SIZE = 10000
+EMBED_CACHE_DISK_SIZE = 500000
+
 # current endpoint for OCI GenAI (embed and llm) models
 # switched to FRA (19/06)
 ENDPOINT = "https://inference.generativeai.eu-frankfurt-1.oci.oraclecloud.com"
 
+# more endpoints for a model (ex: more regions), requests are routed
+# to the fastest healthy one. Models not listed use ENDPOINT
+# ex: {"cohere.command-r-plus": [ENDPOINT, "https://inference.generativeai.us-chicago-1.oci.oraclecloud.com"]}
+MODEL_ENDPOINTS = {}
+# an endpoint with a higher (rolling) error rate is avoided for ROUTER_COOLDOWN sec.
+ROUTER_MAX_ERROR_RATE = 0.5
+ROUTER_COOLDOWN = 30
+# fraction of requests sent to a random healthy endpoint, to refresh its stats
+ROUTER_EXPLORE_RATE = 0.05
+
+# to use the local stand-in server instead of OCI GenAI (oci_genai_standin.py)
+# ex: "http://localhost:8088", None: use ENDPOINT
+OCI_GENAI_STANDIN_URL = None
+
+# max num. of connections kept alive for each OCI GenAI client
+# (clients are shared between threads)
+OCI_CLIENT_POOL_SIZE = 32
+
+# throttling of OCI GenAI calls (chat and embed), for each model
+# max requests/sec. (halved on 429, then slowly recovered)
+OCI_RATE_LIMIT = 10.0
+OCI_RATE_LIMIT_BURST = 10
+# to set a different rate for some models
+OCI_MODEL_RATE_LIMITS = {}
+# retries on 429, 5xx and network errors, with exponential backoff (sec.)
+OCI_MAX_RETRIES = 5
+OCI_BACKOFF_BASE = 1.0
+OCI_BACKOFF_MAX = 30.0
+# after these consecutive failures stop calling a model for OCI_CIRCUIT_RESET sec.
+OCI_CIRCUIT_FAILURES = 5
+OCI_CIRCUIT_RESET = 30
+
 # reranker, True only to experiment
 ADD_RERANKER = True
 COHERE_RERANKER_MODEL = "rerank-multilingual-v3.0"
+# max num. of (query, chunk) scores cached in memory
+RERANK_CACHE_SIZE = 50000
+# max num. of rerank requests in flight (batch of questions)
+RERANK_MAX_CONCURRENCY = 8
 
 # only for rfx, instead of reranker
 ADD_LLMLINGUA = False
@@ -45,16 +96,58 @@ ADD_LLMLINGUA = False
 # Alternative to above
 ADD_LLM_CHAIN_EXTRACTOR = False
 
+# HyDE
+# sequential: generate the hyde doc, then search (the original behaviour)
+# fused (opt-in): search with the query while the hyde doc is generated,
+# merge with RRF
+HYDE_MODE = "sequential"
+# (sec.) in fused mode, after this the hyde doc is ignored
+HYDE_TIMEOUT = 30
+
 # retriever
 TOP_K = 8
 TOP_N = 4
 
+# time budget (sec.) for a question in the UI, None: no limit
+# (classic_rag/hyde_rag have no limit, unless a deadline is passed)
+QUESTION_DEADLINE = 120
+# share of the budget for each stage, in order (hyde only with HyDE)
+# the time not used by a stage is left to the following ones
+DEADLINE_SPLIT = {"hyde": 0.2, "embed": 0.05, "search": 0.1, "rerank": 0.1, "llm": 0.55}
+# if an embed or rerank call is slower than this percentile of
+# the observed latencies, a duplicate is sent and the first reply is used
+HEDGE_ENABLED = True
+HEDGE_PERCENTILE = 95
+# observations needed before hedging
+HEDGE_MIN_SAMPLES = 20
+# threads for the hedged calls
+DEADLINE_MAX_WORKERS = 32
+
+# max number of RFx questions processed in parallel
+MAX_CONCURRENT_QUESTIONS = 4
+# with the async entry points (aclassic_rag, ahyde_rag)
+MAX_ASYNC_QUESTIONS = 100
+
+# semantic cache for answers
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_PATH = "./cache/answers.sqlite"
+# min cosine similarity between questions to reuse an answer
+ANSWER_CACHE_THRESHOLD = 0.95
+
 # to limit chat_history
 # probably in rfp can be kept low
 MAX_MSGS_IN_CHAT = 2
 
 # Oracle VS
+# bits of the stored vectors, for new collections
+# 23AI: 32 (FLOAT32) or 8 (INT8, quantized), OPENSEARCH: 32 or 16 (fp16)
 EMBEDDINGS_BITS = 32
+# max num. of connections used by async search
+ASYNC_DB_POOL_SIZE = 16
+# max num. of connections used by vector search (questions in parallel)
+SEARCH_DB_POOL_SIZE = 8
+# max num. of connections (and threads) used by keyword search (hybrid search)
+KEYWORD_DB_POOL_SIZE = 8
 
 # Vector Store
 # VECTOR_STORE_TYPE = "OPENSEARCH"
@@ -83,9 +176,33 @@ OCI_GENAI_MODEL = "cohere.command-r-plus"
 TEMPERATURE = 0.1
 MAX_TOKENS = 2048
 
+# context window (tokens) of the models, the docs sent to the LLM
+# are packed in it, leaving room for MAX_TOKENS
+MODEL_CONTEXT_WINDOWS = {
+    "cohere.command-r-16k": 16000,
+    "cohere.command-r-plus": 128000,
+    "meta.llama-3-70b-instruct": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# to cap the context (latency, cost), None: only the window
+MAX_CONTEXT_TOKENS = None
+# a tokenizer.json (HF tokenizers) to count tokens, None: estimate from length
+TOKENIZER_PATH = None
+
 # to enable streaming
 DO_STREAMING = False
 
+# identical (non streaming) LLM requests in flight are sent only once
+LLM_SINGLE_FLIGHT = True
+
+# record/replay of LLM responses (non streaming), for evaluation and
+# regression runs: passthrough, record, replay (offline)
+# embeddings are recorded in the embeddings cache (EMBED_CACHE_PATH, keep
+# EMBED_CACHE_DISK_SIZE large enough); streamed answers and rerank are not
+# recorded: to replay offline use DO_STREAMING = False and no reranker
+LLM_REPLAY_MODE = "passthrough"
+LLM_REPLAY_PATH = "./cache/llm_replay.sqlite"
+
 # for TRACING
 LANGCHAIN_PROJECT = "rfx-05"
 
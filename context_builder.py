@@ -0,0 +1,160 @@
+"""
+Token budgeted context
+
+the retrieved chunks are packed, in rank order, in the context window
+of the model, leaving room for the answer (MAX_TOKENS)
+
+tokens are counted with a tokenizer file (TOKENIZER_PATH), if given,
+otherwise estimated from the length; counts are cached per chunk id
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+from cohere_rerank_utils import get_chunk_id
+from utils import get_console_logger
+
+from config import (
+    MODEL_CONTEXT_WINDOWS,
+    DEFAULT_CONTEXT_WINDOW,
+    MAX_CONTEXT_TOKENS,
+    MAX_TOKENS,
+    TOKENIZER_PATH,
+)
+
+logger = get_console_logger()
+
+# conservative: multilingual texts have less chars per token than english
+CHARS_PER_TOKEN = 3
+# for each doc: the other fields (id, source, page) and the formatting
+DOC_OVERHEAD_TOKENS = 20
+# for the chat template and the preamble formatting
+PROMPT_OVERHEAD_TOKENS = 100
+# max num. of counts kept in cache
+TOKEN_CACHE_SIZE = 100000
+
+_TOKENIZER = None
+_TOKENIZER_LOCK = threading.Lock()
+
+
+def _get_tokenizer():
+    """
+    the tokenizer loaded from TOKENIZER_PATH, None if not configured
+    """
+    global _TOKENIZER
+
+    if TOKENIZER_PATH is None:
+        return None
+
+    with _TOKENIZER_LOCK:
+        if _TOKENIZER is None:
+            # imported here: needed only if configured
+            from tokenizers import Tokenizer
+
+            _TOKENIZER = Tokenizer.from_file(TOKENIZER_PATH)
+
+    return _TOKENIZER
+
+
+def count_tokens(text):
+    """
+    num. of tokens of a text (estimated, if there is no tokenizer)
+    """
+    tokenizer = _get_tokenizer()
+
+    if tokenizer is not None:
+        return len(tokenizer.encode(text).ids)
+
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class TokenCountCache:
+    """
+    LRU cache for the token counts of chunks, thread safe
+    """
+
+    def __init__(self, max_items=TOKEN_CACHE_SIZE):
+        self.max_items = max_items
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_doc_tokens(self, doc):
+        """
+        num. of tokens of the chunk
+        """
+        chunk_id = get_chunk_id(doc)
+
+        with self.lock:
+            n_tokens = self.counts.get(chunk_id)
+
+            if n_tokens is not None:
+                self.counts.move_to_end(chunk_id)
+                return n_tokens
+
+        n_tokens = count_tokens(doc.page_content)
+
+        with self.lock:
+            self.counts[chunk_id] = n_tokens
+
+            if len(self.counts) > self.max_items:
+                self.counts.popitem(last=False)
+
+        return n_tokens
+
+
+_TOKEN_CACHE = TokenCountCache()
+
+
+def get_context_budget(llm_model, *texts):
+    """
+    the num. of tokens available for the docs
+
+    texts: the other parts of the prompt (preamble, query...)
+    """
+    window = MODEL_CONTEXT_WINDOWS.get(llm_model, DEFAULT_CONTEXT_WINDOW)
+
+    budget = window - MAX_TOKENS - PROMPT_OVERHEAD_TOKENS
+    budget -= sum(count_tokens(text) for text in texts)
+
+    if MAX_CONTEXT_TOKENS is not None:
+        budget = min(budget, MAX_CONTEXT_TOKENS)
+
+    return max(budget, 0)
+
+
+def fit_docs_to_budget(docs, llm_model, *texts):
+    """
+    docs: the retrieved docs, in rank order
+    texts: the other parts of the prompt (preamble, query...)
+
+    returns the docs kept (same order) and the docs dropped
+    a doc that doesn't fit is dropped, smaller ones after it can be kept
+    """
+    budget = get_context_budget(llm_model, *texts)
+
+    kept = []
+    dropped = []
+    used = 0
+
+    for doc in docs:
+        n_tokens = _TOKEN_CACHE.get_doc_tokens(doc) + DOC_OVERHEAD_TOKENS
+
+        if used + n_tokens <= budget:
+            kept.append(doc)
+            used += n_tokens
+        else:
+            dropped.append(doc)
+
+    if dropped:
+        logger.info(
+            "Context for %s: kept %d docs (%d/%d tokens), dropped %d: %s",
+            llm_model,
+            len(kept),
+            used,
+            budget,
+            len(dropped),
+            [(doc.metadata.get("source"), doc.metadata.get("page")) for doc in dropped],
+        )
+
+    return kept, dropped
@@ -0,0 +1,42 @@
+"""
+create the text index for a collection
+
+The Oracle Text index is needed for hybrid search (keyword + vector).
+New collections get it when created, use this utility
+for collections created before.
+
+The table name must be in correct capitalization.
+"""
+
+import argparse
+import oracledb
+
+from oraclevs_4_rfx import OracleVS4RFX
+from utils import get_console_logger
+
+from config_private import DB_USER, DB_PWD, DB_HOST_IP, DB_SERVICE
+
+#
+# Main
+#
+logger = get_console_logger()
+
+# handling input
+parser = argparse.ArgumentParser(description="Utility to create the text index.")
+
+parser.add_argument("collection_name", type=str, help="Collection name.")
+
+args = parser.parse_args()
+
+dsn = f"{DB_HOST_IP}:1521/{DB_SERVICE}"
+
+connection = oracledb.connect(user=DB_USER, password=DB_PWD, dsn=dsn)
+
+logger.info("")
+
+try:
+    OracleVS4RFX.create_text_index(connection, args.collection_name)
+except oracledb.Error as e:
+    logger.error("Error creating the text index: %s", e)
+
+logger.info("")
@@ -0,0 +1,310 @@
+"""
+Deadlines and hedged requests
+
+* Deadline: the time budget of a question, split between the stages
+  (hyde, embed, search, rerank, llm); the time not used by a stage
+  is left to the following ones
+* run_with_timeout: runs a call with a budget; the budget is passed down
+  (see time_left) as HTTP timeout and limit for retries and backoff,
+  so the call ends in time and no thread is left running
+* hedged_call: if a call (embed, rerank) hasn't returned after the p95
+  of its observed latency, a duplicate is sent and the first reply is used;
+  only the latencies of calls that reached the service are observed
+  (see mark_service_call), not the ones answered by a cache
+"""
+
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from utils import get_console_logger
+
+from config import (
+    DEADLINE_SPLIT,
+    HEDGE_ENABLED,
+    HEDGE_PERCENTILE,
+    HEDGE_MIN_SAMPLES,
+    DEADLINE_MAX_WORKERS,
+)
+
+logger = get_console_logger()
+
+# num. of latencies kept for each kind of call
+LATENCY_WINDOW = 200
+
+# hedged calls run here
+_EXECUTOR = ThreadPoolExecutor(max_workers=DEADLINE_MAX_WORKERS)
+
+# the time (monotonic) by which the current call must end, None: no limit
+_TIME_LIMIT = contextvars.ContextVar("time_limit", default=None)
+
+# set by _timed_call, marked by the requests to the service
+_SERVICE_CALL = contextvars.ContextVar("service_call", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    the budget of a stage (or of the question) has been used
+    """
+
+
+class Deadline:
+    """
+    the time budget of a question
+    """
+
+    def __init__(self, total, split=None):
+        """
+        total: sec.
+        split: share of each stage (see DEADLINE_SPLIT), in order of execution
+        """
+        self.total = total
+        self.split = split or DEADLINE_SPLIT
+        self.start = time.monotonic()
+
+    def remaining(self):
+        return max(0.0, self.total - (time.monotonic() - self.start))
+
+    def stage_timeout(self, *stages):
+        """
+        the budget for the stages: their share of the time remaining,
+        in proportion to the shares of the stages still to be done
+        """
+        names = list(self.split)
+        first = min(names.index(stage) for stage in stages)
+
+        shares_left = sum(self.split[name] for name in names[first:])
+        share = sum(self.split[stage] for stage in stages)
+
+        return self.remaining() * share / shares_left
+
+    def check(self):
+        """
+        raise DeadlineExceeded if there is no time left
+        """
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.total} sec. exceeded")
+
+
+@contextmanager
+def time_limit(timeout):
+    """
+    the calls done in the block must end in timeout sec.
+    (or before, if an outer block has a shorter limit)
+    """
+    limit = time.monotonic() + timeout
+
+    outer_limit = _TIME_LIMIT.get()
+    if outer_limit is not None:
+        limit = min(limit, outer_limit)
+
+    token = _TIME_LIMIT.set(limit)
+
+    try:
+        yield
+    finally:
+        _TIME_LIMIT.reset(token)
+
+
+def time_left():
+    """
+    sec. left to the current call, None if there is no limit
+    """
+    limit = _TIME_LIMIT.get()
+
+    if limit is None:
+        return None
+
+    return max(0.0, limit - time.monotonic())
+
+
+def cap_timeout(timeout):
+    """
+    the HTTP timeout (connect, read) reduced to the time left
+
+    raise DeadlineExceeded if there is no time left
+    """
+    left = time_left()
+
+    if left is None:
+        return timeout
+
+    if left <= 0:
+        raise DeadlineExceeded("No time left for the request")
+
+    return tuple(min(value, left) for value in timeout)
+
+
+def run_with_timeout(stage, timeout, func, *args, **kwargs):
+    """
+    call func with a budget of timeout sec. (None: no timeout)
+
+    the call runs in this thread: OCI calls done by func get the
+    time left as HTTP timeout and don't retry after it
+    """
+    if timeout is None:
+        return func(*args, **kwargs)
+
+    if timeout <= 0:
+        raise DeadlineExceeded(f"No time left for stage {stage}")
+
+    try:
+        with time_limit(timeout):
+            return func(*args, **kwargs)
+    except DeadlineExceeded as e:
+        raise DeadlineExceeded(f"Stage {stage} exceeded {timeout:.1f} sec.") from e
+
+
+def _submit(func, *args, **kwargs):
+    """
+    run func in the executor, with the time limit of the caller
+    """
+    return _EXECUTOR.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+class LatencyTracker:
+    """
+    the latencies observed for a kind of call, thread safe
+    """
+
+    def __init__(self, max_items=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=max_items)
+        self.lock = threading.Lock()
+
+        self.n_hedged = 0
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def get_hedge_delay(self):
+        """
+        when to send the duplicate, None if too few observations
+        """
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+
+            return float(np.percentile(self.latencies, HEDGE_PERCENTILE))
+
+
+_TRACKERS = {}
+_TRACKERS_LOCK = threading.Lock()
+
+
+def get_latency_tracker(name):
+    """
+    the tracker for a kind of call (ex: embed, rerank)
+    """
+    with _TRACKERS_LOCK:
+        tracker = _TRACKERS.get(name)
+
+        if tracker is None:
+            tracker = LatencyTracker()
+            _TRACKERS[name] = tracker
+
+    return tracker
+
+
+def mark_service_call():
+    """
+    called before a request to the service: the latency of the call
+    is observed only if it reached the service (not if cached)
+    """
+    service_call = _SERVICE_CALL.get()
+
+    if service_call is not None:
+        service_call.set()
+
+
+def _timed_call(tracker, func, *args, **kwargs):
+    service_call = threading.Event()
+    token = _SERVICE_CALL.set(service_call)
+
+    start = time.monotonic()
+
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        _SERVICE_CALL.reset(token)
+
+    # a cache hit would lower the hedge delay
+    if service_call.is_set():
+        tracker.record(time.monotonic() - start)
+
+    return result
+
+
+def hedged_call(name, timeout, func, *args, **kwargs):
+    """
+    call func, with a duplicate if the first call is slower than the p95
+
+    name: the kind of call, to track latencies (ex: embed, rerank)
+    timeout: sec., None for no timeout
+    returns the first successful result
+    """
+    tracker = get_latency_tracker(name)
+    hedge_delay = tracker.get_hedge_delay() if HEDGE_ENABLED else None
+
+    if hedge_delay is None or (timeout is not None and hedge_delay >= timeout):
+        # no hedging: time the calls to learn the latency
+        return run_with_timeout(
+            name, timeout, _timed_call, tracker, func, *args, **kwargs
+        )
+
+    start = time.monotonic()
+
+    # the calls in the executor end, at most, with the timeout
+    with time_limit(timeout) if timeout is not None else nullcontext():
+        futures = [_submit(_timed_call, tracker, func, *args, **kwargs)]
+
+        done, _ = wait(futures, timeout=hedge_delay)
+
+        if not done:
+            with tracker.lock:
+                tracker.n_hedged += 1
+
+            logger.info("Hedging %s call after %.2f sec.", name, hedge_delay)
+
+            futures.append(_submit(_timed_call, tracker, func, *args, **kwargs))
+
+    pending = set(futures)
+    error = None
+
+    while pending:
+        left = None if timeout is None else timeout - (time.monotonic() - start)
+
+        if left is not None and left <= 0:
+            break
+
+        done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+
+            error = future.exception()
+
+    if error is not None and not pending:
+        # all the calls failed
+        raise error
+
+    raise DeadlineExceeded(f"Stage {name} exceeded {timeout:.1f} sec.")
+
+
+def get_hedging_stats():
+    """
+    num. of hedged calls and current hedge delay for each kind of call
+    """
+    with _TRACKERS_LOCK:
+        trackers = dict(_TRACKERS)
+
+    return {
+        name: {"hedged": tracker.n_hedged, "hedge_delay": tracker.get_hedge_delay()}
+        for name, tracker in trackers.items()
+    }
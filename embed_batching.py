@@ -0,0 +1,177 @@
+"""
+Adaptive batching for embeddings
+
+batches are packed by estimated tokens and payload bytes, up to
+EMBED_BATCH_SIZE texts, instead of a fixed num. of texts.
+
+The num. of tokens per batch is learned from the observed latency:
+it goes toward the size that takes EMBED_TARGET_LATENCY sec.
+A batch rejected as too large (413, or 400 for a size limit) is split
+in two and retried; the limit for the following batches is reduced
+and grows back after RECOVERY_BATCHES batches accepted.
+"""
+
+import re
+import threading
+
+import oci
+
+from context_builder import count_tokens
+from utils import get_console_logger
+
+from config import (
+    EMBED_BATCH_SIZE,
+    EMBED_MAX_BATCH_TOKENS,
+    EMBED_MAX_BATCH_BYTES,
+    EMBED_TARGET_LATENCY,
+)
+
+logger = get_console_logger()
+
+# weight of the last observation in the rolling average
+EWMA_ALPHA = 0.2
+# the learned target is never below this fraction of the max
+MIN_TARGET_FRACTION = 0.1
+# for each text: quotes and separator in the JSON payload
+TEXT_OVERHEAD_BYTES = 4
+# after these batches accepted, the max (reduced on rejection) is doubled
+RECOVERY_BATCHES = 20
+# a 400 for the size of the request (others are errors of the caller)
+SIZE_ERROR_PATTERN = re.compile(
+    r"too (large|long|many)|exceed|max(imum)?[ _](number|size|tokens|inputs)",
+    re.IGNORECASE,
+)
+
+
+def is_batch_too_large(e):
+    """
+    the service rejected the request for its size
+    """
+    if not isinstance(e, oci.exceptions.ServiceError):
+        return False
+
+    if e.status == 413:
+        return True
+
+    return e.status == 400 and bool(SIZE_ERROR_PATTERN.search(f"{e.code} {e.message}"))
+
+
+class BatchSizer:
+    """
+    decides the size of the batches for a model, thread safe
+    """
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        # reduced when the service rejects a batch
+        self.max_tokens = EMBED_MAX_BATCH_TOKENS
+        self.target_tokens = EMBED_MAX_BATCH_TOKENS
+        # None: no observations
+        self.sec_per_token = None
+        # batches accepted since the last rejection
+        self.n_accepted = 0
+        self.lock = threading.Lock()
+
+    def next_batch_end(self, texts, start, n_tokens):
+        """
+        the end (excluded) of the batch starting at start
+
+        n_tokens: the estimated tokens of each text
+        a batch has always at least one text
+        """
+        with self.lock:
+            max_tokens = min(self.target_tokens, self.max_tokens)
+
+        end = start
+        batch_tokens = 0
+        batch_bytes = 0
+
+        while end < len(texts) and end - start < EMBED_BATCH_SIZE:
+            text_bytes = len(texts[end].encode("utf-8")) + TEXT_OVERHEAD_BYTES
+
+            if end > start and (
+                batch_tokens + n_tokens[end] > max_tokens
+                or batch_bytes + text_bytes > EMBED_MAX_BATCH_BYTES
+            ):
+                break
+
+            batch_tokens += n_tokens[end]
+            batch_bytes += text_bytes
+            end += 1
+
+        return end
+
+    def record(self, n_tokens, latency):
+        """
+        a batch of n_tokens took latency sec., update the target
+        """
+        with self.lock:
+            sec_per_token = latency / max(n_tokens, 1)
+
+            if self.sec_per_token is None:
+                self.sec_per_token = sec_per_token
+            else:
+                self.sec_per_token += EWMA_ALPHA * (sec_per_token - self.sec_per_token)
+
+            self.n_accepted += 1
+
+            if (
+                self.n_accepted >= RECOVERY_BATCHES
+                and self.max_tokens < EMBED_MAX_BATCH_TOKENS
+            ):
+                self.max_tokens = min(EMBED_MAX_BATCH_TOKENS, 2 * self.max_tokens)
+                self.n_accepted = 0
+
+            target = int(EMBED_TARGET_LATENCY / self.sec_per_token)
+
+            self.target_tokens = max(
+                int(MIN_TARGET_FRACTION * self.max_tokens),
+                min(target, self.max_tokens),
+            )
+
+    def record_too_large(self, n_tokens):
+        """
+        a batch of n_tokens has been rejected
+        """
+        with self.lock:
+            self.max_tokens = max(1, min(self.max_tokens, n_tokens // 2))
+            self.n_accepted = 0
+
+            logger.warning(
+                "Embedding batch of %d tokens too large for %s, max now %d",
+                n_tokens,
+                self.model_id,
+                self.max_tokens,
+            )
+
+    def get_stats(self):
+        """
+        current target and max (tokens per batch)
+        """
+        with self.lock:
+            return {"target_tokens": self.target_tokens, "max_tokens": self.max_tokens}
+
+
+_SIZERS = {}
+_SIZERS_LOCK = threading.Lock()
+
+
+def get_batch_sizer(model_id):
+    """
+    the sizer for the model, shared in the process
+    """
+    with _SIZERS_LOCK:
+        sizer = _SIZERS.get(model_id)
+
+        if sizer is None:
+            sizer = BatchSizer(model_id)
+            _SIZERS[model_id] = sizer
+
+    return sizer
+
+
+def estimate_tokens(texts):
+    """
+    the estimated tokens of each text
+    """
+    return [count_tokens(text) for text in texts]
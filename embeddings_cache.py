@@ -0,0 +1,327 @@
+"""
+Cache for embeddings
+
+Wraps an Embeddings model (OCIGenAIEmbeddingsWithBatch) so that
+texts already embedded are not sent again to the service.
+
+Two tiers:
+* in memory LRU
+* on disk, in SQLite (survives restarts), bounded in size
+
+key: hash of model id + input type + text
+
+With record/replay (see llm_replay_cache) the cache is also the store of
+the recorded embeddings: in replay mode a text not in cache raises
+ReplayMissError, instead of calling the service.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from llm_replay_cache import get_replay_mode, ReplayMissError
+from utils import get_console_logger
+
+from config import (
+    EMBED_CACHE_PATH,
+    EMBED_CACHE_MEMORY_SIZE,
+    EMBED_CACHE_DISK_SIZE,
+)
+
+logger = get_console_logger()
+
+# input types, as in Cohere embed v3
+SEARCH_DOCUMENT = "search_document"
+SEARCH_QUERY = "search_query"
+
+# eviction on disk is checked every N inserts
+EVICTION_CHECK_INTERVAL = 1000
+
+
+def make_cache_key(model_id, input_type, text):
+    """
+    the key used in both tiers
+    """
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    return f"{model_id}:{input_type}:{text_hash}"
+
+
+class EmbeddingsCache:
+    """
+    the two tiers store, thread safe
+    """
+
+    def __init__(
+        self,
+        path=EMBED_CACHE_PATH,
+        max_memory_items=EMBED_CACHE_MEMORY_SIZE,
+        max_disk_items=EMBED_CACHE_DISK_SIZE,
+    ):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.n_inserts = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)"
+        )
+        self.conn.commit()
+
+    def _put_in_memory(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+
+        if len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys) -> dict:
+        """
+        return a dict key -> vector for the keys found
+        """
+        found = {}
+        to_search_on_disk = []
+
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                    self.hits_memory += 1
+                else:
+                    to_search_on_disk.append(key)
+
+            # sqlite has a limit on the num. of parameters
+            for i in range(0, len(to_search_on_disk), 500):
+                batch = to_search_on_disk[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                    found[key] = vector
+                    self._put_in_memory(key, vector)
+                    self.hits_disk += 1
+
+                if rows:
+                    now = time.time()
+                    self.conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows],
+                    )
+                    self.conn.commit()
+
+            self.misses += len(set(keys) - set(found.keys()))
+
+        return found
+
+    def put_many(self, items: dict):
+        """
+        items: dict key -> vector
+        """
+        now = time.time()
+
+        with self.lock:
+            for key, vector in items.items():
+                self._put_in_memory(key, vector)
+
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for key, vector in items.items()
+                ],
+            )
+            self.conn.commit()
+
+            self.n_inserts += len(items)
+
+            if self.n_inserts >= EVICTION_CHECK_INTERVAL:
+                self.n_inserts = 0
+                self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        """
+        keep on disk at most max_disk_items, removing the least recently used
+        """
+        (n_items,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+
+        if n_items > self.max_disk_items:
+            self.conn.execute(
+                """
+                DELETE FROM embeddings WHERE key IN (
+                    SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?
+                )
+                """,
+                (n_items - self.max_disk_items,),
+            )
+            self.conn.commit()
+
+            logger.info(
+                "Embeddings cache: evicted %s items", n_items - self.max_disk_items
+            )
+
+    def get_stats(self) -> dict:
+        """
+        hit/miss counters
+        """
+        with self.lock:
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "memory_items": len(self.memory),
+            }
+
+    def clear(self):
+        """
+        empty both tiers
+        """
+        with self.lock:
+            self.memory.clear()
+            self.conn.execute("DELETE FROM embeddings")
+            self.conn.commit()
+
+
+# one store for each path, shared by all the wrappers
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_embeddings_cache(path=EMBED_CACHE_PATH) -> EmbeddingsCache:
+    """
+    return the (shared) cache stored in path
+    """
+    with _CACHES_LOCK:
+        if path not in _CACHES:
+            _CACHES[path] = EmbeddingsCache(path)
+
+        return _CACHES[path]
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings with cache
+
+    Usage:
+        embed_model = CachedEmbeddings(OCIGenAIEmbeddingsWithBatch(...), model_id)
+    """
+
+    def __init__(self, embed_model: Embeddings, model_id: str, cache=None):
+        self.embed_model = embed_model
+        self.model_id = model_id
+        self.cache = cache if cache is not None else get_embeddings_cache()
+
+    def _lookup(self, texts, input_type):
+        """
+        returns the keys, the vectors found and the distinct texts to embed
+        """
+        keys = [make_cache_key(self.model_id, input_type, text) for text in texts]
+
+        found = self.cache.get_many(keys)
+
+        # dict to remove duplicates, keeping the order
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing[key] = text
+
+        if missing and get_replay_mode() == "replay":
+            raise ReplayMissError(
+                f"No recorded embeddings for {len(missing)} texts ({input_type})"
+            )
+
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._lookup(texts, SEARCH_DOCUMENT)
+
+        if missing:
+            vectors = self.embed_model.embed_documents(list(missing.values()))
+
+            new_items = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, found, missing = self._lookup([text], SEARCH_QUERY)
+
+        if missing:
+            vector = self.embed_model.embed_query(text)
+
+            self.cache.put_many({keys[0]: vector})
+            found[keys[0]] = vector
+
+        return found[keys[0]]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        embed many queries with batched requests
+        (cached as queries, so they're found by embed_query)
+        """
+        keys, found, missing = self._lookup(texts, SEARCH_QUERY)
+
+        if missing:
+            vectors = self.embed_model.embed_documents(list(missing.values()))
+
+            new_items = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._lookup(texts, SEARCH_DOCUMENT)
+
+        if missing:
+            vectors = await self.embed_model.aembed_documents(list(missing.values()))
+
+            new_items = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items)
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, found, missing = self._lookup([text], SEARCH_QUERY)
+
+        if missing:
+            vector = await self.embed_model.aembed_query(text)
+
+            self.cache.put_many({keys[0]: vector})
+            found[keys[0]] = vector
+
+        return found[keys[0]]
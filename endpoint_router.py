@@ -0,0 +1,185 @@
+"""
+Latency aware routing between OCI GenAI endpoints
+
+a model can be served from more endpoints (ex: more regions),
+configured in MODEL_ENDPOINTS. For each endpoint we track
+the rolling (EWMA) latency and error rate; each request goes to the
+fastest healthy endpoint. After an error an endpoint is avoided for
+a few sec. (ROUTER_COOLDOWN sec. if its error rate is high), so retries
+fail over to the others.
+"""
+
+import random
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+from oci_throttling import is_retriable
+from utils import get_console_logger
+
+from config import (
+    MODEL_ENDPOINTS,
+    ROUTER_MAX_ERROR_RATE,
+    ROUTER_COOLDOWN,
+    ROUTER_EXPLORE_RATE,
+)
+
+logger = get_console_logger()
+
+# weight of the last observation in the rolling averages
+EWMA_ALPHA = 0.2
+# the latency is increased by this factor times the error rate
+ERROR_PENALTY = 4.0
+# after an error the endpoint is avoided at least for this time (sec.),
+# so the retry goes to another endpoint
+FAILOVER_TIME = 5.0
+
+
+class EndpointStats:
+    """
+    rolling stats of an endpoint
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        # None: never called
+        self.latency = None
+        self.error_rate = 0.0
+        self.last_failure = -float("inf")
+        self.n_calls = 0
+
+    def record(self, latency, is_ok):
+        if is_ok:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += EWMA_ALPHA * (latency - self.latency)
+
+        self.error_rate += EWMA_ALPHA * ((0.0 if is_ok else 1.0) - self.error_rate)
+        self.n_calls += 1
+
+        if not is_ok:
+            self.last_failure = time.monotonic()
+
+    def is_healthy(self):
+        """
+        not healthy just after an error or, if too many errors,
+        until the cooldown has expired
+        """
+        since_failure = time.monotonic() - self.last_failure
+
+        if self.error_rate > ROUTER_MAX_ERROR_RATE:
+            return since_failure > ROUTER_COOLDOWN
+
+        return since_failure > FAILOVER_TIME
+
+    def get_score(self, default_latency):
+        """
+        lower is better
+
+        default_latency: for an endpoint without successful calls
+            (never called or only failed), with the penalty for its errors
+        """
+        latency = self.latency if self.latency is not None else default_latency
+
+        return latency * (1.0 + ERROR_PENALTY * self.error_rate)
+
+
+class EndpointRouter:
+    """
+    chooses the endpoint for the requests to a model, thread safe
+    """
+
+    def __init__(self, model_id, endpoints):
+        self.model_id = model_id
+        self.stats = {endpoint: EndpointStats(endpoint) for endpoint in endpoints}
+        self.lock = threading.Lock()
+
+    def choose(self):
+        """
+        the fastest healthy endpoint (the fastest one, if none is healthy)
+        """
+        with self.lock:
+            stats = list(self.stats.values())
+
+            healthy = [s for s in stats if s.is_healthy()] or stats
+
+            if len(healthy) > 1 and random.random() < ROUTER_EXPLORE_RATE:
+                # to refresh the stats of the others
+                return random.choice(healthy).endpoint
+
+            # the median of the known latencies (if none, only errors count)
+            latencies = [s.latency for s in stats if s.latency is not None]
+            default_latency = statistics.median(latencies) if latencies else 1.0
+
+            return min(healthy, key=lambda s: s.get_score(default_latency)).endpoint
+
+    def record(self, endpoint, latency, is_ok):
+        with self.lock:
+            stats = self.stats[endpoint]
+            was_healthy = stats.is_healthy()
+
+            stats.record(latency, is_ok)
+
+            if was_healthy and not stats.is_healthy():
+                logger.warning(
+                    "Router: endpoint %s unhealthy for %s (error rate %.2f)",
+                    endpoint,
+                    self.model_id,
+                    stats.error_rate,
+                )
+
+    @contextmanager
+    def track(self, endpoint):
+        """
+        record latency and outcome of the call done in the with block
+        """
+        start = time.monotonic()
+
+        try:
+            yield
+        except Exception as e:
+            # a bad request is not a problem of the endpoint
+            if is_retriable(e):
+                self.record(endpoint, time.monotonic() - start, is_ok=False)
+            raise
+
+        self.record(endpoint, time.monotonic() - start, is_ok=True)
+
+    def get_stats(self):
+        """
+        latency (sec.), error rate and num. of calls for each endpoint
+        """
+        with self.lock:
+            return {
+                s.endpoint: {
+                    "latency": s.latency,
+                    "error_rate": s.error_rate,
+                    "calls": s.n_calls,
+                }
+                for s in self.stats.values()
+            }
+
+
+_ROUTERS = {}
+_ROUTERS_LOCK = threading.Lock()
+
+
+def get_router(model_id):
+    """
+    the router for the model, None if the model has a single endpoint
+    """
+    endpoints = MODEL_ENDPOINTS.get(model_id)
+
+    if not endpoints or len(endpoints) < 2:
+        return None
+
+    with _ROUTERS_LOCK:
+        router = _ROUTERS.get(model_id)
+
+        if router is None:
+            router = EndpointRouter(model_id, endpoints)
+            _ROUTERS[model_id] = router
+
+    return router
@@ -1,17 +1,40 @@
 """
 Factory methods implementation based on OCI Cohere
 * supports classi RAG, HyDE
+* RAG pipelines are kept in a registry and reused across questions
 """
 
-from langchain_cohere import CohereRerank
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from langchain.retrievers import ContextualCompressionRetriever
-from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_community.chat_models.oci_generative_ai import ChatOCIGenAI
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 
 from oci_cohere_embeddings_utils import OCIGenAIEmbeddingsWithBatch
+from embeddings_cache import CachedEmbeddings
+from llm_replay_cache import get_replay_mode
 from oci_command_r_oo import OCICommandR
-from factory_vector_store import get_vector_store
+from oci_chat_utils import get_generative_ai_dp_client
+from oci_llama3_oo_lc import OCILlama3
+from cohere_rerank_utils import CohereRerankAsync
+from factory_vector_store import (
+    get_vector_store,
+    get_collection_version,
+    submit_keyword_search,
+)
+from hybrid_retriever import HybridRetriever
+from opensearch_4_rfx import OpenSearchRFX
+from answer_cache import (
+    get_answer_cache,
+    make_scope,
+    serialize_response,
+    deserialize_response,
+)
 from oci_citations_utils import extract_complete_citations, extract_document_list
+from rank_fusion import reciprocal_rank_fusion
+from context_builder import fit_docs_to_budget
+from deadlines import Deadline, run_with_timeout, hedged_call
 from utils import get_console_logger, check_value_in_list
 
 from preamble_libraries import preamble_dict
@@ -19,6 +42,7 @@ from preamble_libraries import preamble_dict
 from config import (
     EMBED_MODEL_TYPE,
     OCI_EMBED_MODEL,
+    EMBED_CACHE_ENABLED,
     VECTOR_STORE_TYPE,
     ENDPOINT,
     TEMPERATURE,
@@ -26,11 +50,23 @@ from config import (
     MAX_TOKENS,
     TOP_K,
     TOP_N,
+    MAX_CONCURRENT_QUESTIONS,
+    MAX_ASYNC_QUESTIONS,
+    ANSWER_CACHE_ENABLED,
+    HYDE_MODE,
+    HYDE_TIMEOUT,
 )
 from config_private import COMPARTMENT_ID, COHERE_API_KEY
 
 logger = get_console_logger()
 
+# for the searches done in parallel with the generation of the hyde doc
+# (keyword searches run in the executor in factory_vector_store)
+_HYDE_EXECUTOR = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_QUESTIONS)
+
+# async pools being closed in a running event loop (see close_async_pool)
+_CLOSING_TASKS = set()
+
 
 def format_docs_for_cohere(l_docs):
     """ "
@@ -66,8 +102,17 @@ def get_embed_model(model_type="OCI"):
             model_id=OCI_EMBED_MODEL,
             service_endpoint=ENDPOINT,
             compartment_id=COMPARTMENT_ID,
+            # the shared client, with its connection pool
+            client=get_generative_ai_dp_client(
+                ENDPOINT, "DEFAULT", use_session_token=False
+            ),
         )
 
+        if EMBED_CACHE_ENABLED or get_replay_mode() != "passthrough":
+            # known texts are not sent again to the service
+            # (with record/replay it stores the recorded embeddings)
+            embed_model = CachedEmbeddings(embed_model, OCI_EMBED_MODEL)
+
     return embed_model
 
 
@@ -88,7 +133,12 @@ def get_task_step1(query):
 def get_text_from_response(response, llm_model):
     """
     extract text from OCI response
+
+    response can be the error of a failed question (see answer_questions)
     """
+    if isinstance(response, Exception):
+        return f"Error: {repr(response)}"
+
     if llm_model.startswith("cohere"):
         return response.data.chat_response.text
 
@@ -129,16 +179,18 @@ def get_llm(llm_model, temperature=TEMPERATURE):
             compartment_id=COMPARTMENT_ID,
             max_tokens=MAX_TOKENS,
             temperature=temperature,
+            # streaming is chosen for each call (see call_llm_for_answer)
             is_streaming=False,
         )
     elif llm_model.startswith("meta"):
-        # Llama3
-        chat = ChatOCIGenAI(
-            model_id=llm_model,
+        # Llama3, our client has native async support
+        chat = OCILlama3(
+            model=llm_model,
             service_endpoint=ENDPOINT,
             compartment_id=COMPARTMENT_ID,
-            is_stream=False,
-            model_kwargs={"temperature": temperature, "max_tokens": MAX_TOKENS},
+            max_tokens=MAX_TOKENS,
+            temperature=temperature,
+            is_streaming=False,
         )
     return chat
 
@@ -147,23 +199,36 @@ def get_llm(llm_model, temperature=TEMPERATURE):
 # This has been modified to support selection over
 # multiple collections
 #
-def get_retriever(add_reranker=False, selected_collection="ORACLE_KNOWLEDGE"):
+def get_retriever(
+    add_reranker=False,
+    selected_collection="ORACLE_KNOWLEDGE",
+    v_store=None,
+    hybrid_search=False,
+):
     """
     selected_collection: the name of the Oracle table in OracleVS
     or index in OpenSearch
+    v_store: an already created Vector Store, if None it is created here
+    hybrid_search: if True, vector and keyword search are combined
     """
-    embed_model = get_embed_model(EMBED_MODEL_TYPE)
+    if v_store is None:
+        embed_model = get_embed_model(EMBED_MODEL_TYPE)
 
-    v_store = get_vector_store(
-        vector_store_type=VECTOR_STORE_TYPE,
-        embed_model=embed_model,
-        selected_collection=selected_collection,
-    )
+        v_store = get_vector_store(
+            vector_store_type=VECTOR_STORE_TYPE,
+            embed_model=embed_model,
+            selected_collection=selected_collection,
+        )
 
     base_retriever = v_store.as_retriever(k=TOP_K)
 
+    if hybrid_search:
+        base_retriever = HybridRetriever(
+            vector_retriever=base_retriever, v_store=v_store, k=TOP_K
+        )
+
     if add_reranker:
-        compressor = CohereRerank(
+        compressor = CohereRerankAsync(
             cohere_api_key=COHERE_API_KEY, top_n=TOP_N, model=COHERE_RERANKER_MODEL
         )
 
@@ -176,6 +241,549 @@ def get_retriever(add_reranker=False, selected_collection="ORACLE_KNOWLEDGE"):
     return retriever
 
 
+def close_async_pool(async_pool, loop):
+    """
+    close an oracledb async pool in its event loop
+    from the running loop (ex: after aanswer_questions) the close is scheduled
+    """
+    if loop.is_closed():
+        # the connections have been closed with the loop
+        return
+
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+
+    if loop is running_loop:
+        task = loop.create_task(async_pool.close(force=True))
+        # keep a reference until done
+        _CLOSING_TASKS.add(task)
+        task.add_done_callback(_CLOSING_TASKS.discard)
+    elif loop.is_running():
+        # running in another thread
+        asyncio.run_coroutine_threadsafe(async_pool.close(force=True), loop)
+    else:
+        loop.run_until_complete(async_pool.close(force=True))
+
+
+class RAGPipeline:
+    """
+    Holds the long-lived objects used to answer questions on a collection:
+    embed model, vector store (with its connection), retriever and llm.
+
+    Build it once and reuse it for all the questions, then close it.
+    """
+
+    def __init__(
+        self,
+        selected_collection,
+        add_reranker=False,
+        llm_model="cohere.command-r-plus",
+        temperature=TEMPERATURE,
+        hybrid_search=False,
+    ):
+        self.selected_collection = selected_collection
+        self.add_reranker = add_reranker
+        self.llm_model = llm_model
+        self.temperature = temperature
+        self.hybrid_search = hybrid_search
+
+        self.embed_model = get_embed_model(EMBED_MODEL_TYPE)
+
+        self.v_store = get_vector_store(
+            vector_store_type=VECTOR_STORE_TYPE,
+            embed_model=self.embed_model,
+            selected_collection=selected_collection,
+        )
+
+        self.retriever = get_retriever(
+            add_reranker,
+            selected_collection,
+            v_store=self.v_store,
+            hybrid_search=hybrid_search,
+        )
+
+        self.chat = get_llm(llm_model, temperature)
+
+        # to invalidate cached answers if the collection changes
+        self.collection_version = None
+        self.refresh_collection_version()
+
+    def refresh_collection_version(self):
+        """
+        read again the version of the collection (used in the answer cache scope)
+
+        called for each batch of questions: documents can be added
+        or removed (also by other processes) while the pipeline lives
+        """
+        if ANSWER_CACHE_ENABLED:
+            self.collection_version = get_collection_version(
+                VECTOR_STORE_TYPE, self.v_store, self.selected_collection
+            )
+
+    def retrieve(self, query, deadline=None, embedding=None):
+        """
+        retrieval for a question: embed, search and rerank,
+        the same done by self.retriever, but with deadlines and hedging
+
+        deadline: a Deadline, each stage gets its share (None: no limits)
+        embedding: the embedding of the query, if already computed
+        """
+
+        def get_timeout(stage):
+            return None if deadline is None else deadline.stage_timeout(stage)
+
+        if embedding is None:
+            embedding = hedged_call(
+                "embed", get_timeout("embed"), self.embed_model.embed_query, query
+            )
+
+        docs = run_with_timeout(
+            "search", get_timeout("search"), self._search, query, embedding
+        )
+
+        if self.add_reranker:
+            compressor = self.retriever.base_compressor
+
+            docs = hedged_call(
+                "rerank",
+                get_timeout("rerank"),
+                compressor.compress_documents,
+                docs,
+                query,
+            )
+
+        return docs
+
+    def _search(self, query, embedding):
+        """
+        vector search (and keyword search, if hybrid)
+        """
+        if not self.hybrid_search:
+            return self.v_store.similarity_search_by_vector(embedding, k=TOP_K)
+
+        keyword_future = submit_keyword_search(
+            VECTOR_STORE_TYPE, self.v_store, query, TOP_K
+        )
+
+        docs = self.v_store.similarity_search_by_vector(embedding, k=TOP_K)
+
+        return reciprocal_rank_fusion([docs, keyword_future.result()], top_n=TOP_K)
+
+    def embed_queries(self, queries):
+        """
+        the embeddings of many questions, in batches (see embed_batching)
+        """
+        embed_queries = getattr(
+            self.embed_model, "embed_queries", self.embed_model.embed_documents
+        )
+
+        return embed_queries(queries)
+
+    def batch_retrieve(self, queries, embeddings=None):
+        """
+        retrieval for many questions, with batched embeddings and searches
+
+        embeddings: the embeddings of the queries, if already computed
+        returns a list of docs for each query (reranked, if needed)
+        """
+        if embeddings is None:
+            embeddings = self.embed_queries(queries)
+
+        if VECTOR_STORE_TYPE == "OPENSEARCH":
+            list_docs = OpenSearchRFX.msearch_by_vectors(
+                self.v_store, embeddings, TOP_K
+            )
+        else:
+            list_docs = self.v_store.similarity_search_by_vector_batch(
+                embeddings, TOP_K
+            )
+
+        if self.hybrid_search:
+            # keyword searches are done in parallel
+            keyword_futures = [
+                submit_keyword_search(VECTOR_STORE_TYPE, self.v_store, query, TOP_K)
+                for query in queries
+            ]
+
+            list_docs = [
+                reciprocal_rank_fusion([docs, future.result()], top_n=TOP_K)
+                for docs, future in zip(list_docs, keyword_futures)
+            ]
+
+        if self.add_reranker:
+            compressor = self.retriever.base_compressor
+
+            list_docs = compressor.rerank_many(queries, list_docs)
+
+        return list_docs
+
+    def get_answer_scope(self, lang):
+        """
+        the scope in the answer cache
+        """
+        return make_scope(
+            self.selected_collection,
+            self.collection_version,
+            self.llm_model,
+            lang,
+            preamble_dict[f"preamble_{lang}"],
+        )
+
+    def close(self):
+        """
+        release the connections used by the vector store
+        """
+        client = getattr(self.v_store, "client", None)
+
+        if client is not None and hasattr(client, "close"):
+            try:
+                client.close()
+            except Exception as e:
+                logger.error("Error closing pipeline connection: %s", e)
+
+        for pool_name in ("search_pool", "keyword_pool"):
+            pool = getattr(self.v_store, pool_name, None)
+
+            if pool is not None:
+                try:
+                    pool.close(force=True)
+                except Exception as e:
+                    logger.error("Error closing pipeline %s: %s", pool_name, e)
+
+        async_pools = getattr(self.v_store, "async_pools", None) or {}
+
+        for loop, async_pool in list(async_pools.items()):
+            try:
+                close_async_pool(async_pool, loop)
+            except Exception as e:
+                logger.error("Error closing pipeline async pool: %s", e)
+
+        self.v_store = None
+        self.retriever = None
+        self.chat = None
+
+
+# the pipelines, keyed by (collection, reranker, model, temperature, hybrid)
+# living at module level they survive Streamlit reruns
+_PIPELINES = {}
+_PIPELINES_LOCK = threading.Lock()
+
+
+def get_rag_pipeline(
+    selected_collection,
+    add_reranker=False,
+    llm_model="cohere.command-r-plus",
+    temperature=TEMPERATURE,
+    hybrid_search=False,
+):
+    """
+    return the pipeline for the given params, creating it only the first time
+    """
+    key = (selected_collection, add_reranker, llm_model, temperature, hybrid_search)
+
+    with _PIPELINES_LOCK:
+        pipeline = _PIPELINES.get(key)
+
+        if pipeline is None:
+            logger.info("Creating RAG pipeline for %s...", key)
+
+            pipeline = RAGPipeline(
+                selected_collection,
+                add_reranker,
+                llm_model,
+                temperature,
+                hybrid_search,
+            )
+            _PIPELINES[key] = pipeline
+
+    return pipeline
+
+
+def refresh_rag_pipeline(
+    selected_collection,
+    add_reranker=False,
+    llm_model="cohere.command-r-plus",
+    temperature=TEMPERATURE,
+    hybrid_search=False,
+):
+    """
+    close the pipeline for the given params (if any) and create a new one
+    """
+    key = (selected_collection, add_reranker, llm_model, temperature, hybrid_search)
+
+    with _PIPELINES_LOCK:
+        pipeline = _PIPELINES.pop(key, None)
+
+    if pipeline is not None:
+        pipeline.close()
+
+    return get_rag_pipeline(
+        selected_collection, add_reranker, llm_model, temperature, hybrid_search
+    )
+
+
+def close_rag_pipelines():
+    """
+    close all the pipelines in the registry
+    """
+    with _PIPELINES_LOCK:
+        pipelines = list(_PIPELINES.values())
+        _PIPELINES.clear()
+
+    for pipeline in pipelines:
+        pipeline.close()
+
+    logger.info("Closed %s RAG pipelines...", len(pipelines))
+
+
+def build_llm_input(llm_model, query, docs, lang):
+    """
+    the input for the final call to the llm: the kwargs of the Cohere
+    native interface or, for the other models, the list of messages
+
+    docs are packed in the context window of the model
+    """
+    preamble = preamble_dict[f"preamble_{lang}"]
+
+    docs, _ = fit_docs_to_budget(docs, llm_model, preamble, query)
+
+    if llm_model.startswith("cohere"):
+        # choose the preamble based on target language
+        return {
+            "query": query,
+            "chat_history": [],
+            "documents": format_docs_for_cohere(docs),
+            "preamble_override": preamble,
+        }
+
+    # meta
+    context = (
+        "Use the following context: \n"
+        + "\n".join(doc.page_content for doc in docs)
+        + "\n"
+    )
+
+    return [
+        SystemMessage(content=preamble),
+        SystemMessage(content=context),
+        HumanMessage(content=query),
+    ]
+
+
+def _check_deadline_before(callback, deadline):
+    """
+    callback, but raising DeadlineExceeded if the time is over
+    """
+    if callback is None:
+        return None
+
+    def checked_callback(*args):
+        deadline.check()
+        callback(*args)
+
+    return checked_callback
+
+
+def call_llm_for_answer(
+    chat, llm_model, query, docs, lang, on_token=None, deadline=None, on_event=None
+):
+    """
+    the final call to the llm, with the retrieved docs as context
+
+    on_token: if given the answer is streamed and on_token is called
+        with each piece of text; the complete response is returned anyway
+    deadline: if given, the call gets the time left; when streaming
+        (on_token must be called by this thread) the stream is stopped
+        when the time is over
+    on_event: only for Cohere, if given the answer is streamed and on_event
+        is called with each event (text, citations, documents),
+        see CitationRenderer
+    """
+    is_streaming = on_token is not None or on_event is not None
+
+    if deadline is not None:
+        if not is_streaming:
+            return run_with_timeout(
+                "llm",
+                deadline.stage_timeout("llm"),
+                call_llm_for_answer,
+                chat,
+                llm_model,
+                query,
+                docs,
+                lang,
+            )
+
+        on_token = _check_deadline_before(on_token, deadline)
+        on_event = _check_deadline_before(on_event, deadline)
+
+    llm_input = build_llm_input(llm_model, query, docs, lang)
+
+    if llm_model.startswith("cohere"):
+        # using Cohere native interface for citations
+        if not is_streaming:
+            return chat.invoke(**llm_input)
+
+        return chat.invoke_stream(**llm_input, on_token=on_token, on_event=on_event)
+
+    # meta
+    messages = llm_input
+
+    if on_token is None:
+        return chat.invoke(messages)
+
+    texts = []
+    for chunk in chat.stream(messages):
+        if chunk.content:
+            texts.append(chunk.content)
+            on_token(chunk.content)
+
+    return AIMessage(content="".join(texts))
+
+
+def stream_cached_answer(response, llm_model, on_token=None, on_event=None):
+    """
+    give a cached answer to the streaming callbacks, in one piece
+    """
+    if on_token is not None:
+        on_token(get_text_from_response(response, llm_model))
+
+    if on_event is not None and llm_model.startswith("cohere"):
+        chat_response = response.data.chat_response
+
+        # as the events of the stream
+        on_event(
+            {
+                "text": chat_response.text,
+                "citations": [
+                    {
+                        "start": citation.start,
+                        "end": citation.end,
+                        "text": citation.text,
+                        "documentIds": citation.document_ids,
+                    }
+                    for citation in (chat_response.citations or [])
+                ],
+                "documents": chat_response.documents or [],
+            }
+        )
+
+
+def embed_question(pipeline, query, deadline=None):
+    """
+    the embedding of the question (hedged, in the budget of the embed stage)
+    """
+    timeout = None if deadline is None else deadline.stage_timeout("embed")
+
+    return hedged_call("embed", timeout, pipeline.embed_model.embed_query, query)
+
+
+def get_cached_answer(pipeline, query, query_embedding, lang):
+    """
+    return the cached answer for a similar question, or None
+    """
+    payload, similarity = get_answer_cache().lookup(
+        pipeline.get_answer_scope(lang), query_embedding
+    )
+
+    if payload is None:
+        return None
+
+    logger.info("Using cached answer (similarity: %.3f)...", similarity)
+
+    return deserialize_response(payload, pipeline.llm_model)
+
+
+def save_answer(pipeline, query, query_embedding, lang, response):
+    """
+    save the answer in the cache
+    """
+    # don't cache failed calls
+    if response is not None:
+        get_answer_cache().save(
+            pipeline.selected_collection,
+            pipeline.get_answer_scope(lang),
+            query,
+            query_embedding,
+            serialize_response(response, pipeline.llm_model),
+        )
+
+
+def generate_hyde_doc(chat, query, llm_model, deadline=None):
+    """
+    Hyde step1: ask to the llm to answer to the query
+    creating an hypothetical document
+    """
+    # formulate the task
+    task = get_task_step1(query)
+
+    timeout = None if deadline is None else deadline.stage_timeout("hyde")
+
+    if llm_model.startswith("cohere"):
+        # the chat is shared: the preamble is never set on it
+        # get the hyde doc (no preamble)
+        response1 = run_with_timeout(
+            "hyde", timeout, chat.invoke, query=task, chat_history=[], documents=[]
+        )
+    else:
+        # meta
+        response1 = run_with_timeout("hyde", timeout, chat.invoke, [HumanMessage(task)])
+
+    # this is the hypotethical doc produced by step1
+    return get_text_from_response(response1, llm_model)
+
+
+def retrieve_hyde_docs(
+    pipeline, query, hyde_mode=HYDE_MODE, deadline=None, embedding=None
+):
+    """
+    the retrieval for HyDE
+
+    hyde_mode:
+        sequential: generate the hyde doc, then search with it
+        fused: the search with the query starts immediately, while the hyde doc
+            is generated; results are merged with RRF. If the hyde step fails
+            or takes more than HYDE_TIMEOUT only the results for the query are used
+    deadline, embedding: see RAGPipeline.retrieve
+    """
+    check_value_in_list(hyde_mode, ["sequential", "fused"])
+
+    if hyde_mode == "sequential":
+        hyde_doc = generate_hyde_doc(pipeline.chat, query, pipeline.llm_model, deadline)
+
+        # do the semantic search searching for docs similar to hyde_doc
+        return pipeline.retrieve(hyde_doc, deadline)
+
+    # fused
+    raw_future = _HYDE_EXECUTOR.submit(pipeline.retrieve, query, deadline, embedding)
+    hyde_future = _HYDE_EXECUTOR.submit(
+        lambda: pipeline.retrieve(
+            generate_hyde_doc(pipeline.chat, query, pipeline.llm_model, deadline),
+            deadline,
+        )
+    )
+
+    hyde_timeout = HYDE_TIMEOUT
+    if deadline is not None:
+        hyde_timeout = min(
+            hyde_timeout, deadline.stage_timeout("hyde", "embed", "search", "rerank")
+        )
+
+    try:
+        hyde_docs = hyde_future.result(timeout=hyde_timeout)
+    except Exception as e:
+        logger.error("HyDE step failed, using only the query: %s", repr(e))
+        hyde_docs = []
+
+    raw_docs = raw_future.result()
+
+    return reciprocal_rank_fusion(
+        [hyde_docs, raw_docs], top_n=max(len(hyde_docs), len(raw_docs))
+    )
+
+
 def hyde_rag(
     query,
     llm_model,
@@ -184,70 +792,295 @@ def hyde_rag(
     lang="en",
     selected_collection="ORACLE_KNOWLEDGE",
     temperature=TEMPERATURE,
+    hyde_mode=HYDE_MODE,
+    on_token=None,
+    deadline=None,
+    on_event=None,
 ):
     """
     This method supports the implementation of HyDE
     see: https://arxiv.org/abs/2212.10496
+
+    hyde_mode: sequential or fused (see retrieve_hyde_docs)
+    on_token, on_event: to stream the answer (see call_llm_for_answer)
+    deadline: time budget (sec.) for the question, None: no limit
     """
+    deadline = None if deadline is None else Deadline(deadline)
 
-    # this doesn't change
-    retriever = get_retriever(add_reranker, selected_collection)
+    # reuse retriever and llm across questions
+    pipeline = get_rag_pipeline(
+        selected_collection, add_reranker, llm_model, temperature, hybrid_search
+    )
+    chat = pipeline.chat
 
-    chat = get_llm(llm_model, temperature)
+    query_embedding = None
+    if ANSWER_CACHE_ENABLED:
+        query_embedding = embed_question(pipeline, query, deadline)
 
-    # Hyde step1: ask to the llm to answer to the query
-    # creating an hypothetical document
+        cached_response = get_cached_answer(pipeline, query, query_embedding, lang)
+        if cached_response is not None:
+            stream_cached_answer(cached_response, llm_model, on_token, on_event)
+            return cached_response
 
-    # formulate the task
-    task = get_task_step1(query)
+    # step 1 (hyde doc) and retrieval
+    docs = retrieve_hyde_docs(pipeline, query, hyde_mode, deadline, query_embedding)
 
-    if llm_model.startswith("cohere"):
-        # resetting preamble
-        chat.preamble_override = None
+    # step 2
+    response2 = call_llm_for_answer(
+        chat, llm_model, query, docs, lang, on_token, deadline, on_event
+    )
 
-        # get the hyde doc
-        response1 = chat.invoke(query=task, chat_history=[], documents=[])
+    if ANSWER_CACHE_ENABLED:
+        save_answer(pipeline, query, query_embedding, lang, response2)
 
-        # this is the hypotethical doc produced by step1
-        hyde_doc = get_text_from_response(response1, llm_model)
+    return response2
 
-        # step 2
-        # do the semantic search searching for docs similar to hyde_doc
-        docs = retriever.invoke(hyde_doc)
 
-        documents_txt = format_docs_for_cohere(docs)
+def classic_rag(
+    query,
+    llm_model,
+    add_reranker=False,
+    hybrid_search=False,
+    lang="en",
+    selected_collection="ORACLE_KNOWLEDGE",
+    temperature=TEMPERATURE,
+    docs=None,
+    on_token=None,
+    deadline=None,
+    on_event=None,
+    query_embedding=None,
+):
+    """
+    Do the classic rag
+
+    docs: if given, the docs already retrieved (see batch_retrieve)
+    query_embedding: if given, the embedding of the query, already
+        looked up in the answer cache (see answer_questions)
+    on_token, on_event: to stream the answer (see call_llm_for_answer)
+    deadline: time budget (sec.) for the question, None: no limit
+    """
+    deadline = None if deadline is None else Deadline(deadline)
 
-        # print("Step 2...")
-        # choose the preamble based on target language
-        chat.preamble_override = preamble_dict[f"preamble_{lang}"]
+    # reuse retriever and llm across questions
+    pipeline = get_rag_pipeline(
+        selected_collection, add_reranker, llm_model, temperature, hybrid_search
+    )
+    chat = pipeline.chat
+
+    if ANSWER_CACHE_ENABLED and query_embedding is None:
+        query_embedding = embed_question(pipeline, query, deadline)
+
+        cached_response = get_cached_answer(pipeline, query, query_embedding, lang)
+        if cached_response is not None:
+            stream_cached_answer(cached_response, llm_model, on_token, on_event)
+            return cached_response
+
+    if docs is None:
+        docs = pipeline.retrieve(query, deadline, query_embedding)
+
+    response = call_llm_for_answer(
+        chat, llm_model, query, docs, lang, on_token, deadline, on_event
+    )
+
+    if ANSWER_CACHE_ENABLED:
+        save_answer(pipeline, query, query_embedding, lang, response)
+
+    return response
+
+
+def _get_pipeline_for_questions(llm_model, rag_kwargs):
+    """
+    the pipeline used by classic_rag/hyde_rag with rag_kwargs,
+    with the collection version read again
+    """
+    pipeline = get_rag_pipeline(
+        rag_kwargs.get("selected_collection", "ORACLE_KNOWLEDGE"),
+        rag_kwargs.get("add_reranker", False),
+        llm_model,
+        rag_kwargs.get("temperature", TEMPERATURE),
+        rag_kwargs.get("hybrid_search", False),
+    )
+    pipeline.refresh_collection_version()
+
+    return pipeline
+
+
+def answer_questions(
+    questions,
+    llm_model,
+    enable_hyde=False,
+    max_workers=MAX_CONCURRENT_QUESTIONS,
+    **rag_kwargs,
+):
+    """
+    Process a list of questions with a bounded pool of workers
+
+    Yields (index, response) as soon as each question is completed,
+    index is the position of the question in questions, so that the caller
+    can keep the output aligned with the input.
+    If a question fails (ex: deadline exceeded) response is the error,
+    the other questions go on.
+    Without HyDE, answers found in the answer cache are returned first and
+    retrieval (batched) is done only for the other questions.
+    rag_kwargs: passed to classic_rag/hyde_rag
+    """
+    rag_func = hyde_rag if enable_hyde else classic_rag
+
+    pipeline = _get_pipeline_for_questions(llm_model, rag_kwargs)
+
+    # kwargs for each question, for classic_rag
+    question_kwargs = [{} for _ in questions]
+
+    if not enable_hyde:
+        to_retrieve = list(range(len(questions)))
+        embeddings = None
+
+        if ANSWER_CACHE_ENABLED:
+            # first the answer cache: retrieval only for the questions not found
+            embeddings = pipeline.embed_queries(questions)
+            lang = rag_kwargs.get("lang", "en")
+
+            to_retrieve = []
+            for i, (question, embedding) in enumerate(zip(questions, embeddings)):
+                cached_response = get_cached_answer(pipeline, question, embedding, lang)
+
+                if cached_response is not None:
+                    yield i, cached_response
+                else:
+                    question_kwargs[i]["query_embedding"] = embedding
+                    to_retrieve.append(i)
+
+            embeddings = [embeddings[i] for i in to_retrieve]
+
+        if to_retrieve:
+            # retrieval for all the questions in a few round trips
+            list_docs = pipeline.batch_retrieve(
+                [questions[i] for i in to_retrieve], embeddings
+            )
+
+            for i, docs in zip(to_retrieve, list_docs):
+                question_kwargs[i]["docs"] = docs
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i, question in enumerate(questions):
+            if enable_hyde or "docs" in question_kwargs[i]:
+                future = executor.submit(
+                    rag_func, question, llm_model, **rag_kwargs, **question_kwargs[i]
+                )
+                futures[future] = i
+
+        for future in as_completed(futures):
+            i = futures[future]
 
-        response2 = chat.invoke(query=query, chat_history=[], documents=documents_txt)
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.error("Error answering question %s: %s", i, repr(e))
+
+                response = e
+
+            yield i, response
+
+
+def _bind_index(callback, index):
+    """
+    callback(index, value) as a function of value
+    """
+    if callback is None:
+        return None
+
+    return lambda value: callback(index, value)
+
+
+def answer_questions_streaming(
+    questions,
+    llm_model,
+    on_token=None,
+    enable_hyde=False,
+    on_event=None,
+    **rag_kwargs,
+):
+    """
+    Process the questions one at a time, streaming the answers
+
+    on_token: called as on_token(index, text) with each piece of text
+    on_event: (only Cohere) called as on_event(index, event) with each event
+        of the stream, to render citations while streaming
+    Yields (index, response) as answer_questions
+    """
+    rag_func = hyde_rag if enable_hyde else classic_rag
+
+    _get_pipeline_for_questions(llm_model, rag_kwargs)
+
+    for i, question in enumerate(questions):
+        try:
+            response = rag_func(
+                question,
+                llm_model,
+                on_token=_bind_index(on_token, i),
+                on_event=_bind_index(on_event, i),
+                **rag_kwargs,
+            )
+        except Exception as e:
+            logger.error("Error answering question %s: %s", i, repr(e))
+
+            response = e
+
+        yield i, response
+
+
+#
+# async entry points: embed, search, rerank and llm calls are awaited
+#
+async def agenerate_hyde_doc(chat, query, llm_model):
+    """
+    async version of generate_hyde_doc
+    """
+    task = get_task_step1(query)
+
+    if llm_model.startswith("cohere"):
+        response1 = await chat.ainvoke(query=task, chat_history=[], documents=[])
     else:
         # meta
-        response1 = chat.invoke([HumanMessage(task)])
+        response1 = await chat.ainvoke([HumanMessage(task)])
 
-        hyde_doc = get_text_from_response(response1, llm_model)
+    return get_text_from_response(response1, llm_model)
 
-        docs = retriever.invoke(hyde_doc)
 
-        context = (
-            "Use the following context: \n"
-            + "\n".join(doc.page_content for doc in docs)
-            + "\n"
-        )
+async def aretrieve_hyde_docs(pipeline, query, hyde_mode=HYDE_MODE):
+    """
+    async version of retrieve_hyde_docs
+    """
+    check_value_in_list(hyde_mode, ["sequential", "fused"])
 
-        messages = [
-            SystemMessage(content=preamble_dict[f"preamble_{lang}"]),
-            SystemMessage(content=context),
-            HumanMessage(content=query),
-        ]
+    retriever = pipeline.retriever
 
-        response2 = chat.invoke(messages)
+    async def hyde_search():
+        hyde_doc = await agenerate_hyde_doc(pipeline.chat, query, pipeline.llm_model)
 
-    return response2
+        return await retriever.ainvoke(hyde_doc)
 
+    if hyde_mode == "sequential":
+        return await hyde_search()
 
-def classic_rag(
+    # fused
+    raw_task = asyncio.ensure_future(retriever.ainvoke(query))
+
+    try:
+        hyde_docs = await asyncio.wait_for(hyde_search(), HYDE_TIMEOUT)
+    except Exception as e:
+        logger.error("HyDE step failed, using only the query: %s", repr(e))
+        hyde_docs = []
+
+    raw_docs = await raw_task
+
+    return reciprocal_rank_fusion(
+        [hyde_docs, raw_docs], top_n=max(len(hyde_docs), len(raw_docs))
+    )
+
+
+async def ahyde_rag(
     query,
     llm_model,
     add_reranker=False,
@@ -255,41 +1088,110 @@ def classic_rag(
     lang="en",
     selected_collection="ORACLE_KNOWLEDGE",
     temperature=TEMPERATURE,
+    hyde_mode=HYDE_MODE,
 ):
     """
-    Do the classic rag
+    async version of hyde_rag
     """
+    pipeline = get_rag_pipeline(
+        selected_collection, add_reranker, llm_model, temperature, hybrid_search
+    )
+    chat = pipeline.chat
+
+    if ANSWER_CACHE_ENABLED:
+        query_embedding = await pipeline.embed_model.aembed_query(query)
 
-    # this doesn't change
-    retriever = get_retriever(add_reranker, selected_collection)
+        cached_response = get_cached_answer(pipeline, query, query_embedding, lang)
+        if cached_response is not None:
+            return cached_response
 
-    docs = retriever.invoke(query)
+    docs = await aretrieve_hyde_docs(pipeline, query, hyde_mode)
 
-    chat = get_llm(llm_model, temperature)
+    llm_input = build_llm_input(llm_model, query, docs, lang)
 
     if llm_model.startswith("cohere"):
-        # using Cohere native interface for citations
+        response2 = await chat.ainvoke(**llm_input)
+    else:
+        # meta
+        response2 = await chat.ainvoke(llm_input)
+
+    if ANSWER_CACHE_ENABLED:
+        save_answer(pipeline, query, query_embedding, lang, response2)
+
+    return response2
+
+
+async def aclassic_rag(
+    query,
+    llm_model,
+    add_reranker=False,
+    hybrid_search=False,
+    lang="en",
+    selected_collection="ORACLE_KNOWLEDGE",
+    temperature=TEMPERATURE,
+):
+    """
+    async version of classic_rag
+    """
+    pipeline = get_rag_pipeline(
+        selected_collection, add_reranker, llm_model, temperature, hybrid_search
+    )
+    retriever = pipeline.retriever
+    chat = pipeline.chat
+
+    if ANSWER_CACHE_ENABLED:
+        query_embedding = await pipeline.embed_model.aembed_query(query)
 
-        documents_txt = format_docs_for_cohere(docs)
+        cached_response = get_cached_answer(pipeline, query, query_embedding, lang)
+        if cached_response is not None:
+            return cached_response
 
-        chat.preamble_override = preamble_dict[f"preamble_{lang}"]
+    docs = await retriever.ainvoke(query)
 
-        response = chat.invoke(query=query, chat_history=[], documents=documents_txt)
+    llm_input = build_llm_input(llm_model, query, docs, lang)
 
+    if llm_model.startswith("cohere"):
+        response = await chat.ainvoke(**llm_input)
     else:
         # meta
-        context = (
-            "Use the following context: \n"
-            + "\n".join(doc.page_content for doc in docs)
-            + "\n"
-        )
+        response = await chat.ainvoke(llm_input)
 
-        messages = [
-            SystemMessage(content=preamble_dict[f"preamble_{lang}"]),
-            SystemMessage(content=context),
-            HumanMessage(content=query),
-        ]
-
-        response = chat.invoke(messages)
+    if ANSWER_CACHE_ENABLED:
+        save_answer(pipeline, query, query_embedding, lang, response)
 
     return response
+
+
+async def aanswer_questions(
+    questions,
+    llm_model,
+    enable_hyde=False,
+    max_concurrency=MAX_ASYNC_QUESTIONS,
+    **rag_kwargs,
+):
+    """
+    async version of answer_questions
+
+    Yields (index, response) as soon as each question is completed,
+    at most max_concurrency questions are in flight
+    if a question fails, response is the exception
+    """
+    rag_func = ahyde_rag if enable_hyde else aclassic_rag
+
+    _get_pipeline_for_questions(llm_model, rag_kwargs)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def process(i, question):
+        async with semaphore:
+            try:
+                return i, await rag_func(question, llm_model, **rag_kwargs)
+            except Exception as e:
+                logger.error("Error answering question %s: %s", i, repr(e))
+
+                return i, e
+
+    tasks = [process(i, question) for i, question in enumerate(questions)]
+
+    for next_completed in asyncio.as_completed(tasks):
+        yield await next_completed
@@ -11,6 +11,9 @@ Python Version: 3.11
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import oracledb
 
 from langchain_community.vectorstores import OpenSearchVectorSearch
@@ -20,11 +23,15 @@ from langchain_community.vectorstores.utils import DistanceStrategy
 
 
 from oraclevs_4_rfx import OracleVS4RFX
+from opensearch_4_rfx import OpenSearchRFX
 from utils import check_value_in_list
 
 from config import (
     # shared params for opensearch
     OPENSEARCH_SHARED_PARAMS,
+    ASYNC_DB_POOL_SIZE,
+    SEARCH_DB_POOL_SIZE,
+    KEYWORD_DB_POOL_SIZE,
 )
 from config_private import (
     OPENSEARCH_USER,
@@ -35,6 +42,10 @@ from config_private import (
     DB_SERVICE,
 )
 
+# all the keyword searches, run in parallel with the vector ones
+# (only leaf tasks here: who submits can wait for them)
+_KEYWORD_EXECUTOR = ThreadPoolExecutor(max_workers=KEYWORD_DB_POOL_SIZE)
+
 
 def get_vector_store(
     vector_store_type,
@@ -66,11 +77,45 @@ def get_vector_store(
         try:
             connection = oracledb.connect(user=DB_USER, password=DB_PWD, dsn=dsn)
 
+            # used by the async search, connections are opened on demand
+            # (a pool for each event loop, created on first use)
+            async_pool_factory = partial(
+                oracledb.create_pool_async,
+                user=DB_USER,
+                password=DB_PWD,
+                dsn=dsn,
+                min=0,
+                max=ASYNC_DB_POOL_SIZE,
+            )
+
+            # used by the vector search: the questions answered
+            # in parallel don't wait for a single connection
+            search_pool = oracledb.create_pool(
+                user=DB_USER,
+                password=DB_PWD,
+                dsn=dsn,
+                min=0,
+                max=SEARCH_DB_POOL_SIZE,
+            )
+
+            # used by the keyword search: it runs in parallel with
+            # the vector search, on another connection
+            keyword_pool = oracledb.create_pool(
+                user=DB_USER,
+                password=DB_PWD,
+                dsn=dsn,
+                min=0,
+                max=KEYWORD_DB_POOL_SIZE,
+            )
+
             v_store = OracleVS4RFX(
                 client=connection,
                 table_name=selected_collection,
                 distance_strategy=DistanceStrategy.COSINE,
                 embedding_function=embed_model,
+                async_pool_factory=async_pool_factory,
+                search_pool=search_pool,
+                keyword_pool=keyword_pool,
             )
         except oracledb.Error as e:
             err_msg = "An error occurred in get_vector_store: " + str(e)
@@ -79,3 +124,39 @@ def get_vector_store(
     # 06/07: removed qdrant
 
     return v_store
+
+
+def get_collection_version(vector_store_type, v_store, selected_collection):
+    """
+    return a fingerprint of the content of the collection
+    used to invalidate caches when the collection changes
+    """
+    check_value_in_list(vector_store_type, ["OPENSEARCH", "23AI"])
+
+    if vector_store_type == "OPENSEARCH":
+        return OpenSearchRFX.get_collection_version(selected_collection)
+
+    return OracleVS4RFX.get_collection_version(v_store.client, selected_collection)
+
+
+def keyword_search(vector_store_type, v_store, query, k):
+    """
+    lexical search: Oracle Text for 23AI, BM25 for OpenSearch
+    """
+    check_value_in_list(vector_store_type, ["OPENSEARCH", "23AI"])
+
+    if vector_store_type == "OPENSEARCH":
+        return OpenSearchRFX.keyword_search(v_store, query, k)
+
+    return v_store.keyword_search(query, k)
+
+
+def submit_keyword_search(vector_store_type, v_store, query, k):
+    """
+    start keyword_search in the executor shared by all the keyword searches
+
+    returns the future
+    """
+    return _KEYWORD_EXECUTOR.submit(
+        keyword_search, vector_store_type, v_store, query, k
+    )
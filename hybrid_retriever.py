@@ -0,0 +1,61 @@
+"""
+Hybrid retriever
+
+Runs in parallel the vector search and a keyword search
+(Oracle Text for 23AI, BM25 for OpenSearch)
+and merges the results with Reciprocal Rank Fusion
+"""
+
+import asyncio
+from typing import Any, List
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from factory_vector_store import submit_keyword_search
+from rank_fusion import reciprocal_rank_fusion
+
+from config import VECTOR_STORE_TYPE
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Usage:
+        retriever = HybridRetriever(
+            vector_retriever=v_store.as_retriever(k=TOP_K), v_store=v_store, k=TOP_K
+        )
+    """
+
+    vector_retriever: BaseRetriever
+    """the retriever for the vector search"""
+    v_store: Any
+    """the vector store, used for the keyword search"""
+    k: int = 4
+    """num. of docs returned"""
+
+    def _submit_keyword_search(self, query: str):
+        return submit_keyword_search(VECTOR_STORE_TYPE, self.v_store, query, self.k)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        keyword_future = self._submit_keyword_search(query)
+
+        vector_docs = self.vector_retriever.invoke(query)
+        keyword_docs = keyword_future.result()
+
+        return reciprocal_rank_fusion([vector_docs, keyword_docs], top_n=self.k)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector_docs, keyword_docs = await asyncio.gather(
+            self.vector_retriever.ainvoke(query),
+            asyncio.wrap_future(self._submit_keyword_search(query)),
+        )
+
+        return reciprocal_rank_fusion([vector_docs, keyword_docs], top_n=self.k)
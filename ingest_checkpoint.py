@@ -0,0 +1,254 @@
+"""
+Checkpoints for ingestion
+
+embeddings are saved on disk as they are computed, so that a load
+that fails halfway (network, 429) can be resumed embedding only
+the chunks still missing.
+
+In the checkpoint dir (one for each collection):
+* shard_NNNNN.npy: the vectors of a shard (float32, loaded memory-mapped)
+* shard_NNNNN.jsonl: for each vector, the hash of the text and the metadata
+* manifest.json: the params of the load, the completed shards and
+  if the load has started to create the collection
+
+shards are append-only: written once, then added to the manifest,
+a shard not in the manifest (ex: interrupted while written) is ignored.
+The checkpoint is removed when the load is completed.
+"""
+
+import json
+import os
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from chunk_index_utils import get_text_hash
+from utils import get_console_logger
+
+logger = get_console_logger()
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _write_atomic(path, write_func):
+    """
+    write to a temporary file, then rename: the file is complete or missing
+    """
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "wb") as f:
+        write_func(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+class CheckpointStore:
+    """
+    the embeddings already computed for a collection
+
+    params: the params of the load (ex: model, chunk size), to check
+        that a resumed load is compatible with the checkpoint
+    """
+
+    def __init__(self, checkpoint_dir, params):
+        self.checkpoint_dir = checkpoint_dir
+        self.params = params
+        self.manifest = {"params": params, "shards": []}
+
+        # text hash -> (shard index, row)
+        self.index = {}
+        # shard index -> vectors (memory-mapped)
+        self.vectors = {}
+
+    def _get_path(self, name):
+        return os.path.join(self.checkpoint_dir, name)
+
+    def _save_manifest(self):
+        _write_atomic(
+            self._get_path(MANIFEST_NAME),
+            lambda f: f.write(json.dumps(self.manifest, indent=2).encode("utf-8")),
+        )
+
+    def exists(self):
+        return os.path.exists(self._get_path(MANIFEST_NAME))
+
+    def _remove_files(self):
+        for name in os.listdir(self.checkpoint_dir):
+            if name.startswith("shard_") or name.startswith(MANIFEST_NAME):
+                os.remove(self._get_path(name))
+
+    def start(self):
+        """
+        start a new load, the previous checkpoint (if any) is removed
+        """
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        self._remove_files()
+
+        self._save_manifest()
+
+    def remove(self):
+        """
+        remove the checkpoint, when the load is completed
+        """
+        if os.path.isdir(self.checkpoint_dir):
+            self._remove_files()
+
+        self.manifest = {"params": self.params, "shards": []}
+        self.index = {}
+        self.vectors = {}
+
+    def set_collection_created(self):
+        """
+        called before creating the collection: a resumed load
+        can drop it and create it again
+        """
+        self.manifest["collection_created"] = True
+        self._save_manifest()
+
+    def is_collection_created(self):
+        """
+        the collection has been created by the load of this checkpoint
+        """
+        return self.manifest.get("collection_created", False)
+
+    def resume(self):
+        """
+        load the completed shards of a previous load
+        """
+        with open(self._get_path(MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        if manifest["params"] != self.params:
+            raise ValueError(
+                f"Checkpoint in {self.checkpoint_dir} made with params "
+                f"{manifest['params']}, not {self.params}"
+            )
+
+        self.manifest = manifest
+
+        for shard in manifest["shards"]:
+            self._load_shard(shard)
+
+        logger.info(
+            "Resumed %d embeddings from %d shards in %s",
+            len(self.index),
+            len(manifest["shards"]),
+            self.checkpoint_dir,
+        )
+
+    def _load_shard(self, shard):
+        shard_id = shard["id"]
+
+        self.vectors[shard_id] = np.load(
+            self._get_path(f"{shard['name']}.npy"), mmap_mode="r"
+        )
+
+        with open(self._get_path(f"{shard['name']}.jsonl"), encoding="utf-8") as f:
+            for row, line in enumerate(f):
+                self.index[json.loads(line)["hash"]] = (shard_id, row)
+
+    def contains(self, text):
+        return get_text_hash(text) in self.index
+
+    def append(self, texts, metadatas, embeddings):
+        """
+        save a new shard with the embeddings of texts
+        """
+        shard_id = len(self.manifest["shards"])
+        name = f"shard_{shard_id:05d}"
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        hashes = [get_text_hash(text) for text in texts]
+
+        _write_atomic(self._get_path(f"{name}.npy"), lambda f: np.save(f, vectors))
+        _write_atomic(
+            self._get_path(f"{name}.jsonl"),
+            lambda f: f.write(
+                "".join(
+                    json.dumps({"hash": text_hash, "metadata": metadata}) + "\n"
+                    for text_hash, metadata in zip(hashes, metadatas)
+                ).encode("utf-8")
+            ),
+        )
+
+        # now the shard is complete
+        shard = {"id": shard_id, "name": name, "count": len(texts)}
+        self.manifest["shards"].append(shard)
+        self._save_manifest()
+
+        self._load_shard(shard)
+
+    def get_embedding(self, text):
+        shard_id, row = self.index[get_text_hash(text)]
+
+        return self.vectors[shard_id][row].tolist()
+
+
+def embed_with_checkpoints(docs, embed_model, store, shard_size):
+    """
+    embed the chunks not yet in the store, saving a shard
+    every shard_size chunks
+    """
+    # each distinct text once
+    missing = {}
+    for doc in docs:
+        if not store.contains(doc.page_content):
+            missing.setdefault(get_text_hash(doc.page_content), doc)
+
+    missing_docs = list(missing.values())
+
+    logger.info(
+        "%d distinct texts to embed for %d chunks (the others are in checkpoint)",
+        len(missing_docs),
+        len(docs),
+    )
+
+    for start in range(0, len(missing_docs), shard_size):
+        shard_docs = missing_docs[start : start + shard_size]
+        texts = [doc.page_content for doc in shard_docs]
+
+        embeddings = embed_model.embed_documents(texts)
+
+        store.append(texts, [doc.metadata for doc in shard_docs], embeddings)
+
+        logger.info(
+            "Saved checkpoint: %d/%d texts embedded",
+            start + len(shard_docs),
+            len(missing_docs),
+        )
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    Embeddings from a CheckpointStore, to write in the vector store
+    the vectors already computed; texts not in the store are
+    embedded with embed_model
+
+    Usage:
+        create_collection_and_add_docs_to_23ai(
+            docs, PrecomputedEmbeddings(store, embed_model), collection_name
+        )
+    """
+
+    def __init__(self, store: CheckpointStore, embed_model: Embeddings):
+        self.store = store
+        self.embed_model = embed_model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        missing = [text for text in texts if not self.store.contains(text)]
+
+        vectors = {}
+        if missing:
+            vectors = dict(zip(missing, self.embed_model.embed_documents(missing)))
+
+        return [
+            vectors[text] if text in vectors else self.store.get_embedding(text)
+            for text in texts
+        ]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_model.embed_query(text)
@@ -0,0 +1,138 @@
+"""
+Record/replay store for LLM calls
+
+Responses to (non streaming) chat requests are stored in SQLite,
+keyed by the hash of the serialized ChatDetails, with the full
+response (text, citations, documents).
+Embeddings are recorded and replayed by the embeddings cache
+(see CachedEmbeddings), per text: batches don't need to be the same.
+
+Modes (LLM_REPLAY_MODE):
+* passthrough: not used
+* record: every request is sent to OCI and the response is stored
+* replay: stored responses are returned without calling OCI,
+  a request never recorded raises ReplayMissError (works offline)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils import get_console_logger
+
+from config import LLM_REPLAY_MODE, LLM_REPLAY_PATH
+
+logger = get_console_logger()
+
+REPLAY_MODES = ["passthrough", "record", "replay"]
+
+
+class ReplayMissError(Exception):
+    """
+    in replay mode, for a request never recorded
+    """
+
+
+class ReplayCache:
+    """
+    Record/replay store, thread safe
+    """
+
+    def __init__(self, path=LLM_REPLAY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model_id TEXT NOT NULL,
+                request TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def lookup(self, key):
+        """
+        returns the stored response (dict) or None
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def save(self, key, model_id, request, response):
+        """
+        store (or replace) the response
+
+        request, response: serialized (dict) ChatDetails and ChatResult
+        the request is stored only to inspect the recordings
+        """
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO responses
+                (key, model_id, request, response, created)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (key, model_id, json.dumps(request), json.dumps(response), time.time()),
+            )
+            self.conn.commit()
+
+    def get_stats(self) -> dict:
+        """
+        hit/miss counters
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_REPLAY_CACHE = None
+_REPLAY_CACHE_LOCK = threading.Lock()
+
+
+def get_replay_mode():
+    """
+    the configured mode (checked)
+    """
+    if LLM_REPLAY_MODE not in REPLAY_MODES:
+        raise ValueError(
+            f"LLM_REPLAY_MODE must be one of {REPLAY_MODES}, not {LLM_REPLAY_MODE}"
+        )
+
+    return LLM_REPLAY_MODE
+
+
+def get_replay_cache() -> ReplayCache:
+    """
+    the record/replay store shared in the process
+    """
+    global _REPLAY_CACHE
+
+    with _REPLAY_CACHE_LOCK:
+        if _REPLAY_CACHE is None:
+            _REPLAY_CACHE = ReplayCache()
+
+            logger.info("LLM replay cache in %s mode", get_replay_mode())
+
+        return _REPLAY_CACHE
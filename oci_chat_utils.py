@@ -2,15 +2,52 @@
 oci_chat_utils
 
 Code common to oci_command_r_oo and oci_llama3_oo
+
+Contains also the async calls to OCI GenAI: the Python SDK is sync only,
+so requests are serialized and signed with the SDK and sent with httpx
 """
 
+import asyncio
+import hashlib
+import json
+import threading
+import weakref
+from contextlib import nullcontext
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 import oci
 from oci.generative_ai_inference import GenerativeAiInferenceClient
 from oci.retry import NoneRetryStrategy
+from oci.circuit_breaker import NoCircuitBreakerStrategy
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from oci_throttling import get_throttle
+from deadlines import cap_timeout, mark_service_call
+from endpoint_router import get_router
+from single_flight import SingleFlight
+from llm_replay_cache import get_replay_cache, get_replay_mode, ReplayMissError
+from config import OCI_CLIENT_POOL_SIZE, LLM_SINGLE_FLIGHT, OCI_GENAI_STANDIN_URL
 
 OCI_CONFIG_DIR = "~/.oci/config"
 TIMEOUT = (10, 240)
 
+# version of the OCI GenAI inference API
+API_VERSION = "20231130"
+
+# one httpx client for each event loop, to reuse connections
+_ASYNC_HTTP_CLIENTS = weakref.WeakKeyDictionary()
+
+# the shared clients, keyed by (endpoint, profile, use_session_token)
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+# (profile, use_session_token) of the shared clients, by id
+_CLIENT_AUTH = {}
+
+# identical chat requests in flight, shared between all the models
+_SINGLE_FLIGHT = SingleFlight()
+
 
 def make_security_token_signer(oci_config):
     """
@@ -24,28 +61,534 @@ def make_security_token_signer(oci_config):
     return oci.auth.signers.SecurityTokenSigner(st_string, pk)
 
 
-def get_generative_ai_dp_client(endpoint, profile, use_session_token):
+def get_service_endpoint(endpoint):
+    """
+    the endpoint to call: the local stand-in server, if configured
+    """
+    return OCI_GENAI_STANDIN_URL or endpoint
+
+
+def _make_standin_signer():
+    """
+    the stand-in server doesn't check signatures:
+    sign with a throwaway key, so no OCI config is needed
+    """
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    return oci.auth.signers.SecurityTokenSigner("standin", private_key)
+
+
+def _limit_session_timeout(session):
+    """
+    the SDK sends every request with the timeout of the client:
+    reduce it to the time left to the call (see deadlines.time_left)
+    """
+    request = session.request
+
+    def request_in_time(method, url, timeout=None, **kwargs):
+        if timeout is not None:
+            timeout = cap_timeout(timeout)
+
+        return request(method, url, timeout=timeout, **kwargs)
+
+    session.request = request_in_time
+
+
+def _create_generative_ai_dp_client(endpoint, profile, use_session_token):
     """
     create the client for OCI GenAI
     """
-    config = oci.config.from_file(OCI_CONFIG_DIR, profile)
+    client_kwargs = {
+        "service_endpoint": get_service_endpoint(endpoint),
+        "retry_strategy": NoneRetryStrategy(),
+        # retries and circuit breaking are done in oci_throttling
+        "circuit_breaker_strategy": NoCircuitBreakerStrategy(),
+        "timeout": TIMEOUT,
+    }
 
-    if use_session_token:
+    if OCI_GENAI_STANDIN_URL is not None:
+        client = GenerativeAiInferenceClient(
+            config={}, signer=_make_standin_signer(), **client_kwargs
+        )
+    elif use_session_token:
+        config = oci.config.from_file(OCI_CONFIG_DIR, profile)
         signer = make_security_token_signer(oci_config=config)
 
         client = GenerativeAiInferenceClient(
-            config=config,
-            signer=signer,
-            service_endpoint=endpoint,
-            retry_strategy=NoneRetryStrategy(),
-            timeout=TIMEOUT,
+            config=config, signer=signer, **client_kwargs
         )
     else:
-        client = GenerativeAiInferenceClient(
-            config=config,
-            service_endpoint=endpoint,
-            retry_strategy=NoneRetryStrategy(),
-            timeout=TIMEOUT,
-        )
+        config = oci.config.from_file(OCI_CONFIG_DIR, profile)
+
+        client = GenerativeAiInferenceClient(config=config, **client_kwargs)
+
+    # more connections kept alive, for concurrent requests
+    adapter = HTTPAdapter(
+        pool_connections=OCI_CLIENT_POOL_SIZE, pool_maxsize=OCI_CLIENT_POOL_SIZE
+    )
+    client.base_client.session.mount("https://", adapter)
+    # the stand-in server is plain http
+    client.base_client.session.mount("http://", adapter)
+
+    _limit_session_timeout(client.base_client.session)
+
+    return client
+
+
+def get_generative_ai_dp_client(endpoint, profile, use_session_token):
+    """
+    return the client for OCI GenAI
+
+    clients are shared in the process, one for each (endpoint, profile, auth),
+    this way config and keys are read once and connections are reused
+    """
+    key = (endpoint, profile, use_session_token)
+
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+
+        if client is None:
+            client = _create_generative_ai_dp_client(
+                endpoint, profile, use_session_token
+            )
+            _CLIENTS[key] = client
+            _CLIENT_AUTH[id(client)] = (profile, use_session_token)
 
     return client
+
+
+def get_single_flight_stats():
+    """
+    num. of chat calls sent and num. of calls that shared a result
+    """
+    return _SINGLE_FLIGHT.get_stats()
+
+
+def close_generative_ai_dp_clients():
+    """
+    close all the shared clients (ex: to reload ~/.oci/config)
+    """
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.base_client.session.close()
+
+        _CLIENTS.clear()
+        _CLIENT_AUTH.clear()
+
+
+class CohereStreamMerger:
+    """
+    merges the events of a Cohere streaming response, one at a time
+    (to be used also where the text must be yielded, ex: LangChain _stream)
+    """
+
+    def __init__(self):
+        self.texts = []
+        self.citations = []
+        self.documents = []
+        self.final_event = None
+
+    def add_event(self, res):
+        """
+        add an event, returns its piece of text (None if no text)
+        """
+        if "finishReason" in res.keys():
+            # the last event contains the full text
+            self.final_event = res
+            return None
+
+        self.citations.extend(res.get("citations", []))
+        self.documents.extend(res.get("documents", []))
+
+        if "text" in res.keys():
+            self.texts.append(res["text"])
+            return res["text"]
+
+        return None
+
+    def is_completed(self):
+        return self.final_event is not None
+
+    def get_final_event(self):
+        """
+        the content of the final event, completed with
+        the citations and documents received during the stream
+        """
+        final_event = dict(self.final_event or {})
+
+        final_event.setdefault("text", "".join(self.texts))
+        if not final_event.get("citations"):
+            final_event["citations"] = self.citations
+        if not final_event.get("documents"):
+            final_event["documents"] = self.documents
+
+        return final_event
+
+
+def merge_cohere_stream_events(events, on_token=None, on_event=None):
+    """
+    consume the events of a Cohere streaming response
+
+    on_token: called with each piece of text, as it arrives
+    on_event: called with each event (dict), ex: to render
+        citations while streaming (see CitationRenderer)
+    returns the content of the final event, completed with
+    the citations and documents received during the stream
+    """
+    merger = CohereStreamMerger()
+
+    for res in events:
+        if on_event is not None:
+            on_event(res)
+
+        text = merger.add_event(res)
+
+        if text is not None and on_token is not None:
+            on_token(text)
+
+        if merger.is_completed():
+            break
+
+    return merger.get_final_event()
+
+
+def build_cohere_chat_result(client, model_id, final_event):
+    """
+    build from the final event of a stream the same ChatResult
+    returned without streaming
+    """
+    data = {
+        "modelId": model_id,
+        "chatResponse": {**final_event, "apiFormat": "COHERE"},
+    }
+
+    return client.base_client.deserialize_response_data(
+        json.dumps(data).encode("utf-8"), "ChatResult"
+    )
+
+
+def get_async_http_client():
+    """
+    return the httpx client for the running event loop
+    """
+    loop = asyncio.get_running_loop()
+
+    http_client = _ASYNC_HTTP_CLIENTS.get(loop)
+
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(TIMEOUT[1], connect=TIMEOUT[0]),
+            limits=httpx.Limits(max_connections=OCI_CLIENT_POOL_SIZE),
+        )
+        _ASYNC_HTTP_CLIENTS[loop] = http_client
+
+    return http_client
+
+
+def get_async_http_timeout():
+    """
+    the timeout for an httpx request, reduced to the time left
+    """
+    connect, read = cap_timeout(TIMEOUT)
+
+    return httpx.Timeout(read, connect=connect)
+
+
+def _prepare_signed_request(client, endpoint, action, details, is_streaming):
+    """
+    serialize the request with the SDK and sign it with the client signer
+
+    returns url, headers and body to be sent
+    """
+    url = f"{get_service_endpoint(endpoint)}/{API_VERSION}/actions/{action}"
+
+    body = json.dumps(client.base_client.sanitize_for_serialization(details))
+
+    accept = "text/event-stream" if is_streaming else "application/json"
+
+    request = requests.Request(
+        "POST",
+        url,
+        headers={"content-type": "application/json", "accept": accept},
+        data=body,
+    ).prepare()
+
+    # the signer adds the authorization headers
+    client.base_client.signer(request)
+
+    return url, dict(request.headers), body
+
+
+def _raise_for_status(status, headers, text):
+    """
+    raise the same exception raised by the SDK
+    """
+    if status >= 400:
+        try:
+            error = json.loads(text)
+        except ValueError:
+            error = {}
+
+        raise oci.exceptions.ServiceError(
+            status, error.get("code"), headers, error.get("message", text)
+        )
+
+
+def _get_model_key(details):
+    """
+    the model (or dedicated endpoint) of a request, to choose the throttle
+    """
+    serving_mode = details.serving_mode
+
+    return getattr(serving_mode, "model_id", None) or serving_mode.endpoint_id
+
+
+def get_request_key(client, action, details):
+    """
+    hash of the full request (model, preamble, message, documents, params...)
+    """
+    payload = json.dumps(
+        client.base_client.sanitize_for_serialization(details), sort_keys=True
+    )
+
+    return hashlib.sha256(f"{action}:{payload}".encode("utf-8")).hexdigest()
+
+
+def _is_shareable(action, details):
+    """
+    only non streaming chat requests are shared (single flight)
+    and recorded/replayed
+    """
+    return action == "chat" and not details.chat_request.is_stream
+
+
+def _replay_lookup(client, key):
+    """
+    in replay mode, the recorded response (without calling OCI)
+    """
+    if get_replay_mode() != "replay":
+        return None
+
+    payload = get_replay_cache().lookup(key)
+
+    if payload is None:
+        raise ReplayMissError(f"No recorded response for request {key}")
+
+    data = client.base_client.deserialize_response_data(
+        json.dumps(payload).encode("utf-8"), "ChatResult"
+    )
+
+    return oci.response.Response(200, {}, data, None)
+
+
+def _replay_record(client, key, details, response):
+    """
+    in record mode, store the response
+    """
+    if get_replay_mode() == "record":
+        get_replay_cache().save(
+            key,
+            _get_model_key(details),
+            client.base_client.sanitize_for_serialization(details),
+            client.base_client.sanitize_for_serialization(response.data),
+        )
+
+
+def _route(details, endpoint):
+    """
+    the endpoint for an attempt (chosen by the router, if the model
+    has more endpoints) and the context manager to track the attempt
+    """
+    router = get_router(_get_model_key(details))
+
+    if router is None:
+        return endpoint, nullcontext()
+
+    endpoint = router.choose()
+
+    return endpoint, router.track(endpoint)
+
+
+def _get_client_for(client, endpoint):
+    """
+    the shared client for the endpoint, with the same auth of client
+    """
+    auth = _CLIENT_AUTH.get(id(client))
+
+    if auth is None:
+        # not a shared client: can't be routed
+        return client
+
+    return get_generative_ai_dp_client(endpoint, *auth)
+
+
+def _send_action(client, action, details):
+    """
+    a single attempt of call_action
+    """
+    endpoint, tracker = _route(details, None)
+
+    if endpoint is not None:
+        client = _get_client_for(client, endpoint)
+
+    methods = {"chat": client.chat, "embedText": client.embed_text}
+
+    mark_service_call()
+
+    with tracker:
+        return methods[action](details)
+
+
+def call_action(client, action, details):
+    """
+    call an action (chat, embedText) with the SDK, with throttling
+    (rate limiting, retries and circuit breaking for the model)
+
+    for chat requests (non streaming):
+    * identical requests in flight at the same time are sent once
+    * responses are recorded/replayed, see llm_replay_cache
+
+    returns the SDK Response
+    """
+    throttle = get_throttle(_get_model_key(details))
+
+    if not _is_shareable(action, details):
+        return throttle.call(_send_action, client, action, details)
+
+    key = get_request_key(client, action, details)
+
+    response = _replay_lookup(client, key)
+    if response is not None:
+        return response
+
+    if LLM_SINGLE_FLIGHT:
+        response = _SINGLE_FLIGHT.do(
+            key, throttle.call, _send_action, client, action, details
+        )
+    else:
+        response = throttle.call(_send_action, client, action, details)
+
+    _replay_record(client, key, details, response)
+
+    return response
+
+
+async def _apost_action_once(client, endpoint, action, details, response_type):
+    """
+    a single attempt of apost_action
+    """
+    endpoint, tracker = _route(details, endpoint)
+
+    url, headers, body = _prepare_signed_request(
+        client, endpoint, action, details, is_streaming=False
+    )
+
+    mark_service_call()
+
+    with tracker:
+        http_response = await get_async_http_client().post(
+            url, headers=headers, content=body, timeout=get_async_http_timeout()
+        )
+
+        _raise_for_status(
+            http_response.status_code, http_response.headers, http_response.text
+        )
+
+    data = client.base_client.deserialize_response_data(
+        http_response.content, response_type
+    )
+
+    return oci.response.Response(
+        http_response.status_code, http_response.headers, data, None
+    )
+
+
+async def apost_action(client, endpoint, action, details, response_type):
+    """
+    async version of the SDK call for an action (chat, embedText)
+    with throttling, single flight and record/replay, as call_action
+
+    client: the GenerativeAiInferenceClient (used for serialization and signing)
+    response_type: the name of the SDK model for the response (ex: ChatResult)
+    returns an oci Response, the same returned by the SDK
+    """
+    throttle = get_throttle(_get_model_key(details))
+
+    if not _is_shareable(action, details):
+        return await throttle.acall(
+            _apost_action_once, client, endpoint, action, details, response_type
+        )
+
+    key = get_request_key(client, action, details)
+
+    response = _replay_lookup(client, key)
+    if response is not None:
+        return response
+
+    call_args = (_apost_action_once, client, endpoint, action, details, response_type)
+
+    if LLM_SINGLE_FLIGHT:
+        response = await _SINGLE_FLIGHT.ado(key, throttle.acall, *call_args)
+    else:
+        response = await throttle.acall(*call_args)
+
+    _replay_record(client, key, details, response)
+
+    return response
+
+
+async def _aopen_stream(client, endpoint, action, details):
+    """
+    send a streaming request, return the response when headers are received
+    (the request is signed at each attempt)
+    """
+    endpoint, tracker = _route(details, endpoint)
+
+    url, headers, body = _prepare_signed_request(
+        client, endpoint, action, details, is_streaming=True
+    )
+
+    http_client = get_async_http_client()
+
+    with tracker:
+        http_response = await http_client.send(
+            http_client.build_request(
+                "POST",
+                url,
+                headers=headers,
+                content=body,
+                timeout=get_async_http_timeout(),
+            ),
+            stream=True,
+        )
+
+        if http_response.status_code >= 400:
+            try:
+                text = (await http_response.aread()).decode("utf-8")
+            finally:
+                await http_response.aclose()
+
+            _raise_for_status(http_response.status_code, http_response.headers, text)
+
+    return http_response
+
+
+async def astream_action(client, endpoint, action, details):
+    """
+    async version of a streaming call
+    only the opening of the stream is throttled and retried
+
+    yields the events, as dict (the json in data: of each SSE event)
+    """
+    throttle = get_throttle(_get_model_key(details))
+
+    http_response = await throttle.acall(
+        _aopen_stream, client, endpoint, action, details
+    )
+
+    try:
+        async for line in http_response.aiter_lines():
+            if line.startswith("data:"):
+                yield json.loads(line[len("data:") :])
+    finally:
+        await http_response.aclose()
@@ -1,10 +1,13 @@
 """
 This file contains utilities to extract citations
 from Cohere command-r/r-plus response
+and to add them to the text of the answer
 
 last update: 07/06/2024
 """
 
+import heapq
+
 # to extract all the info regarding citations
 # Extract start, end, and document_ids
 from oci.response import Response
@@ -62,6 +65,13 @@ def find_source_page_by_id(data: dict, search_id) -> tuple:
     return None, None
 
 
+def index_documents(documents: list) -> dict:
+    """
+    index the documents by id, to find source and page of a doc in O(1)
+    """
+    return {doc["id"]: doc for doc in documents}
+
+
 # this functions complete citations with source (name of doc) and page
 
 
@@ -70,17 +80,17 @@ def extract_complete_citations(response: Response) -> list:
     This function extract from the Cohere response
     documents and citations and complete citations with source, page
     """
-    extracted_doc = extract_document_list(response)
+    docs_by_id = index_documents(extract_document_list(response))
     extracted_citations = extract_citations_from_response(response)
 
     complete_citations = []
     for citation in extracted_citations:
-        document_ids = citation["document_ids"]
-
         documents = []
-        for doc_id in document_ids:
-            source, page = find_source_page_by_id(extracted_doc, doc_id)
-            documents.append({"id": doc_id, "source": source, "page": page})
+        for doc_id in citation["document_ids"]:
+            doc = docs_by_id.get(doc_id, {})
+            documents.append(
+                {"id": doc_id, "source": doc.get("source"), "page": doc.get("page")}
+            )
 
         new_citation = {
             "interval": (citation["start"], citation["end"]),
@@ -90,3 +100,136 @@ def extract_complete_citations(response: Response) -> list:
         complete_citations.append(new_citation)
 
     return complete_citations
+
+
+def format_citation_marker(doc_ids) -> str:
+    """
+    the marker added after the cited text
+    """
+    return f' [{", ".join(doc_ids)}]'
+
+
+def render_citations(text: str, citations: list) -> str:
+    """
+    add after each cited span the list of doc ids, in a single pass
+
+    citations: as returned by extract_complete_citations
+    """
+    # markers in order of position (stable for spans ending at the same point)
+    markers = sorted(
+        (
+            (citation["interval"][1], i, [doc["id"] for doc in citation["documents"]])
+            for i, citation in enumerate(citations)
+        ),
+    )
+
+    parts = []
+    pos = 0
+    for end, _, doc_ids in markers:
+        parts.append(text[pos:end])
+        parts.append(format_citation_marker(doc_ids))
+        pos = end
+
+    parts.append(text[pos:])
+
+    return "".join(parts)
+
+
+class CitationRenderer:
+    """
+    renders the answer with citations while it is streamed
+
+    text, citations and documents are added as the events arrive,
+    the text already rendered (up to the last citation) is not processed again
+    """
+
+    def __init__(self):
+        self.text_parts = []
+        self.text_len = 0
+        self.docs_by_id = {}
+
+        # pending citations: (end, seq, doc ids)
+        self.pending = []
+        self.applied = []
+        self.n_citations = 0
+
+        # the text rendered up to self.committed (position in the answer)
+        self.rendered = ""
+        self.committed = 0
+
+    def add_text(self, text: str):
+        self.text_parts.append(text)
+        self.text_len += len(text)
+
+    def add_documents(self, documents: list):
+        self.docs_by_id.update(index_documents(documents))
+
+    def add_citations(self, citations: list):
+        """
+        citations: as in the stream events (start, end, text, documentIds)
+        """
+        for citation in citations:
+            doc_ids = citation.get("documentIds", citation.get("document_ids", []))
+
+            heapq.heappush(
+                self.pending, (citation["end"], self.n_citations, list(doc_ids))
+            )
+            self.n_citations += 1
+
+    def add_event(self, event: dict):
+        """
+        process an event of the Cohere stream
+        """
+        # the final event repeats the full text
+        if "text" in event and "finishReason" not in event:
+            self.add_text(event["text"])
+
+        self.add_documents(event.get("documents") or [])
+        self.add_citations(event.get("citations") or [])
+
+    def get_text(self) -> str:
+        """
+        the answer, without citations
+        """
+        text = "".join(self.text_parts)
+        # join once, keep a single part
+        self.text_parts = [text]
+
+        return text
+
+    def render(self) -> str:
+        """
+        the answer so far, with the markers of the citations received
+        """
+        text = self.get_text()
+
+        if self.pending and self.pending[0][0] < self.committed:
+            # a citation arrived out of order, before the text already rendered:
+            # render again from the beginning
+            for citation in self.applied:
+                heapq.heappush(self.pending, citation)
+
+            self.applied = []
+            self.rendered = ""
+            self.committed = 0
+
+        # apply the citations whose span has been received
+        parts = [self.rendered]
+        while self.pending and self.pending[0][0] <= self.text_len:
+            citation = heapq.heappop(self.pending)
+            end, _, doc_ids = citation
+
+            parts.append(text[self.committed : end])
+            parts.append(format_citation_marker(doc_ids))
+            self.committed = end
+            self.applied.append(citation)
+
+        self.rendered = "".join(parts)
+
+        return self.rendered + text[self.committed :]
+
+    def get_cited_documents(self) -> list:
+        """
+        the documents received, in order of id
+        """
+        return sorted(self.docs_by_id.values(), key=lambda x: x["id"])
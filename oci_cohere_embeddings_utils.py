@@ -5,10 +5,26 @@ Date last modified: 2024-04-27
 Python Version: 3.11
 """
 
+import asyncio
+import contextvars
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from tqdm.auto import tqdm
 from langchain_community.embeddings import OCIGenAIEmbeddings
+from oci.generative_ai_inference.models import EmbedTextDetails, OnDemandServingMode
+
+from oci_chat_utils import call_action, apost_action
+from embed_batching import get_batch_sizer, estimate_tokens, is_batch_too_large
+from utils import get_console_logger
+from config import EMBED_MAX_CONCURRENCY
+
+logger = get_console_logger()
 
-from config import EMBED_BATCH_SIZE
+# shared: bounds the batches in flight in the process
+# (retries and rate limit are done in call_action)
+_EMBED_EXECUTOR = ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY)
 
 
 #
@@ -18,23 +34,181 @@ class OCIGenAIEmbeddingsWithBatch(OCIGenAIEmbeddings):
     """
     add batching to OCIEmebeddings
     with Cohere max # of texts is: 96
+
+    batches are sized by tokens and bytes (see embed_batching)
+    and sent concurrently (max EMBED_MAX_CONCURRENCY in flight)
     """
 
     def embed_documents(self, texts):
-        batch_size = EMBED_BATCH_SIZE
+        if not texts:
+            return []
+
+        sizer = get_batch_sizer(self.model_id)
+        n_tokens = estimate_tokens(texts)
+
+        if sizer.next_batch_end(texts, 0, n_tokens) == len(texts):
+            # this way we don't display progress bar when we embed a query
+            return self._embed_batch(texts, sum(n_tokens))
+
+        start_time = time.perf_counter()
+
         embeddings = []
+        in_flight = deque()
+        n_batches = 0
+        start = 0
 
-        if len(texts) > batch_size:
-            # do in batch
-            for i in tqdm(range(0, len(texts), batch_size)):
-                batch = texts[i : i + batch_size]
+        with tqdm(total=len(texts)) as progress:
+            while start < len(texts) or in_flight:
+                # batches are cut when sent, to follow the learned size
+                while start < len(texts) and len(in_flight) < EMBED_MAX_CONCURRENCY:
+                    end = sizer.next_batch_end(texts, start, n_tokens)
 
-                embeddings_batch = super().embed_documents(batch)
+                    # with the context: time limit, hedging (see deadlines)
+                    in_flight.append(
+                        _EMBED_EXECUTOR.submit(
+                            contextvars.copy_context().run,
+                            self._embed_batch,
+                            texts[start:end],
+                            sum(n_tokens[start:end]),
+                        )
+                    )
+                    n_batches += 1
+                    start = end
+
+                # results are taken in the order of the batches
+                embeddings_batch = in_flight.popleft().result()
 
                 # add to the final list
                 embeddings.extend(embeddings_batch)
-        else:
-            # this way we don't display progress bar when we embed a query
-            embeddings = super().embed_documents(texts)
+                progress.update(len(embeddings_batch))
+
+        elapsed = time.perf_counter() - start_time
+
+        logger.info(
+            "Embedded %d texts in %d batches in %.1f sec. (%.1f texts/s)",
+            len(texts),
+            n_batches,
+            elapsed,
+            len(texts) / elapsed,
+        )
 
         return embeddings
+
+    def _build_embed_details(self, texts):
+        """
+        the request for a single batch
+        """
+        return EmbedTextDetails(
+            serving_mode=OnDemandServingMode(model_id=self.model_id),
+            compartment_id=self.compartment_id,
+            truncate=self.truncate,
+            inputs=texts,
+        )
+
+    def _embed_batch(self, texts, n_tokens=None):
+        """
+        embed a single batch, with throttling
+
+        if the batch is rejected as too large, it is split in two
+        n_tokens: the estimated tokens of the batch
+        """
+        sizer = get_batch_sizer(self.model_id)
+
+        if n_tokens is None:
+            n_tokens = sum(estimate_tokens(texts))
+
+        details = self._build_embed_details(texts)
+        start = time.perf_counter()
+
+        try:
+            response = call_action(self.client, "embedText", details)
+        except Exception as e:
+            if len(texts) <= 1 or not is_batch_too_large(e):
+                raise
+
+            sizer.record_too_large(n_tokens)
+
+            half = len(texts) // 2
+
+            return self._embed_batch(texts[:half]) + self._embed_batch(texts[half:])
+
+        sizer.record(n_tokens, time.perf_counter() - start)
+
+        return response.data.embeddings
+
+    async def _aembed_batch(self, texts, n_tokens=None):
+        """
+        embed a single batch, without blocking the event loop
+        """
+        sizer = get_batch_sizer(self.model_id)
+
+        if n_tokens is None:
+            n_tokens = sum(estimate_tokens(texts))
+
+        details = self._build_embed_details(texts)
+        start = time.perf_counter()
+
+        try:
+            response = await apost_action(
+                self.client,
+                self.service_endpoint,
+                "embedText",
+                details,
+                "EmbedTextResult",
+            )
+        except Exception as e:
+            if len(texts) <= 1 or not is_batch_too_large(e):
+                raise
+
+            sizer.record_too_large(n_tokens)
+
+            half = len(texts) // 2
+
+            return await self._aembed_batch(texts[:half]) + await self._aembed_batch(
+                texts[half:]
+            )
+
+        sizer.record(n_tokens, time.perf_counter() - start)
+
+        return response.data.embeddings
+
+    async def aembed_documents(self, texts):
+        """
+        async version of embed_documents
+        """
+        if not texts:
+            return []
+
+        sizer = get_batch_sizer(self.model_id)
+        n_tokens = estimate_tokens(texts)
+
+        # here the batches are cut in advance, with the current size
+        batches = []
+        start = 0
+        while start < len(texts):
+            end = sizer.next_batch_end(texts, start, n_tokens)
+            batches.append((texts[start:end], sum(n_tokens[start:end])))
+            start = end
+
+        # max EMBED_MAX_CONCURRENCY batches in flight
+        semaphore = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+
+        async def embed_batch(batch):
+            async with semaphore:
+                return await self._aembed_batch(*batch)
+
+        results = await asyncio.gather(*[embed_batch(b) for b in batches])
+
+        embeddings = []
+        for embeddings_batch in results:
+            embeddings.extend(embeddings_batch)
+
+        return embeddings
+
+    async def aembed_query(self, text):
+        """
+        async version of embed_query
+        """
+        embeddings = await self.aembed_documents([text])
+
+        return embeddings[0]
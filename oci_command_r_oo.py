@@ -8,7 +8,7 @@ good for citations
 last update: 07/06/2024
 """
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 import logging
 
 import json
@@ -23,7 +23,15 @@ from langchain_core.outputs import ChatGeneration, ChatResult
 from oci.generative_ai_inference.models import CohereChatRequest, ChatDetails
 from oci.generative_ai_inference.models import OnDemandServingMode
 
-from oci_chat_utils import get_generative_ai_dp_client
+from oci.response import Response
+
+from oci_chat_utils import (
+    get_generative_ai_dp_client,
+    call_action,
+    apost_action,
+    merge_cohere_stream_events,
+    build_cohere_chat_result,
+)
 
 logger = logging.getLogger("oci_command_r")
 
@@ -117,16 +125,26 @@ class OCICommandR(BaseChatModel):
             use_session_token=False,
         )
 
-    def invoke(self, query: str, chat_history: List, documents: List):
+    def _build_chat_detail(
+        self,
+        query: str,
+        chat_history: List,
+        documents: List,
+        preamble_override: Optional[str] = None,
+        is_streaming: Optional[bool] = None,
+    ):
         """
-        query: user request
-        chat_history: list of previous messages
-        documents: list of documents to use as Context
+        build the request for OCI, used by invoke and ainvoke
         """
+        if preamble_override is None:
+            preamble_override = self.preamble_override
+        if is_streaming is None:
+            is_streaming = self.is_streaming
+
         # LS 07/07/2024, more OO
         chat_request = CohereChatRequest(
             # override the preamble
-            preamble_override=self.preamble_override,
+            preamble_override=preamble_override,
             is_search_queries_only=self.is_search_queries_only,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
@@ -136,7 +154,7 @@ class OCICommandR(BaseChatModel):
             message=query,
             chat_history=chat_history,
             documents=documents,
-            is_stream=self.is_streaming,
+            is_stream=is_streaming,
         )
 
         chat_detail = ChatDetails(
@@ -148,14 +166,88 @@ class OCICommandR(BaseChatModel):
             chat_request=chat_request,
         )
 
+        return chat_detail
+
+    def invoke(
+        self,
+        query: str,
+        chat_history: List,
+        documents: List,
+        preamble_override: Optional[str] = None,
+    ):
+        """
+        query: user request
+        chat_history: list of previous messages
+        documents: list of documents to use as Context
+        preamble_override: if given, used instead of self.preamble_override
+        (this way the same instance can be shared between threads)
+        """
+        chat_detail = self._build_chat_detail(
+            query, chat_history, documents, preamble_override
+        )
+
         #
         # here we call the LLM
         #
-        try:
-            chat_response = self.client.chat(chat_detail)
-        except Exception as e:
-            logger.error("Error in invoke: %s", e)
-            chat_response = None
+        # errors are raised, after retries
+        chat_response = call_action(self.client, "chat", chat_detail)
+
+        return chat_response
+
+    def invoke_stream(
+        self,
+        query: str,
+        chat_history: List,
+        documents: List,
+        preamble_override: Optional[str] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        on_event: Optional[Callable[[dict], None]] = None,
+    ):
+        """
+        do the request in streaming mode
+
+        on_token: called with each piece of text, as it arrives
+        on_event: called with each event of the stream (text, citations...)
+        returns, when the stream is completed, the same response
+        (with citations) returned by invoke
+        """
+        chat_detail = self._build_chat_detail(
+            query, chat_history, documents, preamble_override, is_streaming=True
+        )
+
+        # errors are raised, after retries
+        chat_response = call_action(self.client, "chat", chat_detail)
+
+        events = (json.loads(event.data) for event in chat_response.data.events())
+
+        final_event = merge_cohere_stream_events(events, on_token, on_event)
+
+        return Response(
+            chat_response.status,
+            chat_response.headers,
+            build_cohere_chat_result(self.client, self.model, final_event),
+            chat_response.request,
+        )
+
+    async def ainvoke(
+        self,
+        query: str,
+        chat_history: List,
+        documents: List,
+        preamble_override: Optional[str] = None,
+    ):
+        """
+        async version of invoke, doesn't block a thread while waiting
+
+        always non-streaming, returns the same response of invoke
+        """
+        chat_detail = self._build_chat_detail(
+            query, chat_history, documents, preamble_override, is_streaming=False
+        )
+
+        chat_response = await apost_action(
+            self.client, self.service_endpoint, "chat", chat_detail, "ChatResult"
+        )
 
         return chat_response
 
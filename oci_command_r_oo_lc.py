@@ -6,23 +6,35 @@ This is an OO version based on OCI Python SDK
 last update: 12/06/2024
 """
 
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
 import logging
 
 import json
 
 from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
     CallbackManagerForLLMRun,
 )
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
-from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatResult, ChatGenerationChunk
 
 from oci.generative_ai_inference.models import CohereChatRequest, ChatDetails
 from oci.generative_ai_inference.models import OnDemandServingMode
-from oci.generative_ai_inference.models.cohere_message import CohereMessage
+from oci.generative_ai_inference.models import (
+    CohereUserMessage,
+    CohereChatBotMessage,
+    CohereSystemMessage,
+)
 
-from oci_chat_utils import get_generative_ai_dp_client
+from oci_chat_utils import (
+    get_generative_ai_dp_client,
+    call_action,
+    apost_action,
+    astream_action,
+    CohereStreamMerger,
+)
 
 logger = logging.getLogger("oci_command_r")
 
@@ -147,11 +159,8 @@ class OCICommandR(BaseChatModel):
         #
         # here we call the LLM
         #
-        try:
-            chat_response = self.client.chat(chat_detail)
-        except Exception as e:
-            logger.error("Error in invoke: %s", e)
-            chat_response = None
+        # errors are raised, after retries
+        chat_response = call_action(self.client, "chat", chat_detail)
 
         return chat_response
 
@@ -197,38 +206,41 @@ class OCICommandR(BaseChatModel):
         """Get the identifying parameters."""
         return self._default_params
 
-    def _handle_request(
+    def _build_chat_detail(
         self,
         messages: List[BaseMessage],
         is_streaming: Optional[bool] = False,
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any,
+        documents: Optional[List] = None,
     ):
+        """
+        translate LangChain messages in the request for OCI
+
+        documents: optional, documents to use for answering
+        (passed as kwarg to invoke/stream, ex: chat.stream(msgs, documents=docs))
+        """
         # transform Messages in CohereMessages
+        # (with SDK 2.129 CohereMessage is abstract, one class for each role)
         role_mapping = {
-            HumanMessage: "USER",
-            AIMessage: "CHATBOT",
+            HumanMessage: CohereUserMessage,
+            AIMessage: CohereChatBotMessage,
             # dirty fix for now
-            SystemMessage: "CHATBOT",
+            SystemMessage: CohereChatBotMessage,
         }
 
         cohere_msgs = [
-            CohereMessage(
-                role=role_mapping.get(type(msg), "SYSTEM"), message=msg.content
-            )
+            role_mapping.get(type(msg), CohereSystemMessage)(message=msg.content)
             for msg in messages
         ]
 
         chat_request = CohereChatRequest(
             message=cohere_msgs[-1].message,
             chat_history=cohere_msgs[:-1],
-            # documents to use for answering for now in chat_history
-            documents=[],
+            # documents to use for answering (if not given, in chat_history)
+            documents=documents if documents is not None else [],
             is_search_queries_only=self.is_search_queries_only,
             preamble_override=self.preamble_override,
             max_tokens=self.max_tokens,
-            is_stream=self.is_streaming,
+            is_stream=is_streaming,
             temperature=self.temperature,
             top_p=self.top_p,
             top_k=self.top_k,
@@ -244,14 +256,25 @@ class OCICommandR(BaseChatModel):
             chat_request=chat_request,
         )
 
+        return chat_detail
+
+    def _handle_request(
+        self,
+        messages: List[BaseMessage],
+        is_streaming: Optional[bool] = False,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ):
+        chat_detail = self._build_chat_detail(
+            messages, is_streaming, kwargs.get("documents")
+        )
+
         #
         # here we call the LLM
         #
-        try:
-            chat_response = self.client.chat(chat_detail)
-        except Exception as e:
-            logger.error("Error in invoke: %s", e)
-            chat_response = None
+        # errors are raised, after retries
+        chat_response = call_action(self.client, "chat", chat_detail)
 
         return chat_response
 
@@ -263,7 +286,7 @@ class OCICommandR(BaseChatModel):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> ChatResult:
-        response = self._handle_request(messages, is_streaming=False)
+        response = self._handle_request(messages, is_streaming=False, **kwargs)
 
         # prepare the output
         out_message = AIMessage(
@@ -273,3 +296,104 @@ class OCICommandR(BaseChatModel):
 
         generation = ChatGeneration(message=out_message)
         return ChatResult(generations=[generation])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        native async version of _generate (no executor)
+        """
+        chat_detail = self._build_chat_detail(
+            messages, is_streaming=False, documents=kwargs.get("documents")
+        )
+
+        response = await apost_action(
+            self.client, self.service_endpoint, "chat", chat_detail, "ChatResult"
+        )
+
+        out_message = AIMessage(
+            content=response.data.chat_response.text,
+            response_metadata={},
+        )
+
+        generation = ChatGeneration(message=out_message)
+        return ChatResult(generations=[generation])
+
+    @staticmethod
+    def _final_chunk(merger):
+        """
+        the last chunk (empty), with citations and documents in response_metadata
+        """
+        final_event = merger.get_final_event()
+
+        metadata = {
+            "finish_reason": final_event.get("finishReason"),
+            "citations": final_event["citations"],
+            "documents": final_event["documents"],
+        }
+
+        return ChatGenerationChunk(
+            message=AIMessageChunk(content="", response_metadata=metadata)
+        )
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        """
+        streaming, yields the text as it arrives
+        """
+        response = self._handle_request(messages, is_streaming=True, **kwargs)
+
+        merger = CohereStreamMerger()
+
+        for event in response.data.events():
+            text = merger.add_event(json.loads(event.data))
+
+            if text is not None:
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+                if run_manager and text:
+                    run_manager.on_llm_new_token(text, chunk=chunk)
+
+                yield chunk
+
+        yield self._final_chunk(merger)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """
+        native async streaming, yields the text as it arrives
+        """
+        chat_detail = self._build_chat_detail(
+            messages, is_streaming=True, documents=kwargs.get("documents")
+        )
+
+        merger = CohereStreamMerger()
+
+        async for res in astream_action(
+            self.client, self.service_endpoint, "chat", chat_detail
+        ):
+            text = merger.add_event(res)
+
+            if text is not None:
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+                if run_manager and text:
+                    await run_manager.on_llm_new_token(text, chunk=chunk)
+
+                yield chunk
+
+        yield self._final_chunk(merger)
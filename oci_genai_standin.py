@@ -0,0 +1,375 @@
+"""
+Local stand-in for OCI GenAI (inference)
+
+An HTTP server implementing the APIs we use with GenerativeAiInferenceClient:
+* chat: Cohere and generic (Llama) format, streaming and non streaming
+* embedText
+
+answers and embeddings are fake (deterministic), the goal is to
+benchmark concurrency and retries without the real endpoint:
+latency (lognormal), error rate and 429 rate are configurable.
+
+Requests are not authenticated (signature headers are ignored).
+
+To use it, start the server:
+    python oci_genai_standin.py --port 8088 --throttle-rate 0.1
+and set in config.py:
+    OCI_GENAI_STANDIN_URL = "http://localhost:8088"
+
+or, in process (ex: in a benchmark):
+    server = start_standin_server(StandinSettings(port=8088))
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+API_VERSION = "20231130"
+# as cohere.embed-multilingual-v3.0
+EMBED_DIM = 1024
+
+logger = logging.getLogger("oci_genai_standin")
+
+
+@dataclass
+class StandinSettings:
+    """
+    behaviour of the stand-in server
+
+    latencies are in sec., lognormal: median and sigma
+    """
+
+    port: int = 8088
+    # time to the (first) response
+    chat_latency: float = 1.0
+    embed_latency: float = 0.3
+    latency_sigma: float = 0.5
+    # in streaming, between two events
+    token_delay: float = 0.02
+    # fraction of requests answered with 500
+    error_rate: float = 0.0
+    # fraction of requests answered with 429
+    throttle_rate: float = 0.0
+    # retry-after header (sec.) sent with 429, None: not sent
+    retry_after: float = 1.0
+
+
+def _sample_latency(median, sigma):
+    if median <= 0:
+        return 0.0
+
+    return random.lognormvariate(np.log(median), sigma)
+
+
+def _fake_embedding(text):
+    """
+    deterministic, normalized: same text -> same vector
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+    vector = np.random.default_rng(seed).standard_normal(EMBED_DIM)
+
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def _fake_answer(message):
+    return f"This is a stand-in answer to the request: {message}"
+
+
+def _cohere_citations(text, documents):
+    """
+    a citation of the first document for the first word of the answer
+    """
+    if not documents:
+        return []
+
+    first_word = text.split(" ")[0]
+    doc_id = documents[0].get("id", "doc_0")
+
+    return [
+        {
+            "start": 0,
+            "end": len(first_word),
+            "text": first_word,
+            "documentIds": [doc_id],
+        }
+    ]
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    handles the requests to the stand-in server
+    """
+
+    # set by start_standin_server
+    settings = StandinSettings()
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.send_header("opc-request-id", uuid.uuid4().hex)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def _send_error(self, status, code, message, headers=None):
+        self._send_json(status, {"code": code, "message": message}, headers)
+
+    def _inject_failure(self):
+        """
+        returns True if an error has been sent
+        """
+        settings = self.settings
+        draw = random.random()
+
+        if draw < settings.throttle_rate:
+            headers = {}
+            if settings.retry_after is not None:
+                headers["retry-after"] = str(settings.retry_after)
+
+            self._send_error(429, "TooManyRequests", "Too many requests", headers)
+            return True
+
+        if draw < settings.throttle_rate + settings.error_rate:
+            self._send_error(500, "InternalServerError", "Injected error")
+            return True
+
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if self.path == f"/{API_VERSION}/actions/chat":
+            self._handle_chat(request)
+        elif self.path == f"/{API_VERSION}/actions/embedText":
+            self._handle_embed(request)
+        else:
+            self._send_error(404, "NotFound", f"Unknown path {self.path}")
+
+    def _handle_embed(self, request):
+        time.sleep(
+            _sample_latency(self.settings.embed_latency, self.settings.latency_sigma)
+        )
+
+        if self._inject_failure():
+            return
+
+        inputs = request.get("inputs", [])
+
+        self._send_json(
+            200,
+            {
+                "id": uuid.uuid4().hex,
+                "embeddings": [_fake_embedding(text) for text in inputs],
+                "texts": inputs,
+                "modelId": request["servingMode"].get("modelId"),
+                "modelVersion": "standin",
+            },
+        )
+
+    def _handle_chat(self, request):
+        time.sleep(
+            _sample_latency(self.settings.chat_latency, self.settings.latency_sigma)
+        )
+
+        if self._inject_failure():
+            return
+
+        model_id = request["servingMode"].get("modelId")
+        chat_request = request["chatRequest"]
+
+        if chat_request.get("apiFormat") == "COHERE":
+            text = _fake_answer(chat_request.get("message", ""))
+            documents = chat_request.get("documents") or []
+
+            final = {
+                "apiFormat": "COHERE",
+                "text": text,
+                "citations": _cohere_citations(text, documents),
+                "documents": documents,
+                "finishReason": "COMPLETE",
+            }
+        else:
+            # generic: the last message is the user request
+            messages = chat_request.get("messages", [])
+            content = messages[-1]["content"] if messages else []
+            text = _fake_answer(" ".join(c.get("text", "") for c in content))
+
+            final = {
+                "apiFormat": "GENERIC",
+                "timeCreated": datetime.now(timezone.utc).isoformat(),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "ASSISTANT",
+                            "content": [{"type": "TEXT", "text": text}],
+                        },
+                        "finishReason": "stop",
+                    }
+                ],
+            }
+
+        if chat_request.get("isStream"):
+            self._stream_chat(text, final)
+        else:
+            self._send_json(200, {"modelId": model_id, "chatResponse": final})
+
+    def _stream_chat(self, text, final):
+        """
+        send the answer word by word as SSE events, then the final event
+        """
+        is_cohere = final["apiFormat"] == "COHERE"
+
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("opc-request-id", uuid.uuid4().hex)
+        # no content-length: the end of the stream is the end of the connection
+        self.send_header("connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            piece = word if i == len(words) - 1 else word + " "
+
+            if is_cohere:
+                event = {"apiFormat": "COHERE", "text": piece}
+            else:
+                event = {
+                    "index": 0,
+                    "message": {
+                        "role": "ASSISTANT",
+                        "content": [{"type": "TEXT", "text": piece}],
+                    },
+                }
+
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.settings.token_delay)
+
+        if is_cohere:
+            last_event = final
+        else:
+            last_event = {"index": 0, "finishReason": "stop"}
+
+        self.wfile.write(f"data: {json.dumps(last_event)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def start_standin_server(settings=None):
+    """
+    start the server in a background thread
+
+    returns the server (call shutdown() to stop it)
+    """
+    settings = settings or StandinSettings()
+
+    handler = type("ConfiguredStandinHandler", (StandinHandler,), {})
+    handler.settings = settings
+
+    server = ThreadingHTTPServer(("localhost", settings.port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    logger.info("OCI GenAI stand-in listening on port %d", settings.port)
+
+    return server
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    defaults = StandinSettings()
+
+    parser = argparse.ArgumentParser(description="Local stand-in for OCI GenAI.")
+
+    parser.add_argument("--port", type=int, default=defaults.port)
+    parser.add_argument(
+        "--chat-latency",
+        type=float,
+        default=defaults.chat_latency,
+        help="Median latency of chat (sec.).",
+    )
+    parser.add_argument(
+        "--embed-latency",
+        type=float,
+        default=defaults.embed_latency,
+        help="Median latency of embedText (sec.).",
+    )
+    parser.add_argument(
+        "--latency-sigma",
+        type=float,
+        default=defaults.latency_sigma,
+        help="Sigma of the lognormal latency.",
+    )
+    parser.add_argument(
+        "--token-delay",
+        type=float,
+        default=defaults.token_delay,
+        help="Delay between streaming events (sec.).",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=defaults.error_rate,
+        help="Fraction of requests failing with 500.",
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=defaults.throttle_rate,
+        help="Fraction of requests failing with 429.",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=defaults.retry_after,
+        help="retry-after sent with 429 (sec.).",
+    )
+
+    args = parser.parse_args()
+
+    standin = start_standin_server(
+        StandinSettings(
+            port=args.port,
+            chat_latency=args.chat_latency,
+            embed_latency=args.embed_latency,
+            latency_sigma=args.latency_sigma,
+            token_delay=args.token_delay,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+            retry_after=args.retry_after,
+        )
+    )
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        standin.shutdown()
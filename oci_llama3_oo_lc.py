@@ -7,11 +7,12 @@ inspired by:
 last update: 10/06/2024
 """
 
-from typing import Any, Dict, List, Optional, Iterator
+from typing import Any, AsyncIterator, Dict, List, Optional, Iterator
 import logging
 import json
 
 from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
     CallbackManagerForLLMRun,
 )
 from langchain_core.language_models import BaseChatModel
@@ -23,7 +24,12 @@ from oci.generative_ai_inference.models import GenericChatRequest, ChatDetails
 from oci.generative_ai_inference.models import BaseChatRequest, TextContent, Message
 from oci.generative_ai_inference.models import OnDemandServingMode
 
-from oci_chat_utils import get_generative_ai_dp_client
+from oci_chat_utils import (
+    get_generative_ai_dp_client,
+    call_action,
+    apost_action,
+    astream_action,
+)
 
 logger = logging.getLogger("oci_llama3")
 
@@ -105,24 +111,14 @@ class OCILlama3(BaseChatModel):
             use_session_token=False,
         )
 
-    #
-    # This is called by streaming and non-streaming
-    #
-    def _handle_request(
+    def _build_chat_detail(
         self,
         messages: List[BaseMessage],
         is_streaming: Optional[bool] = False,
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any,
     ):
         """
-        This is called by streaming and non-streaming
-
-        is_streaming: to discriminate if the request comes from stream or generate
+        translate LangChain messages in the request for OCI
         """
-        # prepare the request for OCI Python SDK
-
         # process the list of messages and translate to OCI format
         role_map = {HumanMessage: "USER", AIMessage: "ASSISTANT"}
 
@@ -151,14 +147,32 @@ class OCILlama3(BaseChatModel):
             compartment_id=self.compartment_id,
         )
 
+        return chat_detail
+
+    #
+    # This is called by streaming and non-streaming
+    #
+    def _handle_request(
+        self,
+        messages: List[BaseMessage],
+        is_streaming: Optional[bool] = False,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ):
+        """
+        This is called by streaming and non-streaming
+
+        is_streaming: to discriminate if the request comes from stream or generate
+        """
+        # prepare the request for OCI Python SDK
+        chat_detail = self._build_chat_detail(messages, is_streaming)
+
         #
         # here we call the LLM
         #
-        try:
-            response = self.client.chat(chat_detail)
-        except Exception as e:
-            logger.error("Error in invoke: %s", e)
-            response = None
+        # errors are raised, after retries
+        response = call_action(self.client, "chat", chat_detail)
 
         return response
 
@@ -219,6 +233,59 @@ class OCILlama3(BaseChatModel):
         )
         yield chunk
 
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        native async version of _generate (no executor)
+        """
+        chat_detail = self._build_chat_detail(messages, is_streaming=False)
+
+        response = await apost_action(
+            self.client, self.service_endpoint, "chat", chat_detail, "ChatResult"
+        )
+
+        out_message = AIMessage(
+            content=response.data.chat_response.choices[0].message.content[0].text,
+            response_metadata={},
+        )
+
+        generation = ChatGeneration(message=out_message)
+        return ChatResult(generations=[generation])
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """
+        native async version of _stream
+        """
+        chat_detail = self._build_chat_detail(messages, is_streaming=True)
+
+        async for res in astream_action(
+            self.client, self.service_endpoint, "chat", chat_detail
+        ):
+            if "message" in res.keys():
+                content = res["message"]["content"][0]["text"]
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=content))
+
+                if run_manager:
+                    await run_manager.on_llm_new_token(content, chunk=chunk)
+
+                yield chunk
+
+        chunk = ChatGenerationChunk(
+            message=AIMessageChunk(content="", response_metadata={})
+        )
+        yield chunk
+
     def print_response(self, chat_response):
         """
         helper function to print handling streaming/no_streaming
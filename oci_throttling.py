@@ -0,0 +1,317 @@
+"""
+Throttling for OCI GenAI calls (chat and embed)
+
+for each model:
+* a token bucket limits the rate of requests; the rate is halved
+  when the service answers 429 and slowly recovered after successes
+* failed calls (429, 5xx, network) are retried with exponential backoff
+  and full jitter, honoring retry-after when the service sends it
+* a circuit breaker stops sending requests for a while after
+  too many consecutive failures
+* with a time limit (see deadlines.time_left) there is no wait
+  and no retry beyond it: DeadlineExceeded is raised
+"""
+
+import asyncio
+import random
+import threading
+import time
+
+import httpx
+import requests
+import oci
+
+from deadlines import DeadlineExceeded, time_left
+from utils import get_console_logger
+
+from config import (
+    OCI_RATE_LIMIT,
+    OCI_RATE_LIMIT_BURST,
+    OCI_MODEL_RATE_LIMITS,
+    OCI_MAX_RETRIES,
+    OCI_BACKOFF_BASE,
+    OCI_BACKOFF_MAX,
+    OCI_CIRCUIT_FAILURES,
+    OCI_CIRCUIT_RESET,
+)
+
+logger = get_console_logger()
+
+# the rate is never reduced below this fraction of the configured one
+MIN_RATE_FRACTION = 0.1
+# on success the rate is increased by this fraction of the configured one
+RATE_RECOVERY = 0.05
+
+
+class CircuitOpenError(Exception):
+    """
+    raised, without calling the service, when the circuit is open
+    """
+
+
+class TokenBucket:
+    """
+    token bucket, thread safe
+
+    tokens can go below zero: who takes a token gets the time to wait
+    this way the same bucket works for threads and coroutines
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        take a token, return the seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            self.tokens -= 1
+
+            return max(0.0, -self.tokens / self.rate)
+
+    def slow_down(self):
+        """
+        called on 429
+        """
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+    def speed_up(self):
+        """
+        called on success
+        """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+
+class CircuitBreaker:
+    """
+    opens after n consecutive failures, for reset_timeout sec.
+    then lets requests pass: a success closes it, a failure opens it again
+    """
+
+    def __init__(self, max_failures, reset_timeout):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def check(self, name):
+        """
+        raise CircuitOpenError if the circuit is open
+        """
+        with self.lock:
+            if time.monotonic() < self.open_until:
+                raise CircuitOpenError(f"Circuit open for {name}")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self, name):
+        with self.lock:
+            self.failures += 1
+
+            if self.failures >= self.max_failures:
+                self.open_until = time.monotonic() + self.reset_timeout
+
+                logger.warning(
+                    "Circuit open for %s after %d failures", name, self.failures
+                )
+
+
+def _get_status(e):
+    """
+    the HTTP status of an error, None for network errors
+    """
+    if isinstance(e, oci.exceptions.ServiceError):
+        return e.status
+
+    return None
+
+
+def is_retriable(e):
+    """
+    throttling, server errors and network errors can be retried
+    """
+    if isinstance(
+        e,
+        (
+            oci.exceptions.RequestException,
+            oci.exceptions.ConnectTimeout,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            httpx.TransportError,
+        ),
+    ):
+        return True
+
+    status = _get_status(e)
+
+    return status is not None and (status == 429 or status >= 500)
+
+
+def get_retry_after(e):
+    """
+    the value of the retry-after header (sec.), if any
+    """
+    headers = getattr(e, "headers", None) or {}
+
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt, retry_after=None):
+    """
+    exponential backoff with full jitter
+
+    never less than what the service asked for
+    """
+    delay = random.uniform(0, min(OCI_BACKOFF_MAX, OCI_BACKOFF_BASE * 2**attempt))
+
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+class ModelThrottle:
+    """
+    rate limiting, retries and circuit breaking for a model
+    """
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+
+        rate = OCI_MODEL_RATE_LIMITS.get(model_id, OCI_RATE_LIMIT)
+
+        self.bucket = TokenBucket(rate, OCI_RATE_LIMIT_BURST)
+        self.breaker = CircuitBreaker(OCI_CIRCUIT_FAILURES, OCI_CIRCUIT_RESET)
+
+    def _on_error(self, e, attempt):
+        """
+        return the seconds to wait before retrying, or raise
+        """
+        if not is_retriable(e):
+            logger.error("Error calling %s: %s", self.model_id, e)
+            raise e
+
+        left = time_left()
+
+        if _get_status(e) == 429:
+            # throttled: the service is fine, we're too fast
+            self.bucket.slow_down()
+        elif left is not None and left <= 0:
+            # our time limit (the HTTP timeout) is over, not a failure of the service
+            raise DeadlineExceeded(f"No time left calling {self.model_id}") from e
+        else:
+            self.breaker.record_failure(self.model_id)
+
+        if attempt >= OCI_MAX_RETRIES:
+            logger.error("Error calling %s, no more retries: %s", self.model_id, e)
+            raise e
+
+        delay = get_backoff(attempt, get_retry_after(e))
+
+        if left is not None and delay >= left:
+            raise DeadlineExceeded(
+                f"No time left to retry {self.model_id} in {delay:.1f} sec."
+            ) from e
+
+        logger.warning(
+            "Retrying %s in %.1f sec. (attempt %d): %s",
+            self.model_id,
+            delay,
+            attempt + 1,
+            e,
+        )
+
+        return delay
+
+    def _reserve(self):
+        """
+        take a token, return the seconds to wait before using it
+        """
+        delay = self.bucket.reserve()
+
+        left = time_left()
+        if left is not None and delay >= left:
+            raise DeadlineExceeded(f"No time left to call {self.model_id}")
+
+        return delay
+
+    def _on_success(self):
+        self.breaker.record_success()
+        self.bucket.speed_up()
+
+    def call(self, func, *args, **kwargs):
+        """
+        call func, with throttling
+        """
+        attempt = 0
+
+        while True:
+            self.breaker.check(self.model_id)
+            time.sleep(self._reserve())
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                time.sleep(self._on_error(e, attempt))
+                attempt += 1
+                continue
+
+            self._on_success()
+
+            return result
+
+    async def acall(self, coro_func, *args, **kwargs):
+        """
+        async version of call, coro_func is an async function
+        """
+        attempt = 0
+
+        while True:
+            self.breaker.check(self.model_id)
+            await asyncio.sleep(self._reserve())
+
+            try:
+                result = await coro_func(*args, **kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, attempt))
+                attempt += 1
+                continue
+
+            self._on_success()
+
+            return result
+
+
+_THROTTLES = {}
+_THROTTLES_LOCK = threading.Lock()
+
+
+def get_throttle(model_id):
+    """
+    return the throttle for the model (one for each model, in the process)
+    """
+    with _THROTTLES_LOCK:
+        throttle = _THROTTLES.get(model_id)
+
+        if throttle is None:
+            throttle = ModelThrottle(model_id)
+            _THROTTLES[model_id] = throttle
+
+    return throttle
@@ -3,10 +3,22 @@ Add extension for using OpenSearch as Vector Store
 """
 
 from opensearchpy import OpenSearch
+from langchain_core.documents import Document
+from langchain_community.vectorstores.opensearch_vector_search import (
+    _default_text_mapping,
+)
+
+from utils import get_console_logger
 
 from config import OPENSEARCH_SHARED_PARAMS, OPENSEARCH_URL
 from config_private import OPENSEARCH_USER, OPENSEARCH_PWD
 
+logger = get_console_logger()
+
+# EMBEDDINGS_BITS supported: with 16 vectors are stored as fp16
+# (faiss scalar quantizer), query vectors are encoded by OpenSearch
+OPENSEARCH_VECTOR_BITS = [32, 16]
+
 
 def is_embedding(field_mapping):
     """
@@ -85,3 +97,107 @@ class OpenSearchRFX:
             books_list.append(row[0])
 
         return books_list
+
+    @classmethod
+    def create_index(cls, client, index_name, embedding_dim, bits):
+        """
+        create the index, if it doesn't exist, for vectors with the given bits
+
+        with 32 bits nothing is done: LangChain creates the index
+        when the first docs are added
+        """
+        if bits not in OPENSEARCH_VECTOR_BITS:
+            raise ValueError(
+                f"EMBEDDINGS_BITS for OPENSEARCH must be one of "
+                f"{OPENSEARCH_VECTOR_BITS}, not {bits}"
+            )
+
+        if bits == 32 or client.indices.exists(index=index_name):
+            return
+
+        # as LangChain does (faiss engine), with the fp16 encoder
+        mapping = _default_text_mapping(embedding_dim, engine="faiss")
+        method = mapping["mappings"]["properties"]["vector_field"]["method"]
+        method["parameters"]["encoder"] = {"name": "sq", "parameters": {"type": "fp16"}}
+
+        client.indices.create(index=index_name, body=mapping)
+
+    @classmethod
+    def get_collection_version(cls, collection_name):
+        """
+        a fingerprint of the content of the index:
+        it changes when documents are added or removed
+        """
+        client = cls._get_client()
+
+        stats = client.indices.stats(index=collection_name, metric="docs,indexing")
+        primaries = stats["indices"][collection_name]["primaries"]
+
+        n_docs = primaries["docs"]["count"]
+        n_indexed = primaries["indexing"]["index_total"]
+        n_deleted = primaries["indexing"]["delete_total"]
+
+        return f"{n_docs}-{n_indexed}-{n_deleted}"
+
+    @classmethod
+    def msearch_by_vectors(cls, v_store, embeddings, k):
+        """
+        search for many query vectors with a single _msearch request
+
+        v_store: the OpenSearchVectorSearch
+        returns a list of docs for each embedding
+        (fields are the ones used by the LangChain implementation)
+        a query failed in the _msearch is done again with a single search
+        """
+        body = []
+        for embedding in embeddings:
+            body.append({"index": v_store.index_name})
+            body.append(
+                {
+                    "size": k,
+                    "query": {"knn": {"vector_field": {"vector": embedding, "k": k}}},
+                }
+            )
+
+        response = v_store.client.msearch(body=body)
+
+        results = []
+        for embedding, item in zip(embeddings, response["responses"]):
+            if item.get("error"):
+                logger.warning(
+                    "Error in msearch (status %s): %s, retrying with search",
+                    item.get("status"),
+                    item["error"],
+                )
+                results.append(v_store.similarity_search_by_vector(embedding, k=k))
+                continue
+
+            docs = [
+                Document(
+                    page_content=hit["_source"]["text"],
+                    metadata=hit["_source"].get("metadata", {}),
+                )
+                for hit in item["hits"]["hits"]
+            ]
+            results.append(docs)
+
+        return results
+
+    @classmethod
+    def keyword_search(cls, v_store, query, k):
+        """
+        lexical search (BM25) on the text field
+
+        v_store: the OpenSearchVectorSearch
+        """
+        body = {"size": k, "query": {"match": {"text": query}}}
+
+        response = v_store.client.search(index=v_store.index_name, body=body)
+
+        return [
+            Document(
+                page_content=hit["_source"]["text"],
+                metadata=hit["_source"].get("metadata", {}),
+            )
+            for hit in response["hits"]["hits"]
+        ]
@@ -3,22 +3,477 @@ Extensions to Oracle VS
 """
 
 import os
+import re
+import array
+import asyncio
+import json
+import weakref
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import oracledb
 from oracledb import Connection
 
-from langchain_community.vectorstores.oraclevs import OracleVS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores.oraclevs import (
+    OracleVS,
+    _get_distance_function,
+    _table_exists,
+)
+from langchain_community.vectorstores.utils import DistanceStrategy
 
 from utils import get_console_logger, debug_bool
 
+from config import EMBEDDINGS_BITS
+
 logger = get_console_logger()
 
 VERBOSE = debug_bool(os.environ.get("DEBUG", "False"))
 
+# max num. of query vectors in a single SQL statement
+SEARCH_BATCH_SIZE = 20
+
+# max num. of terms in the Oracle Text query
+MAX_TEXT_QUERY_TERMS = 30
+
+# formats of the vectors, by EMBEDDINGS_BITS (23ai has no FLOAT16)
+VECTOR_FORMATS = {32: "FLOAT32", 8: "INT8"}
+INT8_MAX = 127
+
+# the declared format of a VECTOR column, as described by oracledb
+DB_VECTOR_FORMATS = {
+    oracledb.VECTOR_FORMAT_FLOAT32: "FLOAT32",
+    oracledb.VECTOR_FORMAT_FLOAT64: "FLOAT64",
+    oracledb.VECTOR_FORMAT_INT8: "INT8",
+}
+
+
+def bits_to_vector_format(bits: int) -> str:
+    """
+    the 23ai vector format for EMBEDDINGS_BITS
+    """
+    if bits not in VECTOR_FORMATS:
+        raise ValueError(
+            f"EMBEDDINGS_BITS for 23AI must be one of {list(VECTOR_FORMATS)}, not {bits}"
+        )
+
+    return VECTOR_FORMATS[bits]
+
+
+def quantize_int8(embedding: List[float]) -> List[int]:
+    """
+    scale the vector so that the max abs value is INT8_MAX and round
+    the scale is per vector: the cosine distance doesn't change
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+
+    max_abs = float(np.max(np.abs(vector))) or 1.0
+
+    return np.rint(vector * (INT8_MAX / max_abs)).astype(np.int8).tolist()
+
+
+def make_text_query(query: str) -> str:
+    """
+    translate a question in an Oracle Text query
+    each term is escaped with {} and terms are combined with ACCUM
+    (docs containing more terms get higher score)
+    """
+    terms = [term for term in re.findall(r"\w[\w\-\.]*\w", query) if len(term) > 1]
+
+    return " ACCUM ".join(f"{{{term}}}" for term in terms[:MAX_TEXT_QUERY_TERMS])
+
 
 class OracleVS4RFX(OracleVS):
     """
     This class extends OracleVS and has been defined to add utility methods
+
+    async_pool_factory: creates an oracledb AsyncConnectionPool, used for
+        async search (a pool for each event loop, see get_async_pool)
+    search_pool: an oracledb ConnectionPool, used for vector search
+        (so that searches in parallel don't share the connection)
+    keyword_pool: an oracledb ConnectionPool, used for keyword search
+        (so that it runs in parallel with the vector search)
+
+    if the table has INT8 vectors (see create_table) stored and query vectors
+    are quantized (see quantize_int8); only with COSINE distance
     """
 
+    def __init__(
+        self,
+        client: Connection,
+        embedding_function: Union[Callable[[str], List[float]], Embeddings],
+        table_name: str,
+        distance_strategy: DistanceStrategy = DistanceStrategy.EUCLIDEAN_DISTANCE,
+        query: Optional[str] = "What is a Oracle database",
+        params: Optional[Dict[str, Any]] = None,
+        async_pool_factory=None,
+        search_pool=None,
+        keyword_pool=None,
+    ):
+        # new tables get the format in config (EMBEDDINGS_BITS)
+        self.vector_format = bits_to_vector_format(EMBEDDINGS_BITS)
+
+        if not _table_exists(client, table_name):
+            # created here: OracleVS would create it with FLOAT32 vectors
+            self.embedding_function = embedding_function
+            self.query = query
+
+            self.create_table(
+                client, table_name, self.get_embedding_dimension(), self.vector_format
+            )
+
+        super().__init__(
+            client, embedding_function, table_name, distance_strategy, query, params
+        )
+
+        self.async_pool_factory = async_pool_factory
+        # event loop -> async pool: a pool works only in its loop
+        self.async_pools = weakref.WeakKeyDictionary()
+        self.search_pool = search_pool
+        self.keyword_pool = keyword_pool
+
+        # an existing table keeps the format it has been created with
+        self.vector_format = (
+            self.get_vector_format(client, table_name) or self.vector_format
+        )
+
+        if (
+            self.vector_format == "INT8"
+            and self.distance_strategy != DistanceStrategy.COSINE
+        ):
+            raise ValueError("INT8 vectors are supported only with COSINE distance")
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        quantized if the table has INT8 vectors
+        (integer values: stored exactly by the insert in add_texts)
+        """
+        embeddings = super()._embed_documents(texts)
+
+        if self.vector_format == "INT8":
+            embeddings = [quantize_int8(embedding) for embedding in embeddings]
+
+        return embeddings
+
+    def _to_db_vector(self, embedding: List[float]) -> array.array:
+        """
+        the query vector to bind, in the format of the table
+        """
+        if self.vector_format == "INT8":
+            return array.array("b", quantize_int8(embedding))
+
+        return array.array("f", embedding)
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """
+        as in OracleVS, with the query vector in the format of the table
+        and a connection from the search pool
+        """
+        if self.vector_format != "INT8" and self.search_pool is None:
+            return super().similarity_search_by_vector_with_relevance_scores(
+                embedding, k, filter, **kwargs
+            )
+
+        distance = _get_distance_function(self.distance_strategy)
+
+        query = f"""
+                SELECT text, metadata,
+                vector_distance(embedding, :embedding, {distance}) as distance
+                FROM {self.table_name}
+                ORDER BY distance
+                FETCH APPROX FIRST {k} ROWS ONLY
+                """
+
+        docs_and_scores = []
+
+        with self._acquire_connection(self.search_pool) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, embedding=self._to_db_vector(embedding))
+
+                for text, metadata, distance in cursor.fetchall():
+                    metadata = json.loads(
+                        self._get_clob_value(metadata) if metadata is not None else "{}"
+                    )
+
+                    if filter and not all(
+                        metadata.get(key) in value for key, value in filter.items()
+                    ):
+                        continue
+
+                    text = self._get_clob_value(text) if text is not None else ""
+
+                    docs_and_scores.append(
+                        (Document(page_content=text, metadata=metadata), distance)
+                    )
+
+        return docs_and_scores
+
+    @staticmethod
+    async def _aget_lob_value(value):
+        """
+        with async connections LOBs must be read with await
+        """
+        if value is None or isinstance(value, (str, dict)):
+            return value
+        if hasattr(value, "read"):
+            return await value.read()
+        return str(value)
+
+    def get_async_pool(self):
+        """
+        the async pool for the running event loop, created on first use
+        """
+        loop = asyncio.get_running_loop()
+
+        async_pool = self.async_pools.get(loop)
+
+        if async_pool is None:
+            async_pool = self.async_pool_factory()
+            self.async_pools[loop] = async_pool
+
+        return async_pool
+
+    async def asimilarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        **kwargs,
+    ) -> List[Document]:
+        """
+        async search using the async pool, the event loop is not blocked
+
+        filter: as in similarity_search_by_vector, applied to the k docs found
+        """
+        if self.async_pool_factory is None:
+            # no async pool, fallback on executor
+            return await super().asimilarity_search_by_vector(
+                embedding, k, filter=filter, **kwargs
+            )
+
+        distance = _get_distance_function(self.distance_strategy)
+
+        query = f"""
+                SELECT id, text, metadata,
+                vector_distance(embedding, :embedding, {distance}) as distance
+                FROM {self.table_name}
+                ORDER BY distance
+                FETCH APPROX FIRST {k} ROWS ONLY
+                """
+
+        docs = []
+
+        async with self.get_async_pool().acquire() as connection:
+            with connection.cursor() as cursor:
+                await cursor.execute(query, embedding=self._to_db_vector(embedding))
+
+                rows = await cursor.fetchall()
+
+            for row in rows:
+                text = await self._aget_lob_value(row[1])
+                metadata = await self._aget_lob_value(row[2])
+
+                if not isinstance(metadata, dict):
+                    metadata = json.loads(metadata) if metadata else {}
+
+                if filter and not all(
+                    metadata.get(key) in value for key, value in filter.items()
+                ):
+                    continue
+
+                docs.append(Document(page_content=text or "", metadata=metadata))
+
+        return docs
+
+    def similarity_search_by_vector_batch(
+        self, embeddings: List[List[float]], k: int = 4
+    ) -> List[List[Document]]:
+        """
+        search for many query vectors with a single SQL statement
+        (one sub query for each vector, in UNION ALL)
+
+        returns a list of docs for each embedding
+        """
+        distance = _get_distance_function(self.distance_strategy)
+
+        results = [[] for _ in embeddings]
+
+        for start in range(0, len(embeddings), SEARCH_BATCH_SIZE):
+            batch = embeddings[start : start + SEARCH_BATCH_SIZE]
+
+            sub_queries = [
+                f"""
+                SELECT * FROM (
+                    SELECT {start + i} AS qid, text, metadata,
+                    vector_distance(embedding, :e{i}, {distance}) as distance
+                    FROM {self.table_name}
+                    ORDER BY distance
+                    FETCH APPROX FIRST {k} ROWS ONLY
+                )
+                """
+                for i in range(len(batch))
+            ]
+            query = " UNION ALL ".join(sub_queries) + " ORDER BY qid, distance"
+
+            params = {f"e{i}": self._to_db_vector(emb) for i, emb in enumerate(batch)}
+
+            with self._acquire_connection(self.search_pool) as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(query, params)
+
+                    for qid, text, metadata, _ in cursor.fetchall():
+                        metadata = json.loads(
+                            self._get_clob_value(metadata)
+                            if metadata is not None
+                            else "{}"
+                        )
+                        text = self._get_clob_value(text) if text is not None else ""
+
+                        results[qid].append(
+                            Document(page_content=text, metadata=metadata)
+                        )
+
+        return results
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs
+    ) -> List[Document]:
+        """
+        async similarity search: embedding and search are awaited
+
+        filter: see asimilarity_search_by_vector
+        """
+        if isinstance(self.embedding_function, Embeddings):
+            embedding = await self.embedding_function.aembed_query(query)
+        else:
+            # a function (supported by OracleVS), run in the executor
+            embedding = await asyncio.get_running_loop().run_in_executor(
+                None, self.embedding_function, query
+            )
+
+        return await self.asimilarity_search_by_vector(
+            embedding, k, filter=filter, **kwargs
+        )
+
+    def _acquire_connection(self, pool):
+        """
+        a connection from the pool, or the one of the vector store
+        """
+        if pool is None:
+            return nullcontext(self.client)
+
+        return pool.acquire()
+
+    def keyword_search(self, query: str, k: int = 4) -> List[Document]:
+        """
+        lexical search with Oracle Text (CONTAINS) on the text column
+        needs the text index (see create_text_index)
+        """
+        text_query = make_text_query(query)
+
+        if not text_query:
+            return []
+
+        sql = f"""
+              SELECT text, metadata
+              FROM {self.table_name}
+              WHERE CONTAINS(text, :text_query, 1) > 0
+              ORDER BY SCORE(1) DESC
+              FETCH FIRST {k} ROWS ONLY
+              """
+
+        docs = []
+
+        try:
+            with self._acquire_connection(self.keyword_pool) as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, text_query=text_query)
+
+                    for text, metadata in cursor.fetchall():
+                        metadata = json.loads(
+                            self._get_clob_value(metadata)
+                            if metadata is not None
+                            else "{}"
+                        )
+                        text = self._get_clob_value(text) if text is not None else ""
+
+                        docs.append(Document(page_content=text, metadata=metadata))
+        except oracledb.Error as e:
+            # ex: the text index has not been created
+            logger.error("Error in keyword_search: %s", e)
+
+        return docs
+
+    @classmethod
+    def create_text_index(cls, connection: Connection, collection_name: str):
+        """
+        create the Oracle Text index used for keyword search
+        """
+        sql = f"""
+              CREATE INDEX {collection_name}_TEXT_IDX
+              ON {collection_name}(text)
+              INDEXTYPE IS CTXSYS.CONTEXT
+              PARAMETERS ('SYNC (ON COMMIT)')
+              """
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+        logger.info("Created text index on %s", collection_name)
+
+    @classmethod
+    def create_table(
+        cls,
+        connection: Connection,
+        collection_name: str,
+        embedding_dim: int,
+        vector_format: str = "FLOAT32",
+    ):
+        """
+        create the table for a collection, as OracleVS does
+        but with the given format of the vectors (OracleVS uses FLOAT32)
+        """
+        sql = f"""
+              CREATE TABLE {collection_name} (
+                  id RAW(16) DEFAULT SYS_GUID() PRIMARY KEY,
+                  text CLOB,
+                  metadata CLOB,
+                  embedding VECTOR({embedding_dim}, {vector_format})
+              )
+              """
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+        logger.info("Created table %s with %s vectors", collection_name, vector_format)
+
+    @classmethod
+    def get_vector_format(cls, connection: Connection, collection_name: str):
+        """
+        the declared format of the vectors in the collection
+        (from the describe of the column, no row is read),
+        None if the format is flexible (VECTOR(*, *))
+        """
+        query = f"""
+                SELECT embedding
+                FROM {collection_name}
+                WHERE 1 = 0
+                """
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+
+            vector_format = cursor.description[0].vector_format
+
+        return DB_VECTOR_FORMATS.get(vector_format)
+
     @classmethod
     def list_collections(cls, connection: Connection):
         """
@@ -67,6 +522,23 @@ class OracleVS4RFX(OracleVS):
 
         return list_books
 
+    @classmethod
+    def get_collection_version(cls, connection: Connection, collection_name: str):
+        """
+        a fingerprint of the content of the collection:
+        it changes when documents are added or removed
+        """
+        query = f"""
+                SELECT COUNT(*), NVL(SUM(ORA_HASH(id)), 0)
+                FROM {collection_name}
+                """
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+
+            n_rows, ids_hash = cursor.fetchone()
+
+        return f"{n_rows}-{ids_hash}"
+
     @classmethod
     def delete_documents(
         cls, connection: Connection, collection_name: str, doc_names: list
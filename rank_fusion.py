@@ -0,0 +1,42 @@
+"""
+Reciprocal Rank Fusion (RRF)
+
+to merge lists of documents produced by different searches
+see: https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+"""
+
+# the constant k in RRF formula
+RRF_K = 60
+
+
+def get_doc_key(doc):
+    """
+    identify the same chunk returned by different searches
+    """
+    return (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
+
+
+def reciprocal_rank_fusion(list_of_docs_lists, top_n=None, k=RRF_K):
+    """
+    list_of_docs_lists: list of ranked lists of Document
+    top_n: max num. of docs returned (None: all)
+
+    returns the fused list, ordered by RRF score
+    """
+    scores = {}
+    docs_by_key = {}
+
+    for docs in list_of_docs_lists:
+        for rank, doc in enumerate(docs, start=1):
+            key = get_doc_key(doc)
+
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            # keep the first occurrence
+            docs_by_key.setdefault(key, doc)
+
+    sorted_keys = sorted(scores.keys(), key=lambda key: scores[key], reverse=True)
+
+    if top_n is not None:
+        sorted_keys = sorted_keys[:top_n]
+
+    return [docs_by_key[key] for key in sorted_keys]
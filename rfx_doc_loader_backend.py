@@ -12,6 +12,7 @@ from oraclevs_4_rfx import OracleVS4RFX
 from translations import translations
 from factory_rfx import get_embed_model
 from utils import get_console_logger
+from answer_cache import get_answer_cache
 
 from chunk_index_utils import (
     load_book_and_split,
@@ -126,6 +127,10 @@ def load_uploaded_file_in_vector_store(
 
         result_status = "OK"
 
+    if result_status == "OK":
+        # the content of the collection has changed
+        get_answer_cache().invalidate_collection(collection_name)
+
     return result_status
 
 
@@ -138,3 +143,6 @@ def delete_documents_in_collection(collection_name, doc_names):
 
         logger.info("Delete docs: %s in collection %s", doc_names, collection_name)
         OracleVS4RFX.delete_documents(conn, collection_name, doc_names)
+
+        # the content of the collection has changed
+        get_answer_cache().invalidate_collection(collection_name)
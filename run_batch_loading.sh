@@ -1,2 +1 @@
-python batch_loading.py $1 $2
-
+python batch_loading.py $1 $2 $3
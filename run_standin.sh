@@ -0,0 +1 @@
+python oci_genai_standin.py --port 8088 --chat-latency 1.0 --embed-latency 0.3 --throttle-rate 0.05
@@ -0,0 +1,129 @@
+"""
+Single flight: identical requests in flight at the same time
+are sent only once
+
+the first caller (the leader) does the call, the others wait
+and get the same result (or the same exception)
+"""
+
+import asyncio
+import threading
+
+from utils import get_console_logger
+
+logger = get_console_logger()
+
+
+class _Call:
+    """
+    a call in flight
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.n_waiters = 0
+
+
+class SingleFlight:
+    """
+    thread safe, for sync and async callers
+    """
+
+    def __init__(self):
+        self.calls = {}
+        # for async callers, keyed by (event loop, key)
+        self.futures = {}
+        self.lock = threading.Lock()
+
+        self.n_calls = 0
+        self.n_shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        call func, unless a call with the same key is in flight
+        """
+        with self.lock:
+            call = self.calls.get(key)
+
+            if call is not None:
+                call.n_waiters += 1
+                self.n_shared += 1
+                is_leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.n_calls += 1
+                is_leader = True
+
+        if not is_leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+            call.done.set()
+
+            if call.n_waiters > 0:
+                logger.info("Single flight: result shared by %d calls", call.n_waiters)
+
+        return call.result
+
+    async def ado(self, key, coro_func, *args, **kwargs):
+        """
+        async version of do, coro_func is an async function
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+
+        with self.lock:
+            future = self.futures.get(loop_key)
+
+            if future is not None:
+                self.n_shared += 1
+                is_leader = False
+            else:
+                future = loop.create_future()
+                self.futures[loop_key] = future
+                self.n_calls += 1
+                is_leader = True
+
+        if not is_leader:
+            # shield: a cancelled waiter must not cancel the call
+            return await asyncio.shield(future)
+
+        try:
+            result = await coro_func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark it as retrieved, if nobody is waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.futures[loop_key]
+
+        return result
+
+    def get_stats(self):
+        """
+        num. of calls done and num. of calls that shared a result
+        """
+        return {"calls": self.n_calls, "shared": self.n_shared}
@@ -0,0 +1,32 @@
+"""
+the modules are in the root of the repo
+
+they read the credentials from config_private (not in the repo):
+if it's missing, placeholders are used (the tests don't call the services)
+"""
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config_private  # noqa: F401
+except ImportError:
+    config_private = types.ModuleType("config_private")
+
+    for name in (
+        "COMPARTMENT_ID",
+        "COHERE_API_KEY",
+        "LANGSMITH_API_KEY",
+        "OPENSEARCH_USER",
+        "OPENSEARCH_PWD",
+        "DB_USER",
+        "DB_PWD",
+        "DB_HOST_IP",
+        "DB_SERVICE",
+    ):
+        setattr(config_private, name, "test")
+
+    sys.modules["config_private"] = config_private
@@ -0,0 +1,124 @@
+"""
+Tests for answer_cache
+"""
+
+import pytest
+
+from answer_cache import AnswerCache, make_scope
+
+SCOPE = make_scope("coll1", 1, "cohere.command-r-plus", "en", "preamble")
+PAYLOAD = {"text": "the answer"}
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "answers.db")
+
+
+def test_scope_depends_on_all_the_params():
+    scopes = {
+        SCOPE,
+        make_scope("coll2", 1, "cohere.command-r-plus", "en", "preamble"),
+        make_scope("coll1", 2, "cohere.command-r-plus", "en", "preamble"),
+        make_scope("coll1", 1, "meta.llama-3-70b-instruct", "en", "preamble"),
+        make_scope("coll1", 1, "cohere.command-r-plus", "it", "preamble"),
+        make_scope("coll1", 1, "cohere.command-r-plus", "en", "other preamble"),
+    }
+
+    assert len(scopes) == 6
+    assert SCOPE.startswith("coll1:")
+
+
+def test_empty_cache_is_a_miss(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.9)
+
+    assert cache.lookup(SCOPE, [1.0, 0.0]) == (None, 0.0)
+    assert cache.get_stats() == {"hits": 0, "misses": 1}
+
+
+def test_similar_question_is_a_hit(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.9)
+
+    cache.save("coll1", SCOPE, "question", [1.0, 0.0], PAYLOAD)
+
+    payload, similarity = cache.lookup(SCOPE, [2.0, 0.1])
+
+    assert payload == PAYLOAD
+    assert similarity > 0.99
+    assert cache.get_stats() == {"hits": 1, "misses": 0}
+
+
+def test_below_threshold_is_a_miss(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.9)
+
+    cache.save("coll1", SCOPE, "question", [1.0, 0.0], PAYLOAD)
+
+    payload, similarity = cache.lookup(SCOPE, [1.0, 1.0])
+
+    assert payload is None
+    assert similarity == pytest.approx(0.7071, abs=1e-3)
+
+
+def test_the_most_similar_is_returned(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.5)
+
+    cache.save("coll1", SCOPE, "q1", [1.0, 0.0, 0.0], {"text": "a1"})
+    cache.save("coll1", SCOPE, "q2", [0.0, 1.0, 0.0], {"text": "a2"})
+
+    payload, _ = cache.lookup(SCOPE, [0.1, 1.0, 0.0])
+
+    assert payload == {"text": "a2"}
+
+
+def test_answers_are_not_shared_between_scopes(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.9)
+    other_scope = make_scope("coll1", 2, "cohere.command-r-plus", "en", "preamble")
+
+    cache.save("coll1", SCOPE, "question", [1.0, 0.0], PAYLOAD)
+
+    assert cache.lookup(other_scope, [1.0, 0.0])[0] is None
+
+
+def test_answers_are_persisted(cache_path):
+    AnswerCache(cache_path, threshold=0.9).save(
+        "coll1", SCOPE, "question", [1.0, 0.0], PAYLOAD
+    )
+
+    assert AnswerCache(cache_path, threshold=0.9).lookup(SCOPE, [1.0, 0.0])[0] == (
+        PAYLOAD
+    )
+
+
+def test_invalidate_collection(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.9)
+    scope2 = make_scope("coll2", 1, "cohere.command-r-plus", "en", "preamble")
+
+    cache.save("coll1", SCOPE, "question", [1.0, 0.0], PAYLOAD)
+    cache.save("coll2", scope2, "question", [1.0, 0.0], PAYLOAD)
+    # loaded in memory
+    cache.lookup(SCOPE, [1.0, 0.0])
+
+    cache.invalidate_collection("coll1")
+
+    assert cache.lookup(SCOPE, [1.0, 0.0])[0] is None
+    assert cache.lookup(scope2, [1.0, 0.0])[0] == PAYLOAD
+
+
+def test_answer_deleted_by_another_process_is_a_miss(cache_path):
+    cache = AnswerCache(cache_path, threshold=0.9)
+    other = AnswerCache(cache_path, threshold=0.9)
+
+    cache.save("coll1", SCOPE, "question", [1.0, 0.0], PAYLOAD)
+    # loaded in memory
+    assert cache.lookup(SCOPE, [1.0, 0.0])[0] == PAYLOAD
+
+    other.invalidate_collection("coll1")
+
+    assert cache.lookup(SCOPE, [1.0, 0.0])[0] is None
+    # and dropped from the index
+    assert cache.index[SCOPE] == ([], None)
+
+    # a new answer can be saved and found
+    cache.save("coll1", SCOPE, "question", [1.0, 0.0], {"text": "new"})
+
+    assert cache.lookup(SCOPE, [1.0, 0.0])[0] == {"text": "new"}
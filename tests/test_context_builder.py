@@ -0,0 +1,99 @@
+"""
+Tests for context_builder
+"""
+
+import pytest
+from langchain_core.documents import Document
+
+import context_builder
+from context_builder import (
+    CHARS_PER_TOKEN,
+    DOC_OVERHEAD_TOKENS,
+    PROMPT_OVERHEAD_TOKENS,
+    TokenCountCache,
+    count_tokens,
+    fit_docs_to_budget,
+    get_context_budget,
+)
+
+MODEL = "test.model"
+WINDOW = 1000
+
+
+@pytest.fixture(autouse=True)
+def small_window(monkeypatch):
+    monkeypatch.setattr(context_builder, "MODEL_CONTEXT_WINDOWS", {MODEL: WINDOW})
+    monkeypatch.setattr(context_builder, "MAX_TOKENS", 200)
+    monkeypatch.setattr(context_builder, "MAX_CONTEXT_TOKENS", None)
+    monkeypatch.setattr(context_builder, "TOKENIZER_PATH", None)
+
+
+def make_doc(n_tokens, page):
+    """
+    a doc of n_tokens (estimated)
+    """
+    return Document(
+        page_content="x" * (n_tokens * CHARS_PER_TOKEN),
+        metadata={"source": "a.pdf", "page": page},
+    )
+
+
+def test_count_tokens_is_estimated_from_length():
+    assert count_tokens("") == 0
+    assert count_tokens("x" * CHARS_PER_TOKEN) == 1
+    assert count_tokens("x" * (CHARS_PER_TOKEN + 1)) == 2
+
+
+def test_budget_leaves_room_for_prompt_and_answer():
+    budget = WINDOW - 200 - PROMPT_OVERHEAD_TOKENS
+
+    assert get_context_budget(MODEL) == budget
+    assert get_context_budget(MODEL, "x" * 30 * CHARS_PER_TOKEN) == budget - 30
+
+
+def test_budget_unknown_model_and_cap(monkeypatch):
+    assert get_context_budget("other.model") == (
+        context_builder.DEFAULT_CONTEXT_WINDOW - 200 - PROMPT_OVERHEAD_TOKENS
+    )
+
+    monkeypatch.setattr(context_builder, "MAX_CONTEXT_TOKENS", 100)
+    assert get_context_budget(MODEL) == 100
+
+    # never negative
+    assert get_context_budget(MODEL, "x" * WINDOW * CHARS_PER_TOKEN) == 0
+
+
+def test_docs_that_fit_are_kept_in_order():
+    docs = [make_doc(100, page) for page in range(3)]
+
+    kept, dropped = fit_docs_to_budget(docs, MODEL)
+
+    assert kept == docs
+    assert dropped == []
+
+
+def test_doc_too_large_is_dropped_smaller_kept():
+    # budget: 700 tokens, each doc costs its tokens + DOC_OVERHEAD_TOKENS
+    large = make_doc(400, 1)
+    docs = [make_doc(300, 0), large, make_doc(100, 2)]
+
+    kept, dropped = fit_docs_to_budget(docs, MODEL)
+
+    assert kept == [docs[0], docs[2]]
+    assert dropped == [large]
+    assert 300 + 100 + 2 * DOC_OVERHEAD_TOKENS <= get_context_budget(MODEL)
+
+
+def test_token_counts_are_cached_per_chunk():
+    cache = TokenCountCache(max_items=2)
+    docs = [make_doc(10, page) for page in range(3)]
+
+    for doc in docs:
+        assert cache.get_doc_tokens(doc) == 10
+
+    # LRU: the first has been evicted
+    assert len(cache.counts) == 2
+
+    # the same chunk (source, page, text) has the same count
+    assert cache.get_doc_tokens(make_doc(10, 2)) == 10
+    assert len(cache.counts) == 2
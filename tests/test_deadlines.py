@@ -0,0 +1,188 @@
+"""
+Tests for deadlines
+"""
+
+import itertools
+import threading
+import time
+
+import pytest
+
+from deadlines import (
+    HEDGE_MIN_SAMPLES,
+    Deadline,
+    DeadlineExceeded,
+    cap_timeout,
+    get_latency_tracker,
+    hedged_call,
+    mark_service_call,
+    run_with_timeout,
+    time_left,
+    time_limit,
+)
+
+SPLIT = {"embed": 0.2, "search": 0.3, "llm": 0.5}
+
+_NAMES = itertools.count()
+
+
+def new_tracker(latency=None):
+    """
+    a tracker for a new kind of call, with HEDGE_MIN_SAMPLES latencies
+    """
+    name = f"test-{next(_NAMES)}"
+    tracker = get_latency_tracker(name)
+
+    if latency is not None:
+        for _ in range(HEDGE_MIN_SAMPLES):
+            tracker.record(latency)
+
+    return name, tracker
+
+
+def service_call(result, delay=0.0):
+    mark_service_call()
+    time.sleep(delay)
+
+    return result
+
+
+def test_stage_timeout_is_the_share_of_the_time_left():
+    deadline = Deadline(10.0, SPLIT)
+
+    assert deadline.stage_timeout("embed") == pytest.approx(2.0, abs=0.01)
+    assert deadline.stage_timeout("embed", "search") == pytest.approx(5.0, abs=0.01)
+
+
+def test_unused_time_goes_to_the_following_stages():
+    deadline = Deadline(10.0, SPLIT)
+
+    # embed done (in no time): search gets 0.3 / 0.8 of the time left
+    assert deadline.stage_timeout("search") == pytest.approx(3.75, abs=0.01)
+
+    # 5 sec. used: all the time left to the last stage
+    deadline.start -= 5.0
+    assert deadline.stage_timeout("llm") == pytest.approx(5.0, abs=0.01)
+
+
+def test_deadline_check():
+    deadline = Deadline(10.0, SPLIT)
+    deadline.check()
+
+    deadline.start -= 11.0
+    assert deadline.remaining() == 0.0
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+
+
+def test_time_limit_is_nested():
+    assert time_left() is None
+
+    with time_limit(1.0):
+        assert 0.9 < time_left() <= 1.0
+
+        with time_limit(10.0):
+            # the outer limit is shorter
+            assert time_left() <= 1.0
+
+        with time_limit(0.5):
+            assert time_left() <= 0.5
+
+    assert time_left() is None
+
+
+def test_cap_timeout():
+    assert cap_timeout((10, 60)) == (10, 60)
+
+    with time_limit(5.0):
+        connect, read = cap_timeout((10, 60))
+        assert connect <= 5.0 and read <= 5.0
+
+        assert cap_timeout((1, 60))[0] == 1
+
+    with time_limit(0.01):
+        time.sleep(0.02)
+
+        with pytest.raises(DeadlineExceeded):
+            cap_timeout((10, 60))
+
+
+def test_run_with_timeout_passes_the_limit():
+    assert run_with_timeout("stage", None, time_left) is None
+    assert run_with_timeout("stage", 2.0, time_left) <= 2.0
+
+    with pytest.raises(DeadlineExceeded, match="stage"):
+        run_with_timeout("stage", 0.0, time_left)
+
+
+def test_run_with_timeout_names_the_stage():
+    def exceeded():
+        raise DeadlineExceeded("no time left")
+
+    with pytest.raises(DeadlineExceeded, match="Stage search"):
+        run_with_timeout("search", 1.0, exceeded)
+
+
+def test_latencies_are_recorded_only_for_service_calls():
+    name, tracker = new_tracker()
+
+    assert hedged_call(name, None, service_call, "result") == "result"
+    # answered by a cache: not recorded
+    assert hedged_call(name, None, lambda: "cached") == "cached"
+
+    assert len(tracker.latencies) == 1
+
+
+def test_no_hedging_with_few_samples():
+    name, tracker = new_tracker()
+    n_calls = []
+
+    def call():
+        n_calls.append(1)
+        return service_call("result", 0.05)
+
+    assert hedged_call(name, None, call) == "result"
+    assert len(n_calls) == 1
+    assert tracker.n_hedged == 0
+
+
+def test_slow_call_is_hedged():
+    name, tracker = new_tracker(latency=0.01)
+    n_calls = []
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            n_calls.append(1)
+            is_first = len(n_calls) == 1
+
+        # the first is slow, the duplicate fast
+        return service_call("slow" if is_first else "fast", 1.0 if is_first else 0)
+
+    start = time.monotonic()
+
+    assert hedged_call(name, 5.0, call) == "fast"
+    assert time.monotonic() - start < 0.5
+    assert tracker.n_hedged == 1
+
+
+def test_hedged_call_bounded_by_the_timeout():
+    name, _ = new_tracker(latency=0.01)
+
+    start = time.monotonic()
+
+    with pytest.raises(DeadlineExceeded):
+        hedged_call(name, 0.2, service_call, "result", 1.0)
+
+    assert time.monotonic() - start < 0.5
+
+
+def test_hedged_call_raises_when_all_fail():
+    name, _ = new_tracker(latency=0.01)
+
+    def failing():
+        time.sleep(0.05)
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        hedged_call(name, 5.0, failing)
@@ -0,0 +1,209 @@
+"""
+Tests for embed_batching and the batches of OCIGenAIEmbeddingsWithBatch
+"""
+
+import itertools
+from types import SimpleNamespace
+
+import oci
+import pytest
+
+import embed_batching
+from embed_batching import (
+    RECOVERY_BATCHES,
+    BatchSizer,
+    estimate_tokens,
+    is_batch_too_large,
+)
+from oci_cohere_embeddings_utils import OCIGenAIEmbeddingsWithBatch
+
+MAX_TOKENS = embed_batching.EMBED_MAX_BATCH_TOKENS
+
+_MODEL_IDS = itertools.count()
+
+
+def service_error(status, message="message", code="code"):
+    return oci.exceptions.ServiceError(status, code, {}, message)
+
+
+class FakeClient:
+    """
+    embeds a text as [len(text)], rejects the batches over max_texts
+    """
+
+    def __init__(self, max_texts=None, error=None):
+        self.max_texts = max_texts
+        self.error = error
+        self.batches = []
+        self.chat = None
+
+    def embed_text(self, details):
+        self.batches.append(list(details.inputs))
+
+        if self.error is not None:
+            raise self.error
+
+        if self.max_texts is not None and len(details.inputs) > self.max_texts:
+            raise service_error(413, "Request entity too large")
+
+        return SimpleNamespace(
+            data=SimpleNamespace(
+                embeddings=[[float(len(text))] for text in details.inputs]
+            )
+        )
+
+
+def make_embed_model(client):
+    # a new model id for each test: the sizers are shared by model
+    return OCIGenAIEmbeddingsWithBatch(
+        client=client,
+        model_id=f"test.embed-{next(_MODEL_IDS)}",
+        service_endpoint="https://localhost",
+        compartment_id="test",
+    )
+
+
+def embed_model_sizer_max(embed_model):
+    return embed_batching.get_batch_sizer(embed_model.model_id).max_tokens
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (service_error(413), True),
+        (service_error(400, "Too many tokens in the request"), True),
+        (service_error(400, "Input exceeds the limit of 96 texts"), True),
+        (service_error(400, "Invalid model id"), False),
+        (service_error(400, "Invalid input type"), False),
+        (service_error(401, "Not authenticated"), False),
+        (service_error(429, "Too many requests"), False),
+        (ValueError("too large"), False),
+    ],
+)
+def test_is_batch_too_large(error, expected):
+    assert is_batch_too_large(error) == expected
+
+
+def test_batches_are_cut_by_tokens():
+    sizer = BatchSizer("test")
+    sizer.max_tokens = 10
+
+    texts = ["t"] * 6
+    n_tokens = [4] * 6
+
+    assert sizer.next_batch_end(texts, 0, n_tokens) == 2
+    assert sizer.next_batch_end(texts, 2, n_tokens) == 4
+
+
+def test_a_batch_has_at_least_one_text():
+    sizer = BatchSizer("test")
+    sizer.max_tokens = 10
+
+    assert sizer.next_batch_end(["t", "t"], 0, [50, 50]) == 1
+
+
+def test_batches_are_cut_by_size():
+    sizer = BatchSizer("test")
+    texts = ["t"] * (2 * embed_batching.EMBED_BATCH_SIZE)
+
+    end = sizer.next_batch_end(texts, 0, [1] * len(texts))
+
+    assert end == embed_batching.EMBED_BATCH_SIZE
+
+
+def test_target_follows_the_latency():
+    sizer = BatchSizer("test")
+
+    # 1000 tokens in 1/20 of the target latency: the target is 20000 tokens
+    sizer.record(1000, embed_batching.EMBED_TARGET_LATENCY / 20)
+
+    assert sizer.get_stats()["target_tokens"] == 20000
+
+
+def test_rejection_reduces_the_max():
+    sizer = BatchSizer("test")
+
+    sizer.record_too_large(1000)
+
+    assert sizer.get_stats()["max_tokens"] == 500
+
+
+def test_max_recovers_after_accepted_batches():
+    sizer = BatchSizer("test")
+    sizer.record_too_large(1000)
+
+    for _ in range(RECOVERY_BATCHES - 1):
+        sizer.record(10, 0.001)
+    assert sizer.max_tokens == 500
+
+    sizer.record(10, 0.001)
+    assert sizer.max_tokens == 1000
+
+    # up to the configured max
+    for _ in range(100 * RECOVERY_BATCHES):
+        sizer.record(10, 0.001)
+    assert sizer.max_tokens == MAX_TOKENS
+
+
+def test_rejection_restarts_the_recovery():
+    sizer = BatchSizer("test")
+    sizer.record_too_large(1000)
+
+    for _ in range(RECOVERY_BATCHES - 1):
+        sizer.record(10, 0.001)
+    sizer.record_too_large(1000)
+    sizer.record(10, 0.001)
+
+    assert sizer.max_tokens == 500
+
+
+def test_rejected_batch_is_split():
+    client = FakeClient(max_texts=2)
+    embed_model = make_embed_model(client)
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+
+    embeddings = embed_model._embed_batch(texts)
+
+    assert embeddings == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert client.batches[0] == texts
+    # the max of the model is reduced (at least) to half of the batch
+    assert embed_model_sizer_max(embed_model) <= sum(estimate_tokens(texts)) // 2
+
+
+def test_other_errors_are_not_split():
+    client = FakeClient(error=service_error(400, "Invalid model id"))
+    embed_model = make_embed_model(client)
+
+    with pytest.raises(oci.exceptions.ServiceError):
+        embed_model._embed_batch(["a", "bb", "ccc"])
+
+    assert len(client.batches) == 1
+    assert embed_model_sizer_max(embed_model) == MAX_TOKENS
+
+
+def test_single_text_too_large_is_raised():
+    client = FakeClient(error=service_error(413))
+    embed_model = make_embed_model(client)
+
+    with pytest.raises(oci.exceptions.ServiceError):
+        embed_model._embed_batch(["a"])
+
+    assert len(client.batches) == 1
+
+
+def test_no_texts_no_call():
+    client = FakeClient(error=service_error(413))
+    embed_model = make_embed_model(client)
+
+    assert embed_model.embed_documents([]) == []
+    assert not client.batches
+
+
+def test_empty_batch_is_not_split():
+    client = FakeClient(error=service_error(413))
+    embed_model = make_embed_model(client)
+
+    with pytest.raises(oci.exceptions.ServiceError):
+        embed_model._embed_batch([])
+
+    assert len(client.batches) == 1
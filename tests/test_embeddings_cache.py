@@ -0,0 +1,191 @@
+"""
+Tests for embeddings_cache
+"""
+
+import asyncio
+
+import pytest
+from langchain_core.embeddings import Embeddings
+
+import embeddings_cache
+import llm_replay_cache
+from embeddings_cache import (
+    SEARCH_DOCUMENT,
+    SEARCH_QUERY,
+    CachedEmbeddings,
+    EmbeddingsCache,
+    make_cache_key,
+)
+from llm_replay_cache import ReplayMissError
+
+MODEL_ID = "test.embed"
+
+
+class CountingEmbeddings(Embeddings):
+    """
+    the vector of a text is [len(text), 1.0], counting the texts embedded
+    """
+
+    def __init__(self):
+        self.documents = []
+        self.queries = []
+
+    def embed_documents(self, texts):
+        self.documents.extend(texts)
+
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        self.queries.append(text)
+
+        return [float(len(text)), 2.0]
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmbeddingsCache(str(tmp_path / "embeddings.sqlite"), 3, 5)
+
+
+def key(text, input_type=SEARCH_DOCUMENT):
+    return make_cache_key(MODEL_ID, input_type, text)
+
+
+def test_key_depends_on_model_input_type_and_text():
+    keys = {
+        key("a"),
+        key("b"),
+        key("a", SEARCH_QUERY),
+        make_cache_key("other.embed", SEARCH_DOCUMENT, "a"),
+    }
+
+    assert len(keys) == 4
+
+
+def test_put_then_get(cache):
+    cache.put_many({key("a"): [1.0, 2.0]})
+
+    assert cache.get_many([key("a"), key("b")]) == {key("a"): [1.0, 2.0]}
+    assert cache.get_stats()["hits_memory"] == 1
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_memory_is_lru(cache):
+    cache.put_many({key(text): [1.0] for text in "abc"})
+    # a is used: b is the least recently used
+    cache.get_many([key("a")])
+
+    cache.put_many({key("d"): [1.0]})
+
+    assert list(cache.memory) == [key("c"), key("a"), key("d")]
+
+
+def test_evicted_from_memory_found_on_disk(cache):
+    cache.put_many({key(text): [float(i)] for i, text in enumerate("abcd")})
+    assert key("a") not in cache.memory
+
+    assert cache.get_many([key("a")]) == {key("a"): [0.0]}
+    assert cache.get_stats()["hits_disk"] == 1
+    # back in memory
+    assert key("a") in cache.memory
+
+
+def test_disk_keeps_the_most_recently_used(cache, monkeypatch):
+    monkeypatch.setattr(embeddings_cache, "EVICTION_CHECK_INTERVAL", 1)
+    times = iter(range(100))
+    monkeypatch.setattr(embeddings_cache.time, "time", lambda: next(times))
+
+    cache.put_many({key(text): [1.0] for text in "abcde"})
+    # a used on disk after the others
+    cache.memory.clear()
+    cache.get_many([key("a")])
+
+    cache.put_many({key("f"): [1.0]})
+
+    (n_items,) = cache.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+    assert n_items == 5
+
+    cache.memory.clear()
+    found = cache.get_many([key(text) for text in "abcdef"])
+    # b was the least recently used
+    assert set(found) == {key(text) for text in "acdef"}
+
+
+def test_persisted(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+
+    EmbeddingsCache(path).put_many({key("a"): [1.0, 2.0]})
+
+    assert EmbeddingsCache(path).get_many([key("a")]) == {key("a"): [1.0, 2.0]}
+
+
+def test_texts_are_embedded_once(cache):
+    embed_model = CountingEmbeddings()
+    cached = CachedEmbeddings(embed_model, MODEL_ID, cache)
+
+    vectors = cached.embed_documents(["a", "bb", "a", "ccc"])
+
+    assert vectors == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [3.0, 1.0]]
+    # the repeated text is sent once
+    assert embed_model.documents == ["a", "bb", "ccc"]
+
+    # then they are in cache
+    assert cached.embed_documents(["ccc", "bb", "dddd"])[:2] == [
+        [3.0, 1.0],
+        [2.0, 1.0],
+    ]
+    assert embed_model.documents == ["a", "bb", "ccc", "dddd"]
+
+
+def test_queries_and_documents_are_cached_apart(cache):
+    embed_model = CountingEmbeddings()
+    cached = CachedEmbeddings(embed_model, MODEL_ID, cache)
+
+    cached.embed_documents(["a"])
+
+    assert cached.embed_query("a") == [1.0, 2.0]
+    assert cached.embed_query("a") == [1.0, 2.0]
+    assert embed_model.queries == ["a"]
+
+
+def test_async_uses_the_cache(cache):
+    embed_model = CountingEmbeddings()
+    cached = CachedEmbeddings(embed_model, MODEL_ID, cache)
+
+    cached.embed_documents(["a"])
+    cached.embed_query("q")
+
+    assert asyncio.run(cached.aembed_documents(["a", "a", "bb"])) == [
+        [1.0, 1.0],
+        [1.0, 1.0],
+        [2.0, 1.0],
+    ]
+    assert asyncio.run(cached.aembed_query("q")) == [1.0, 2.0]
+    assert embed_model.documents == ["a", "bb"]
+    assert embed_model.queries == ["q"]
+
+
+def test_replay_miss_doesnt_call_the_service(cache, monkeypatch):
+    embed_model = CountingEmbeddings()
+    cached = CachedEmbeddings(embed_model, MODEL_ID, cache)
+
+    cached.embed_documents(["a"])
+
+    monkeypatch.setattr(llm_replay_cache, "LLM_REPLAY_MODE", "replay")
+
+    # recorded
+    assert cached.embed_documents(["a"]) == [[1.0, 1.0]]
+
+    with pytest.raises(ReplayMissError):
+        cached.embed_documents(["a", "bb"])
+
+    with pytest.raises(ReplayMissError):
+        cached.embed_query("q")
+
+    assert embed_model.documents == ["a"]
+    assert embed_model.queries == []
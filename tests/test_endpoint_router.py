@@ -0,0 +1,71 @@
+"""
+Tests for endpoint_router
+"""
+
+import pytest
+
+import endpoint_router
+from endpoint_router import EndpointRouter
+
+ENDPOINTS = ["https://a", "https://b", "https://c"]
+
+
+@pytest.fixture
+def router(monkeypatch):
+    # no random exploration
+    monkeypatch.setattr(endpoint_router, "ROUTER_EXPLORE_RATE", 0.0)
+
+    return EndpointRouter("test.model", ENDPOINTS)
+
+
+def expire_failures(router):
+    for stats in router.stats.values():
+        stats.last_failure = -float("inf")
+
+
+def test_fastest_is_chosen(router):
+    router.record("https://a", 2.0, is_ok=True)
+    router.record("https://b", 0.5, is_ok=True)
+    router.record("https://c", 1.0, is_ok=True)
+
+    assert router.choose() == "https://b"
+
+
+def test_failed_endpoint_is_avoided(router):
+    router.record("https://a", 0.1, is_ok=True)
+    router.record("https://b", 0.5, is_ok=True)
+    router.record("https://a", 0.1, is_ok=False)
+
+    assert router.choose() != "https://a"
+
+
+def test_endpoint_only_failed_is_not_first_after_cooldown(router):
+    router.record("https://a", 1.0, is_ok=True)
+    router.record("https://b", 2.0, is_ok=True)
+    for _ in range(3):
+        router.record("https://c", 0.1, is_ok=False)
+
+    expire_failures(router)
+
+    assert router.choose() == "https://a"
+
+
+def test_endpoint_never_called_gets_the_median(router):
+    router.record("https://a", 1.0, is_ok=True)
+    router.record("https://b", 3.0, is_ok=True)
+
+    # c (never called) is scored 2.0: between a and b
+    assert router.choose() == "https://a"
+
+    router.stats["https://a"].last_failure = float("inf")
+    assert router.choose() == "https://c"
+
+
+def test_no_latency_known_errors_count(router):
+    router.record("https://a", 0.1, is_ok=False)
+    router.record("https://b", 0.1, is_ok=False)
+    router.record("https://b", 0.1, is_ok=False)
+
+    expire_failures(router)
+
+    assert router.choose() == "https://c"
@@ -0,0 +1,167 @@
+"""
+Tests for ingest_checkpoint
+"""
+
+import os
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from ingest_checkpoint import (
+    CheckpointStore,
+    PrecomputedEmbeddings,
+    embed_with_checkpoints,
+)
+
+PARAMS = {"model": "cohere.embed-multilingual-v3.0", "chunk_size": 1500}
+
+
+class CountingEmbeddings(Embeddings):
+    """
+    the vector of a text is [len(text), 1.0], counting the texts embedded
+    """
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), 1.0]
+
+
+def make_docs(*texts):
+    return [Document(page_content=text, metadata={"source": "a.pdf"}) for text in texts]
+
+
+@pytest.fixture
+def checkpoint_dir(tmp_path):
+    return str(tmp_path / "checkpoint")
+
+
+def test_append_then_get(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+
+    store.append(["a", "bb"], [{}, {}], [[1.0, 2.0], [3.0, 4.0]])
+
+    assert store.contains("a")
+    assert not store.contains("c")
+    assert store.get_embedding("bb") == [3.0, 4.0]
+
+
+def test_resume(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    store.append(["a"], [{}], [[1.0, 2.0]])
+    store.append(["bb"], [{}], [[3.0, 4.0]])
+
+    resumed = CheckpointStore(checkpoint_dir, PARAMS)
+    assert resumed.exists()
+    resumed.resume()
+
+    assert resumed.get_embedding("a") == [1.0, 2.0]
+    assert resumed.get_embedding("bb") == [3.0, 4.0]
+    assert len(resumed.manifest["shards"]) == 2
+
+
+def test_resume_with_other_params_fails(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+
+    with pytest.raises(ValueError):
+        CheckpointStore(checkpoint_dir, {**PARAMS, "chunk_size": 500}).resume()
+
+
+def test_shard_not_in_manifest_is_ignored(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    store.append(["a"], [{}], [[1.0, 2.0]])
+
+    # interrupted while writing the next shard
+    with open(os.path.join(checkpoint_dir, "shard_00001.jsonl"), "w") as f:
+        f.write('{"hash": "partial"')
+
+    resumed = CheckpointStore(checkpoint_dir, PARAMS)
+    resumed.resume()
+
+    assert resumed.contains("a")
+    assert len(resumed.index) == 1
+
+
+def test_start_removes_the_previous_checkpoint(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    store.append(["a"], [{}], [[1.0, 2.0]])
+
+    new_store = CheckpointStore(checkpoint_dir, PARAMS)
+    new_store.start()
+
+    assert not new_store.contains("a")
+    assert not any(name.startswith("shard_") for name in os.listdir(checkpoint_dir))
+
+
+def test_embed_with_checkpoints_resumes_the_missing(checkpoint_dir):
+    docs = make_docs("a", "bb", "a", "ccc", "dddd")
+    embed_model = CountingEmbeddings()
+
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    store.append(["bb"], [{}], embed_model.embed_documents(["bb"]))
+
+    embed_with_checkpoints(docs, embed_model, store, shard_size=2)
+
+    # each missing text once, "bb" was in the checkpoint
+    assert embed_model.embedded == ["bb", "a", "ccc", "dddd"]
+    # 1 + 2 shards
+    assert len(store.manifest["shards"]) == 3
+    assert store.get_embedding("ccc") == [3.0, 1.0]
+
+
+def test_precomputed_embeddings(checkpoint_dir):
+    embed_model = CountingEmbeddings()
+
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    store.append(["a", "bb"], [{}, {}], [[10.0, 0.0], [20.0, 0.0]])
+
+    embeddings = PrecomputedEmbeddings(store, embed_model)
+
+    assert embeddings.embed_documents(["bb", "ccc", "a"]) == [
+        [20.0, 0.0],
+        [3.0, 1.0],
+        [10.0, 0.0],
+    ]
+    # only the text not in the checkpoint
+    assert embed_model.embedded == ["ccc"]
+    assert embeddings.embed_query("q") == [1.0, 1.0]
+
+
+def test_collection_created_is_saved(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    assert not store.is_collection_created()
+
+    store.set_collection_created()
+
+    resumed = CheckpointStore(checkpoint_dir, PARAMS)
+    resumed.resume()
+    assert resumed.is_collection_created()
+
+
+def test_remove_after_completed(checkpoint_dir):
+    store = CheckpointStore(checkpoint_dir, PARAMS)
+    store.start()
+    store.append(["a"], [{}], [[1.0, 2.0]])
+    store.set_collection_created()
+
+    store.remove()
+
+    assert not store.exists()
+    assert not store.contains("a")
+    assert not store.is_collection_created()
+    assert os.listdir(checkpoint_dir) == []
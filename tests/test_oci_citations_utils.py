@@ -0,0 +1,123 @@
+"""
+Tests for the rendering of citations (oci_citations_utils)
+"""
+
+from oci_citations_utils import (
+    CitationRenderer,
+    format_citation_marker,
+    index_documents,
+    render_citations,
+)
+
+TEXT = "Oracle 23ai has vectors. It supports INT8. And hybrid search."
+
+# as in the Cohere stream events
+CITATIONS = [
+    {"start": 0, "end": 23, "text": TEXT[0:23], "documentIds": ["doc_0"]},
+    {"start": 25, "end": 41, "text": TEXT[25:41], "documentIds": ["doc_1", "doc_2"]},
+    {"start": 43, "end": 60, "text": TEXT[43:60], "documentIds": ["doc_0"]},
+]
+
+DOCUMENTS = [
+    {"id": "doc_1", "source": "b.pdf", "page": 2},
+    {"id": "doc_0", "source": "a.pdf", "page": 1},
+    {"id": "doc_2", "source": "c.pdf", "page": 3},
+]
+
+
+def to_complete_citations(citations):
+    """
+    as returned by extract_complete_citations
+    """
+    return [
+        {
+            "interval": (c["start"], c["end"]),
+            "text": c["text"],
+            "documents": [{"id": doc_id} for doc_id in c["documentIds"]],
+        }
+        for c in citations
+    ]
+
+
+def chunks(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+EXPECTED = render_citations(TEXT, to_complete_citations(CITATIONS))
+
+
+def test_render_citations():
+    assert EXPECTED == (
+        "Oracle 23ai has vectors [doc_0]. It supports INT8 [doc_1, doc_2]."
+        " And hybrid search [doc_0]."
+    )
+    assert format_citation_marker(["a", "b"]) == " [a, b]"
+
+
+def test_render_without_citations():
+    assert render_citations(TEXT, []) == TEXT
+
+
+def test_index_documents():
+    assert index_documents(DOCUMENTS)["doc_0"]["source"] == "a.pdf"
+
+
+def test_streamed_render_equals_the_final_render():
+    renderer = CitationRenderer()
+    citations = list(CITATIONS)
+    received = ""
+
+    for text in chunks(TEXT, 7):
+        renderer.add_event({"text": text})
+        received += text
+
+        # citations arrive after the text they cite
+        while citations and citations[0]["end"] <= len(received):
+            renderer.add_event({"citations": [citations.pop(0)]})
+
+        rendered = renderer.render()
+        # at each step: the text so far, with the citations received
+        assert rendered.replace(" [doc_0]", "").replace(" [doc_1, doc_2]", "") == (
+            received
+        )
+
+    # the final event repeats the text
+    renderer.add_event({"text": TEXT, "finishReason": "COMPLETE"})
+
+    assert renderer.render() == EXPECTED
+    assert renderer.get_text() == TEXT
+
+
+def test_citation_before_its_text_is_applied_later():
+    renderer = CitationRenderer()
+
+    renderer.add_event({"text": TEXT[:10], "citations": [CITATIONS[0]]})
+    assert renderer.render() == TEXT[:10]
+
+    renderer.add_event({"text": TEXT[10:]})
+    assert renderer.render().startswith("Oracle 23ai has vectors [doc_0].")
+
+
+def test_citations_out_of_order():
+    renderer = CitationRenderer()
+    renderer.add_event({"text": TEXT})
+
+    renderer.add_event({"citations": [CITATIONS[2]]})
+    renderer.render()
+    # before the text already rendered
+    renderer.add_event({"citations": [CITATIONS[0], CITATIONS[1]]})
+
+    assert renderer.render() == EXPECTED
+
+
+def test_cited_documents_in_order_of_id():
+    renderer = CitationRenderer()
+
+    renderer.add_event({"text": TEXT, "documents": DOCUMENTS[:2]})
+    renderer.add_event({"documents": DOCUMENTS[2:]})
+
+    assert [doc["id"] for doc in renderer.get_cited_documents()] == [
+        "doc_0",
+        "doc_1",
+        "doc_2",
+    ]
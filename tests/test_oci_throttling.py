@@ -0,0 +1,241 @@
+"""
+Tests for oci_throttling
+"""
+
+import asyncio
+import time
+
+import oci
+import pytest
+import requests
+
+import oci_throttling
+from deadlines import DeadlineExceeded, time_limit
+from oci_throttling import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ModelThrottle,
+    TokenBucket,
+    get_backoff,
+    get_retry_after,
+    is_retriable,
+)
+
+MODEL_ID = "test.model"
+
+
+def service_error(status, headers=None):
+    return oci.exceptions.ServiceError(status, "code", headers or {}, "message")
+
+
+class Failing:
+    """
+    raises the errors, then returns "ok"
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.n_calls = 0
+
+    def __call__(self):
+        self.n_calls += 1
+
+        if self.errors:
+            raise self.errors.pop(0)
+
+        return "ok"
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(oci_throttling, "get_backoff", lambda attempt, retry_after: 0)
+
+
+def test_bucket_burst_then_wait():
+    bucket = TokenBucket(rate=10.0, burst=2)
+
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    # no tokens left: wait for one
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_bucket_slow_down_and_speed_up():
+    bucket = TokenBucket(rate=10.0, burst=1)
+
+    bucket.slow_down()
+    assert bucket.rate == 5.0
+
+    for _ in range(10):
+        bucket.slow_down()
+    # never below the min fraction
+    assert bucket.rate == pytest.approx(10.0 * oci_throttling.MIN_RATE_FRACTION)
+
+    for _ in range(100):
+        bucket.speed_up()
+    # never above the configured rate
+    assert bucket.rate == 10.0
+
+
+def test_circuit_opens_after_failures():
+    breaker = CircuitBreaker(max_failures=2, reset_timeout=60)
+
+    breaker.record_failure(MODEL_ID)
+    breaker.check(MODEL_ID)
+
+    breaker.record_failure(MODEL_ID)
+    with pytest.raises(CircuitOpenError):
+        breaker.check(MODEL_ID)
+
+
+def test_circuit_success_resets_failures():
+    breaker = CircuitBreaker(max_failures=2, reset_timeout=60)
+
+    breaker.record_failure(MODEL_ID)
+    breaker.record_success()
+    breaker.record_failure(MODEL_ID)
+
+    breaker.check(MODEL_ID)
+
+
+def test_circuit_half_open_after_reset():
+    breaker = CircuitBreaker(max_failures=1, reset_timeout=0.05)
+
+    breaker.record_failure(MODEL_ID)
+    with pytest.raises(CircuitOpenError):
+        breaker.check(MODEL_ID)
+
+    time.sleep(0.06)
+    breaker.check(MODEL_ID)
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (service_error(429), True),
+        (service_error(500), True),
+        (service_error(503), True),
+        (service_error(400), False),
+        (service_error(404), False),
+        (requests.exceptions.ConnectionError(), True),
+        (requests.exceptions.ReadTimeout(), True),
+        (ValueError(), False),
+    ],
+)
+def test_is_retriable(error, expected):
+    assert is_retriable(error) == expected
+
+
+def test_get_retry_after():
+    assert get_retry_after(service_error(429, {"retry-after": "3"})) == 3.0
+    assert get_retry_after(service_error(429, {"retry-after": "soon"})) is None
+    assert get_retry_after(service_error(429)) is None
+    assert get_retry_after(ValueError()) is None
+
+
+def test_backoff_is_bounded():
+    for attempt in range(20):
+        delay = get_backoff(attempt)
+
+        assert (
+            0
+            <= delay
+            <= min(
+                oci_throttling.OCI_BACKOFF_MAX,
+                oci_throttling.OCI_BACKOFF_BASE * 2**attempt,
+            )
+        )
+
+
+def test_backoff_honors_retry_after():
+    assert get_backoff(0, retry_after=100.0) == 100.0
+
+
+def test_call_retries_retriable_errors(no_backoff):
+    throttle = ModelThrottle(MODEL_ID)
+    func = Failing(service_error(503), requests.exceptions.ConnectionError())
+
+    assert throttle.call(func) == "ok"
+    assert func.n_calls == 3
+    assert throttle.breaker.failures == 0
+
+
+def test_call_doesnt_retry_other_errors(no_backoff):
+    throttle = ModelThrottle(MODEL_ID)
+    func = Failing(service_error(400))
+
+    with pytest.raises(oci.exceptions.ServiceError):
+        throttle.call(func)
+
+    assert func.n_calls == 1
+
+
+def test_call_gives_up_after_max_retries(no_backoff, monkeypatch):
+    monkeypatch.setattr(oci_throttling, "OCI_MAX_RETRIES", 2)
+    throttle = ModelThrottle(MODEL_ID)
+    func = Failing(*[service_error(500) for _ in range(5)])
+
+    with pytest.raises(oci.exceptions.ServiceError):
+        throttle.call(func)
+
+    assert func.n_calls == 3
+
+
+def test_429_slows_down_without_opening_the_circuit(no_backoff):
+    throttle = ModelThrottle(MODEL_ID)
+    rate = throttle.bucket.rate
+    func = Failing(service_error(429), service_error(429))
+
+    assert throttle.call(func) == "ok"
+    assert throttle.bucket.rate < rate
+    assert throttle.breaker.failures == 0
+
+
+def test_acall_retries(no_backoff):
+    throttle = ModelThrottle(MODEL_ID)
+    func = Failing(service_error(503))
+
+    async def coro_func():
+        return func()
+
+    assert asyncio.run(throttle.acall(coro_func)) == "ok"
+    assert func.n_calls == 2
+
+
+def test_no_retry_beyond_the_time_limit(monkeypatch):
+    monkeypatch.setattr(
+        oci_throttling, "get_backoff", lambda attempt, retry_after: 10.0
+    )
+    throttle = ModelThrottle(MODEL_ID)
+    func = Failing(service_error(503))
+
+    start = time.monotonic()
+    with time_limit(1.0), pytest.raises(DeadlineExceeded):
+        throttle.call(func)
+
+    assert time.monotonic() - start < 0.5
+    assert func.n_calls == 1
+
+
+def test_timeout_is_not_a_failure_of_the_service():
+    throttle = ModelThrottle(MODEL_ID)
+
+    def slow():
+        time.sleep(0.1)
+        raise requests.exceptions.ReadTimeout()
+
+    with time_limit(0.05), pytest.raises(DeadlineExceeded):
+        throttle.call(slow)
+
+    assert throttle.breaker.failures == 0
+
+
+def test_no_wait_for_a_token_beyond_the_time_limit():
+    throttle = ModelThrottle(MODEL_ID)
+    throttle.bucket = TokenBucket(rate=0.1, burst=1)
+
+    assert throttle.call(lambda: "ok") == "ok"
+
+    with time_limit(1.0), pytest.raises(DeadlineExceeded):
+        throttle.call(lambda: "ok")
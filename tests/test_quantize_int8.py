@@ -0,0 +1,48 @@
+"""
+Tests for quantize_int8 (oraclevs_4_rfx)
+"""
+
+import numpy as np
+
+from oraclevs_4_rfx import INT8_MAX, quantize_int8
+
+
+def cosine(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def test_max_abs_value_is_int8_max():
+    assert quantize_int8([0.5, -0.25, 0.1]) == [INT8_MAX, -64, 25]
+    assert quantize_int8([-2.0, 1.0]) == [-INT8_MAX, 64]
+
+
+def test_values_are_in_int8_range():
+    rng = np.random.default_rng(42)
+    vector = rng.normal(size=1024).tolist()
+
+    quantized = quantize_int8(vector)
+
+    assert len(quantized) == len(vector)
+    assert all(isinstance(value, int) for value in quantized)
+    assert max(abs(value) for value in quantized) == INT8_MAX
+
+
+def test_cosine_similarity_is_preserved():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=1024)
+    b = a + rng.normal(scale=0.5, size=1024)
+
+    assert abs(cosine(quantize_int8(a), quantize_int8(b)) - cosine(a, b)) < 0.01
+
+
+def test_scale_doesnt_matter():
+    vector = [0.3, -0.7, 0.05]
+
+    assert quantize_int8(vector) == quantize_int8([value * 1000 for value in vector])
+
+
+def test_zero_vector():
+    assert quantize_int8([0.0, 0.0, 0.0]) == [0, 0, 0]
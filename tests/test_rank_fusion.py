@@ -0,0 +1,68 @@
+"""
+Tests for rank_fusion
+"""
+
+from langchain_core.documents import Document
+
+from rank_fusion import get_doc_key, reciprocal_rank_fusion
+
+
+def make_doc(text, source="a.pdf", page=1):
+    return Document(page_content=text, metadata={"source": source, "page": page})
+
+
+def test_doc_key_identifies_the_same_chunk():
+    assert get_doc_key(make_doc("x")) == get_doc_key(make_doc("x"))
+    assert get_doc_key(make_doc("x")) != get_doc_key(make_doc("x", page=2))
+    assert get_doc_key(make_doc("x")) != get_doc_key(make_doc("x", source="b.pdf"))
+
+
+def test_single_list_keeps_the_order():
+    docs = [make_doc("a"), make_doc("b"), make_doc("c")]
+
+    assert reciprocal_rank_fusion([docs]) == docs
+
+
+def test_docs_in_both_lists_come_first():
+    a, b, c, d = (make_doc(text) for text in "abcd")
+
+    fused = reciprocal_rank_fusion([[a, b, c], [d, c, b]])
+
+    # b and c are in both lists, a and d only in one
+    assert fused[:2] == [b, c] or fused[:2] == [c, b]
+    assert set(get_doc_key(doc) for doc in fused[2:]) == {
+        get_doc_key(a),
+        get_doc_key(d),
+    }
+
+
+def test_scores_follow_the_formula():
+    a, b = make_doc("a"), make_doc("b")
+
+    # a: 1/(k+1) + 1/(k+3), b: 1/(k+2) + 1/(k+1)
+    fused = reciprocal_rank_fusion([[a, b], [b, make_doc("c"), a]])
+
+    assert fused[0] == b
+    assert fused[1] == a
+
+
+def test_duplicates_are_merged_keeping_the_first():
+    first = make_doc("a")
+    second = make_doc("a")
+
+    fused = reciprocal_rank_fusion([[first], [second]])
+
+    assert len(fused) == 1
+    assert fused[0] is first
+
+
+def test_top_n():
+    docs = [make_doc(text) for text in "abcde"]
+
+    assert reciprocal_rank_fusion([docs], top_n=2) == docs[:2]
+    assert reciprocal_rank_fusion([docs], top_n=10) == docs
+
+
+def test_empty():
+    assert reciprocal_rank_fusion([]) == []
+    assert reciprocal_rank_fusion([[], []]) == []
@@ -0,0 +1,161 @@
+"""
+Tests for single_flight
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight
+
+N_CALLERS = 5
+
+
+class SlowCall:
+    """
+    blocks until released, counting the calls
+    """
+
+    def __init__(self, result="result", error=None):
+        self.result = result
+        self.error = error
+        self.n_calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.n_calls += 1
+        self.started.set()
+        self.release.wait(5)
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+def run_concurrently(flight, key, func):
+    """
+    N_CALLERS threads call func with the same key
+    the leader is started first, the others while it is in flight
+    """
+    with ThreadPoolExecutor(N_CALLERS) as executor:
+        futures = [executor.submit(flight.do, key, func)]
+        func.started.wait(5)
+
+        futures += [executor.submit(flight.do, key, func) for _ in range(N_CALLERS - 1)]
+
+        # the waiters have joined the call
+        while flight.get_stats()["shared"] < N_CALLERS - 1:
+            time.sleep(0.01)
+
+        func.release.set()
+
+        return futures
+
+
+def test_identical_calls_are_done_once():
+    flight = SingleFlight()
+    func = SlowCall()
+
+    futures = run_concurrently(flight, "key", func)
+
+    assert [future.result() for future in futures] == ["result"] * N_CALLERS
+    assert func.n_calls == 1
+    assert flight.get_stats() == {"calls": 1, "shared": N_CALLERS - 1}
+    assert flight.calls == {}
+
+
+def test_the_error_is_shared():
+    flight = SingleFlight()
+    func = SlowCall(error=ValueError("failed"))
+
+    futures = run_concurrently(flight, "key", func)
+
+    for future in futures:
+        with pytest.raises(ValueError, match="failed"):
+            future.result()
+
+    assert func.n_calls == 1
+
+
+def test_different_keys_are_not_shared():
+    flight = SingleFlight()
+
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+    assert flight.get_stats() == {"calls": 2, "shared": 0}
+
+
+def test_calls_after_the_end_are_done_again():
+    flight = SingleFlight()
+    results = iter([1, 2])
+
+    assert flight.do("key", lambda: next(results)) == 1
+    assert flight.do("key", lambda: next(results)) == 2
+    assert flight.get_stats() == {"calls": 2, "shared": 0}
+
+
+def test_async_identical_calls_are_done_once():
+    flight = SingleFlight()
+    n_calls = 0
+
+    async def slow_call(value):
+        nonlocal n_calls
+        n_calls += 1
+        await asyncio.sleep(0.05)
+
+        return value
+
+    async def main():
+        return await asyncio.gather(
+            *[flight.ado("key", slow_call, "result") for _ in range(N_CALLERS)]
+        )
+
+    assert asyncio.run(main()) == ["result"] * N_CALLERS
+    assert n_calls == 1
+    assert flight.get_stats() == {"calls": 1, "shared": N_CALLERS - 1}
+    assert flight.futures == {}
+
+
+def test_async_the_error_is_shared():
+    flight = SingleFlight()
+
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise ValueError("failed")
+
+    async def main():
+        return await asyncio.gather(
+            *[flight.ado("key", failing) for _ in range(N_CALLERS)],
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.get_stats()["calls"] == 1
+
+
+def test_async_cancelled_waiter_doesnt_cancel_the_call():
+    flight = SingleFlight()
+
+    async def slow_call():
+        await asyncio.sleep(0.05)
+
+        return "result"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.ado("key", slow_call))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flight.ado("key", slow_call))
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+
+        return await leader, waiter.cancelled()
+
+    assert asyncio.run(main()) == ("result", True)
@@ -14,6 +14,7 @@ from factory_rfx import (
     get_documents_from_response,
 )
 from translations import translations
+from oci_citations_utils import render_citations
 from utils import get_console_logger, remove_path_from_ref
 from oraclevs_4_rfx import OracleVS4RFX
 from opensearch_4_rfx import OpenSearchRFX
@@ -111,31 +112,6 @@ def show_books(the_collection):
     logger.info("")
 
 
-def highlight_substrings(text, delimiters, doc_ids_list):
-    """
-    For citations
-    Evidenzia le sottostringhe in un testo e aggiunge le liste di doc_id tra parentesi quadre.
-
-    Args:
-    - text (str): il testo originale.
-    - delimiters (list of tuples): ogni tupla contiene (start, end).
-    - doc_ids_list (list of lists): lista delle liste di doc_id associati ai delimitatori.
-
-    Returns:
-    - str: il testo con le sottostringhe evidenziate e le liste di doc_id aggiunte.
-    """
-    combined = list(zip(delimiters, doc_ids_list))
-    combined.sort(key=lambda x: x[0][0], reverse=True)
-
-    for (start, end), doc_ids in combined:
-        original_substring = text[start:end]
-        highlighted_substring = f"{original_substring}"
-        doc_id_str = f' [{", ".join(doc_ids)}]'
-        text = text[:start] + highlighted_substring + doc_id_str + text[end:]
-
-    return text
-
-
 def add_citations_to_answer(orig_answer, v_response):
     """
     for Cohere models add citations to the llm answer
@@ -144,21 +120,8 @@ def add_citations_to_answer(orig_answer, v_response):
     """
     citations = get_citations_from_response(v_response)
 
-    span_demarks = []
-    doc_ids = []
-
-    for citation in citations:
-        span_demarks.append(citation["interval"])
-
-        docs_for_this_citation = []
-        for doc in citation["documents"]:
-            docs_for_this_citation.append(doc["id"])
-        doc_ids.append(docs_for_this_citation)
-
-        assert len(doc_ids) == len(span_demarks)
-
     # this add the doc_id enclosed in []
-    new_answer = highlight_substrings(orig_answer, span_demarks, doc_ids)
+    new_answer = render_citations(orig_answer, citations)
 
     # adding docs list
     cited_docs = get_documents_from_response(v_response)
@@ -7,19 +7,28 @@ import streamlit as st
 import pandas as pd
 
 from factory_rfx import (
-    hyde_rag,
-    classic_rag,
+    close_rag_pipelines,
+    answer_questions,
+    answer_questions_streaming,
     get_text_from_response,
     get_citations_from_response,
     get_documents_from_response,
 )
 from translations import translations
+from oci_citations_utils import render_citations, CitationRenderer
 from utils import get_console_logger, remove_path_from_ref
 from output_utils import generate_markdown_file, generate_xlsx_file
 from oraclevs_4_rfx import OracleVS4RFX
 from opensearch_4_rfx import OpenSearchRFX
 
-from config import VECTOR_STORE_TYPE, LANG_SUPPORTED, VERBOSE
+from config import (
+    VECTOR_STORE_TYPE,
+    LANG_SUPPORTED,
+    VERBOSE,
+    MAX_CONCURRENT_QUESTIONS,
+    DO_STREAMING,
+    QUESTION_DEADLINE,
+)
 from config_private import DB_USER, DB_PWD, DB_HOST_IP, DB_SERVICE
 
 # the name of the column with all the questions
@@ -35,6 +44,9 @@ def reset_ui():
     """
     st.session_state.processed_questions = set()
 
+    # release connections and clients, they will be recreated
+    close_rag_pipelines()
+
 
 # to handle multilingual use the dictionary in translations.py
 def translate(text, v_lang):
@@ -112,31 +124,6 @@ def show_books(the_collection):
     logger.info("")
 
 
-def highlight_substrings(text, delimiters, doc_ids_list):
-    """
-    For citations
-    Evidenzia le sottostringhe in un testo e aggiunge le liste di doc_id tra parentesi quadre.
-
-    Args:
-    - text (str): il testo originale.
-    - delimiters (list of tuples): ogni tupla contiene (start, end).
-    - doc_ids_list (list of lists): lista delle liste di doc_id associati ai delimitatori.
-
-    Returns:
-    - str: il testo con le sottostringhe evidenziate e le liste di doc_id aggiunte.
-    """
-    combined = list(zip(delimiters, doc_ids_list))
-    combined.sort(key=lambda x: x[0][0], reverse=True)
-
-    for (start, end), doc_ids in combined:
-        original_substring = text[start:end]
-        highlighted_substring = f"{original_substring}"
-        doc_id_str = f' [{", ".join(doc_ids)}]'
-        text = text[:start] + highlighted_substring + doc_id_str + text[end:]
-
-    return text
-
-
 def add_citations_to_answer(orig_answer, v_response):
     """
     for Cohere models add citations to the llm answer
@@ -145,21 +132,8 @@ def add_citations_to_answer(orig_answer, v_response):
     """
     citations = get_citations_from_response(v_response)
 
-    span_demarks = []
-    doc_ids = []
-
-    for citation in citations:
-        span_demarks.append(citation["interval"])
-
-        docs_for_this_citation = []
-        for doc in citation["documents"]:
-            docs_for_this_citation.append(doc["id"])
-        doc_ids.append(docs_for_this_citation)
-
-        assert len(doc_ids) == len(span_demarks)
-
     # this add the doc_id enclosed in []
-    new_answer = highlight_substrings(orig_answer, span_demarks, doc_ids)
+    new_answer = render_citations(orig_answer, citations)
 
     # adding docs list
     cited_docs = get_documents_from_response(v_response)
@@ -270,7 +244,11 @@ if uploaded_file is not None:
     with col2:
         st.header(translate("Answers:", lang))
 
-    answers = []
+        # to show the answer to the current question, while streaming
+        streaming_placeholder = st.empty()
+
+    # aligned with questions, filled as each question is completed
+    answers = [""] * len(questions)
 
     # show the collection chosen
     logger.info("Collection chosen: %s", selected_collection)
@@ -279,40 +257,90 @@ if uploaded_file is not None:
     if VERBOSE:
         show_books(selected_collection)
 
-    #
-    # loop to process all questions
-    #
-    for i, question in enumerate(questions):
-
-        logger.info("Processing: %s ...", question)
-
-        # call the GenAI
-        if enable_hyde:
-            response = hyde_rag(
-                question,
-                llm_model,
-                add_reranker=add_reranker,
-                hybrid_search=enable_hybrid_search,
-                lang=lang,
-                selected_collection=selected_collection,
-                temperature=temperature,
+    rag_kwargs = {
+        "add_reranker": add_reranker,
+        "hybrid_search": enable_hybrid_search,
+        "lang": lang,
+        "selected_collection": selected_collection,
+        "temperature": temperature,
+        # a slow question is stopped, with an error as answer
+        "deadline": QUESTION_DEADLINE,
+    }
+
+    if DO_STREAMING:
+        #
+        # process questions one at a time, showing tokens as they arrive
+        #
+        logger.info("Processing %s questions, streaming...", len(questions))
+
+        # the text received so far for each question
+        streamed_texts = {}
+        # with citations: the answer and citations received for each question
+        renderers = {}
+
+        def show_token(index, text):
+            """
+            add the new piece of text to the answer shown
+            """
+            streamed_texts[index] = streamed_texts.get(index, "") + text
+
+            streaming_placeholder.markdown(
+                f"**{questions[index]}**\n\n{streamed_texts[index]}"
             )
-        else:
-            response = classic_rag(
-                question,
-                llm_model,
-                add_reranker=add_reranker,
-                hybrid_search=enable_hybrid_search,
-                lang=lang,
-                selected_collection=selected_collection,
-                temperature=temperature,
+
+        def show_event(index, event):
+            """
+            add the event (text, citations) to the answer shown, with citations
+            """
+            renderer = renderers.setdefault(index, CitationRenderer())
+            renderer.add_event(event)
+
+            streaming_placeholder.markdown(
+                f"**{questions[index]}**\n\n{renderer.render()}"
             )
 
+        if llm_model.startswith("cohere") and enable_citations:
+            streaming_kwargs = {"on_event": show_event}
+        else:
+            streaming_kwargs = {"on_token": show_token}
+
+        completed = answer_questions_streaming(
+            questions,
+            llm_model,
+            enable_hyde=enable_hyde,
+            **streaming_kwargs,
+            **rag_kwargs,
+        )
+    else:
+        #
+        # process all questions, in parallel
+        #
+        logger.info(
+            "Processing %s questions, %s in parallel...",
+            len(questions),
+            MAX_CONCURRENT_QUESTIONS,
+        )
+
+        completed = answer_questions(
+            questions,
+            llm_model,
+            enable_hyde=enable_hyde,
+            max_workers=MAX_CONCURRENT_QUESTIONS,
+            **rag_kwargs,
+        )
+
+    for n_completed, (i, response) in enumerate(completed, start=1):
+
+        logger.info("Completed: %s ...", questions[i])
+
         # we pass the name of the model because, in current implementation
         # response has a different structure
         answer = get_text_from_response(response, llm_model)
 
-        if ("cohere" in llm_model) and enable_citations:
+        # a failed question has the error as response
+        is_failed = isinstance(response, Exception)
+
+        if ("cohere" in llm_model) and enable_citations and not is_failed:
             # handle citations
             # modify answer to add citations
             answer = add_citations_to_answer(answer, response)
@@ -322,7 +350,7 @@ if uploaded_file is not None:
             logger.info("")
 
         # add here, because it has been eventually modified for citations
-        answers.append(answer)
+        answers[i] = answer
 
         # register it has been processed
         st.session_state.processed_questions.add(i)
@@ -335,13 +363,14 @@ if uploaded_file is not None:
             dataframe_placeholder.dataframe(df, hide_index=True)
 
             # update the progress bar
-            progress_bar.progress(int(i + 1) / len(questions))
+            progress_bar.progress(n_completed / len(questions))
 
     # when all questions have been processed, handle output
     dict_out = {"Answers": answers}
     df_out = pd.DataFrame(dict_out)
 
     with col2:
+        streaming_placeholder.empty()
         st.dataframe(df_out, hide_index=True)
 
     # save output file in xlsx